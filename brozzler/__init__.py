@@ -142,30 +142,43 @@ def behaviors(behaviors_dir=None):
     return _behaviors
 
 
-def behavior_script(url, template_parameters=None, behaviors_dir=None):
+def matching_behavior(url, behaviors_dir=None):
     """
-    Returns the javascript behavior string populated with template_parameters.
+    Returns the first behavior from `behaviors.yaml` whose `url_regex` matches
+    `url`, or `None`.
     """
-    import re, logging, json
+    import re
 
     for behavior in behaviors(behaviors_dir=behaviors_dir):
         if re.match(behavior["url_regex"], url):
-            parameters = dict()
-            if "default_parameters" in behavior:
-                parameters.update(behavior["default_parameters"])
-            if template_parameters:
-                parameters.update(template_parameters)
-            template = jinja2_environment(behaviors_dir).get_template(
-                behavior["behavior_js_template"]
-            )
-            script = template.render(parameters)
-            logging.info(
-                "using template=%r populated with parameters=%r for %r",
-                behavior["behavior_js_template"],
-                json.dumps(parameters),
-                url,
-            )
-            return script
+            return behavior
+    return None
+
+
+def behavior_script(url, template_parameters=None, behaviors_dir=None):
+    """
+    Returns the javascript behavior string populated with template_parameters.
+    """
+    import logging, json
+
+    behavior = matching_behavior(url, behaviors_dir=behaviors_dir)
+    if behavior:
+        parameters = dict()
+        if "default_parameters" in behavior:
+            parameters.update(behavior["default_parameters"])
+        if template_parameters:
+            parameters.update(template_parameters)
+        template = jinja2_environment(behaviors_dir).get_template(
+            behavior["behavior_js_template"]
+        )
+        script = template.render(parameters)
+        logging.info(
+            "using template=%r populated with parameters=%r for %r",
+            behavior["behavior_js_template"],
+            json.dumps(parameters),
+            url,
+        )
+        return script
     return None
 
 
@@ -358,6 +371,7 @@ from brozzler.model import (
     new_site,
     Job,
     Page,
+    PageOutlinks,
     Site,
     InvalidJobConf,
 )
@@ -365,6 +379,7 @@ from brozzler.cli import suggest_default_chrome_exe
 
 __all__ = [
     "Page",
+    "PageOutlinks",
     "Site",
     "BrozzlerWorker",
     "is_permitted_by_robots",
@@ -0,0 +1,740 @@
+"""
+brozzler/aiobrowser.py - asyncio counterparts of the browser classes in
+brozzler/browser.py, driving chrome over the devtools protocol without a
+thread per browser
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import brozzler
+import asyncio
+import functools
+import itertools
+import json
+import socket
+import sys
+import time
+import urlcanon
+from ipaddress import AddressValueError
+from brozzler.browser import (
+    BrowsingException,
+    BrowsingTimeout,
+    CdpSession,
+    NoBrowsersAvailable,
+    b64decode_to_buffer,
+    session_setup_messages,
+)
+from brozzler.chrome import Chrome
+
+try:
+    import websockets
+except ImportError as e:
+    logging.critical(
+        '%s: %s\n\nYou might need to run "pip install '
+        'brozzler[async]".\nSee README.rst for more information.',
+        type(e).__name__,
+        e,
+    )
+    sys.exit(1)
+
+
+def run_in_thread(fn, *args, **kwargs):
+    """
+    Runs blocking `fn(*args, **kwargs)` in the event loop's default executor,
+    for rethinkdb queries and the like.
+
+    Returns:
+        awaitable result of `fn`
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+class AsyncCdpSession(CdpSession):
+    """
+    Session with a tab over an asyncio websocket connection, see `receive()`.
+
+    Rather than raising exceptions in a calling thread, events that abort
+    browsing (reaching a warcprox limit, a proxy error, a crashed tab...)
+    resolve `self.aborted` with the exception, and `guard()` cancels whatever
+    is being awaited when that happens.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, websock):
+        super().__init__()
+        self.websock = websock
+        self.is_open = True
+        self.closing = False
+        self._ids = itertools.count(1)
+        self._futures = {}  # {msg_id: Future} of commands awaiting results
+        self._changed = asyncio.Event()
+        self._sends = set()
+        self.aborted = asyncio.get_running_loop().create_future()
+
+    def _notify_changed(self):
+        self._changed.set()
+
+    def note_network_activity(self):
+        super().note_network_activity()
+        self._changed.set()
+
+    def _abort(self, exception_class):
+        if exception_class is brozzler.ReachedLimit and self.reached_limit:
+            e = self.reached_limit
+        else:
+            e = exception_class()
+        if not self.aborted.done():
+            self.aborted.set_result(e)
+        self._changed.set()
+
+    def reset_abort(self):
+        """
+        Forgets why browsing was last aborted, if it was, unless the
+        connection is gone.
+        """
+        if self.aborted.done() and self.is_open:
+            self.aborted = asyncio.get_running_loop().create_future()
+
+    async def receive(self):
+        """
+        Dispatches messages from chrome until the websocket is closed.
+        """
+        try:
+            async for message in self.websock:
+                try:
+                    self.dispatch(json.loads(message))
+                except Exception:
+                    self.logger.error(
+                        "uncaught exception handling message=%s",
+                        message,
+                        exc_info=True,
+                    )
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.is_open = False
+            if not self.closing:
+                self.logger.error("websocket closed, did chrome die?")
+            self._abort(BrowsingException)
+
+    def dispatch(self, message):
+        if message.get("id") in self._futures:
+            future = self._futures.pop(message["id"])
+            if not future.done():
+                future.set_result(message)
+        else:
+            super().dispatch(message)
+
+    def send(self, message):
+        task = asyncio.get_running_loop().create_task(
+            self.websock.send(json.dumps(message, separators=",:"))
+        )
+        # keep a reference until sent
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def post(self, method, **params):
+        """
+        Sends command `method` without waiting for its result.
+        """
+        await self.websock.send(
+            json.dumps(
+                dict(id=next(self._ids), method=method, params=params),
+                separators=",:",
+            )
+        )
+
+    async def command(self, method, timeout=30, **params):
+        """
+        Sends command `method` and returns its result.
+
+        Raises:
+            BrowsingTimeout: if the result doesn't come within `timeout`
+                seconds
+            BrowsingException: if chrome responds with an error
+        """
+        msg_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[msg_id] = future
+        try:
+            await self.websock.send(
+                json.dumps(
+                    dict(id=msg_id, method=method, params=params), separators=",:"
+                )
+            )
+            message = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise BrowsingTimeout(
+                "timed out after %ss waiting for result of %s" % (timeout, method)
+            )
+        finally:
+            self._futures.pop(msg_id, None)
+        if "error" in message:
+            raise BrowsingException("%s failed: %s" % (method, message["error"]))
+        return message.get("result", {})
+
+    async def wait_for(self, callback, timeout=None):
+        """
+        Waits until callback() returns truthy, checking again whenever a
+        message from chrome changes the state of the session.
+
+        Raises:
+            BrowsingTimeout: if `timeout` seconds pass first
+        """
+
+        async def _wait():
+            while not callback():
+                self._changed.clear()
+                await self._changed.wait()
+
+        try:
+            await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            raise BrowsingTimeout(
+                "timed out after %ss waiting for: %s" % (timeout, callback)
+            )
+
+    async def wait_for_network_idle(self, idle_ms=500, timeout=30, max_inflight=0):
+        """
+        Waits until at most `max_inflight` requests are in flight and no
+        request has started or finished for `idle_ms` milliseconds.
+
+        Returns:
+            `True` if the network went idle, `False` if `timeout` seconds
+            passed first
+        """
+        idle = idle_ms / 1000
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self.network_idle_for(idle, max_inflight):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            quiet_for = time.monotonic() - self.last_network_activity
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait(), min(remaining, max(idle - quiet_for, 0.01))
+                )
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def guard(self, awaitable):
+        """
+        Awaits `awaitable`, unless browsing is aborted first, in which case
+        `awaitable` is cancelled and the exception that aborted browsing is
+        raised.
+        """
+        task = asyncio.ensure_future(awaitable)
+        try:
+            await asyncio.wait(
+                {task, self.aborted}, return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.done():
+            return task.result()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.debug("%r after browsing was aborted", e)
+        raise self.aborted.result()
+
+
+class AsyncBrowser:
+    """
+    Manages an instance of chrome for browsing pages, like
+    `brozzler.Browser`, from an asyncio event loop.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes the AsyncBrowser.
+
+        Args:
+            **kwargs: arguments for Chrome(...)
+        """
+        self.chrome = Chrome(**kwargs)
+        self.session = None
+        self._receiver = None
+        self.is_browsing = False
+
+    def is_running(self):
+        return self.session is not None
+
+    async def start(self, proxy=None, cookie_db=None, cookies=None, **kwargs):
+        """
+        Starts chrome if it's not running.
+
+        Args:
+            proxy: http proxy 'host:port' (default None)
+            cookie_db: raw bytes of chrome/chromium sqlite3 cookies database,
+                which, if supplied, will be written to the user data dir
+                before starting chrome (default None)
+            cookies: accepted for compatibility with `Browser.start()` and
+                ignored, they only apply to warm browsers
+            **kwargs: arguments for self.chrome.start(...)
+        """
+        if self.is_running():
+            return
+        websock_url = await run_in_thread(
+            self.chrome.start, proxy=proxy, cookie_db=cookie_db, **kwargs
+        )
+        # screenshots can be many megabytes, hence max_size=None
+        websock = await websockets.connect(
+            websock_url, max_size=None, ping_interval=None, open_timeout=30
+        )
+        self.session = AsyncCdpSession(websock)
+        self._receiver = asyncio.get_running_loop().create_task(self.session.receive())
+        for message in session_setup_messages(self.logger.isEnabledFor(logging.DEBUG)):
+            await self.session.command(message["method"], **message.get("params", {}))
+
+    async def stop(self):
+        """
+        Stops chrome if it's running.
+        """
+        try:
+            if self.session:
+                self.session.closing = True
+                await self.session.websock.close()
+            if self._receiver:
+                await self._receiver
+            await run_in_thread(self.chrome.stop)
+        except Exception:
+            self.logger.error("problem stopping", exc_info=True)
+        finally:
+            self.session = None
+            self._receiver = None
+
+    async def browse_page(
+        self,
+        page_url,
+        extra_headers=None,
+        user_agent=None,
+        behavior_parameters=None,
+        behaviors_dir=None,
+        on_request=None,
+        on_response=None,
+        on_service_worker_version_updated=None,
+        on_screenshot=None,
+        username=None,
+        password=None,
+        hashtags=None,
+        screenshot_full_page=False,
+        skip_extract_outlinks=False,
+        skip_visit_hashtags=False,
+        skip_youtube_dl=False,
+        ytdlp_tmpdir="/tmp",
+        simpler404=False,
+        page_timeout=300,
+        behavior_timeout=900,
+        extract_outlinks_timeout=60,
+        download_throughput=-1,
+        stealth=False,
+    ):
+        """
+        Browses page in browser, see `brozzler.Browser.browse_page()`, which
+        takes the same arguments.
+
+        Callbacks are called in the event loop and must not block.
+
+        Returns:
+            A tuple (final_page_url, outlinks).
+
+        Raises:
+            brozzler.ProxyError: in case of proxy connection error
+            BrowsingException: if browsing the page fails in some other way
+        """
+        if not self.is_running():
+            raise BrowsingException("browser has not been started")
+        if self.is_browsing:
+            raise BrowsingException("browser is already busy browsing a page")
+        self.is_browsing = True
+        session = self.session
+        session.reset_abort()
+        session.on_request = on_request
+        session.on_response = on_response
+        session.on_service_worker_version_updated = on_service_worker_version_updated
+        try:
+            return await session.guard(
+                self._browse_page(
+                    page_url,
+                    extra_headers=extra_headers,
+                    user_agent=user_agent,
+                    behavior_parameters=behavior_parameters,
+                    behaviors_dir=behaviors_dir,
+                    on_screenshot=on_screenshot,
+                    username=username,
+                    password=password,
+                    hashtags=hashtags,
+                    screenshot_full_page=screenshot_full_page,
+                    skip_extract_outlinks=skip_extract_outlinks,
+                    skip_visit_hashtags=skip_visit_hashtags,
+                    simpler404=simpler404,
+                    page_timeout=page_timeout,
+                    behavior_timeout=behavior_timeout,
+                    extract_outlinks_timeout=extract_outlinks_timeout,
+                    download_throughput=download_throughput,
+                    stealth=stealth,
+                )
+            )
+        except websockets.ConnectionClosed as e:
+            self.logger.error("websocket closed, did chrome die?")
+            raise BrowsingException(e)
+        finally:
+            self.is_browsing = False
+            session.on_request = None
+            session.on_response = None
+            session.on_service_worker_version_updated = None
+
+    async def _browse_page(
+        self,
+        page_url,
+        extra_headers,
+        user_agent,
+        behavior_parameters,
+        behaviors_dir,
+        on_screenshot,
+        username,
+        password,
+        hashtags,
+        screenshot_full_page,
+        skip_extract_outlinks,
+        skip_visit_hashtags,
+        simpler404,
+        page_timeout,
+        behavior_timeout,
+        extract_outlinks_timeout,
+        download_throughput,
+        stealth,
+    ):
+        await self.configure_browser(
+            extra_headers=extra_headers,
+            user_agent=user_agent,
+            download_throughput=download_throughput,
+            stealth=stealth,
+        )
+        await self.navigate_to_page(page_url, timeout=page_timeout)
+        if password:
+            await self.try_login(username, password, timeout=page_timeout)
+            # if login redirected us, return to page_url
+            if page_url != (await self.url()).split("#")[0]:
+                self.logger.debug("login navigated away from %s; returning!", page_url)
+                await self.navigate_to_page(page_url, timeout=page_timeout)
+        page_status = self.session.page_status
+        run_behaviors = not (simpler404 and (page_status is None or page_status >= 400))
+
+        if run_behaviors and behavior_timeout > 0:
+            behavior_script = brozzler.behavior_script(
+                page_url, behavior_parameters, behaviors_dir=behaviors_dir
+            )
+            behavior = brozzler.matching_behavior(page_url, behaviors_dir=behaviors_dir)
+            await self.run_behavior(
+                behavior_script,
+                timeout=behavior_timeout,
+                request_idle_timeout=(
+                    behavior and behavior.get("request_idle_timeout_sec")
+                ),
+            )
+        final_page_url = await self.url()
+        if on_screenshot and (
+            not simpler404 or (page_status is not None and page_status < 400)
+        ):
+            await self._try_screenshot(on_screenshot, screenshot_full_page)
+
+        if not run_behaviors or skip_extract_outlinks:
+            outlinks = []
+        else:
+            outlinks = await self.extract_outlinks(timeout=extract_outlinks_timeout)
+        if run_behaviors and not skip_visit_hashtags:
+            await self.visit_hashtags(final_page_url, hashtags, outlinks)
+        return final_page_url, outlinks
+
+    async def configure_browser(
+        self, extra_headers=None, user_agent=None, download_throughput=-1, stealth=False
+    ):
+        headers = dict(extra_headers or {})
+        headers["Accept-Encoding"] = "gzip"  # avoid encodings br, sdch
+        await self.session.command("Network.setExtraHTTPHeaders", headers=headers)
+        if user_agent:
+            await self.session.command(
+                "Network.setUserAgentOverride", userAgent=user_agent
+            )
+        if download_throughput > -1:
+            await self.session.command(
+                "Network.emulateNetworkConditions",
+                downloadThroughput=download_throughput,
+            )
+        if stealth:
+            js = brozzler.jinja2_environment().get_template("stealth.js").render()
+            await self.session.command(
+                "Page.addScriptToEvaluateOnNewDocument", timeout=10, source=js
+            )
+
+    async def navigate_to_page(self, page_url, timeout=300):
+        self.logger.info("navigating to page %s", page_url)
+        self.session.got_page_load_event = None
+        self.session.page_status = None
+        self.session.reset_network_activity()
+        await self.session.post("Page.navigate", url=page_url)
+        await self.session.wait_for(
+            lambda: self.session.got_page_load_event, timeout=timeout
+        )
+
+    async def evaluate(self, expression, timeout=30):
+        """
+        Returns the result of evaluating javascript `expression` in the page,
+        as described by the devtools protocol's Runtime.evaluate.
+        """
+        return await self.session.command(
+            "Runtime.evaluate", timeout=timeout, expression=expression
+        )
+
+    async def url(self, timeout=30):
+        """
+        Returns value of document.URL from the browser.
+        """
+        result = await self.evaluate("document.URL", timeout=timeout)
+        return result["result"]["value"]
+
+    async def extract_outlinks(self, timeout=60):
+        self.logger.info("extracting outlinks")
+        js = brozzler.jinja2_environment().get_template("extract-outlinks.js").render()
+        result = await self.evaluate(js, timeout=timeout)
+        if "result" in result and "value" in result["result"]:
+            if result["result"]["value"]:
+                out = []
+                for link in result["result"]["value"].split("\n"):
+                    try:
+                        out.append(str(urlcanon.whatwg(link)))
+                    except AddressValueError:
+                        self.logger.warning("skip invalid outlink: %s", link)
+                return frozenset(out)
+            else:
+                # no links found
+                return frozenset()
+        else:
+            self.logger.error("problem extracting outlinks, result: %s", result)
+            return frozenset()
+
+    async def _try_screenshot(self, on_screenshot, full_page=False):
+        # the page must be scrolled to the top before taking a screenshot
+        await self.session.post("Runtime.evaluate", expression="window.scroll(0,0)")
+        for i in range(3):
+            try:
+                jpeg_bytes = await self.screenshot(full_page)
+                on_screenshot(jpeg_bytes)
+                return
+            except BrowsingTimeout as e:
+                logging.error("attempt %s/3: %s", i + 1, e)
+
+    async def screenshot(self, full_page=False, timeout=45):
+        """
+        Returns:
+            memoryview of the jpeg bytes
+        """
+        self.logger.info("taking screenshot")
+        capture_params = {"format": "jpeg", "quality": 95, "optimizeForSpeed": True}
+        if full_page:
+            result = await self.session.command(
+                "Page.getLayoutMetrics", timeout=timeout
+            )
+            width = result["contentSize"]["width"]
+            height = result["contentSize"]["height"]
+            await self.session.command(
+                "Emulation.setDeviceMetricsOverride",
+                mobile=False,
+                width=width,
+                height=height,
+                deviceScaleFactor=1,
+                screenOrientation={"angle": 0, "type": "portraitPrimary"},
+            )
+            capture_params["clip"] = dict(x=0, y=0, width=width, height=height, scale=1)
+        result = await self.session.command(
+            "Page.captureScreenshot", timeout=timeout, **capture_params
+        )
+        # don't keep the base64 around any longer than necessary
+        return b64decode_to_buffer(result.pop("data"))
+
+    async def visit_hashtags(self, page_url, hashtags, outlinks):
+        _hashtags = set(hashtags or [])
+        for outlink in outlinks:
+            url = urlcanon.whatwg(outlink)
+            hashtag = (url.hash_sign + url.fragment).decode("utf-8")
+            urlcanon.canon.remove_fragment(url)
+            if hashtag and str(url) == page_url:
+                _hashtags.add(hashtag)
+        for hashtag in _hashtags:
+            self.logger.debug("navigating to hashtag %s", hashtag)
+            url = urlcanon.whatwg(page_url)
+            url.hash_sign = b"#"
+            url.fragment = hashtag[1:].encode("utf-8")
+            self.session.note_network_activity()
+            await self.session.post("Page.navigate", url=str(url))
+            # give the page up to 5 seconds to fetch whatever the hashtag
+            # leads it to fetch
+            await self.session.wait_for_network_idle(idle_ms=1000, timeout=5)
+
+    async def run_behavior(
+        self, behavior_script, timeout=900, request_idle_timeout=None
+    ):
+        """
+        Runs `behavior_script` until it says it has finished, or until
+        `timeout` seconds have passed, or, if `request_idle_timeout` is set,
+        until no requests have started or finished for that many seconds.
+        """
+        self.session.note_network_activity()
+        await self.session.post("Runtime.evaluate", expression=behavior_script)
+        try:
+            await asyncio.wait_for(
+                self._wait_for_behavior(min(timeout, 7), request_idle_timeout),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            logging.info("behavior reached hard timeout after %.1fs", timeout)
+
+    async def _wait_for_behavior(self, check_interval, request_idle_timeout):
+        while True:
+            if request_idle_timeout:
+                if await self.session.wait_for_network_idle(
+                    idle_ms=request_idle_timeout * 1000, timeout=check_interval
+                ):
+                    self.logger.info(
+                        "behavior finished, no network activity for %ss",
+                        request_idle_timeout,
+                    )
+                    return
+            else:
+                await asyncio.sleep(check_interval)
+            try:
+                result = await self.evaluate("umbraBehaviorFinished()", timeout=5)
+            except BrowsingTimeout:
+                continue
+            if (
+                "exceptionDetails" not in result
+                and not result.get("wasThrown")
+                and result.get("result", {}).get("value") is True
+            ):
+                self.logger.info("behavior decided it has finished")
+                return
+
+    async def try_login(self, username, password, timeout=300):
+        try_login_js = (
+            brozzler.jinja2_environment()
+            .get_template("try-login.js.j2")
+            .render(username=username, password=password)
+        )
+        self.session.got_page_load_event = None
+        await self.session.post("Runtime.evaluate", expression=try_login_js)
+
+        # wait for tryLogin to finish trying (should be very very quick)
+        start = time.time()
+        while True:
+            try:
+                result = await self.evaluate(
+                    'try { __brzl_tryLoginState } catch (e) { "maybe-submitted-form" }',
+                    timeout=5,
+                )
+                state = result.get("result", {}).get("value")
+                if state == "login-form-not-found":
+                    # we're done
+                    return
+                elif state in ("submitted-form", "maybe-submitted-form"):
+                    self.logger.info(
+                        "submitted a login form, waiting for another page load event"
+                    )
+                    break
+                # else try again to get __brzl_tryLoginState
+            except BrowsingTimeout:
+                pass
+            if time.time() - start > 30:
+                raise BrowsingException(
+                    "timed out trying to check if tryLogin finished"
+                )
+
+        await self.session.wait_for(
+            lambda: self.session.got_page_load_event, timeout=timeout
+        )
+
+
+class AsyncBrowserPool:
+    """
+    Pool of up to `size` `AsyncBrowser`s, each on a debugging port of its
+    own. Released browsers are stopped.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, size=3, **kwargs):
+        """
+        Args:
+            size: size of pool (default 3)
+            **kwargs: arguments for AsyncBrowser(...)
+        """
+        self.size = size
+        self.kwargs = kwargs
+        self._in_use = set()
+
+    def _fresh_browser(self):
+        # choose available port
+        sock = socket.socket()
+        sock.bind(("0.0.0.0", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return AsyncBrowser(port=port, **self.kwargs)
+
+    def acquire_multi(self, n=1):
+        """
+        Returns a list of up to `n` browsers.
+
+        Raises:
+            NoBrowsersAvailable if none available
+        """
+        if len(self._in_use) >= self.size:
+            raise NoBrowsersAvailable
+        browsers = []
+        while len(self._in_use) < self.size and len(browsers) < n:
+            browser = self._fresh_browser()
+            browsers.append(browser)
+            self._in_use.add(browser)
+        return browsers
+
+    async def release(self, browser):
+        try:
+            await browser.stop()  # make sure
+        finally:
+            self._in_use.discard(browser)
+
+    async def shutdown_now(self):
+        self.logger.info(
+            "shutting down browser pool (%s browsers in use)", len(self._in_use)
+        )
+        await asyncio.gather(*(browser.stop() for browser in list(self._in_use)))
+
+    def num_available(self):
+        return self.size - len(self._in_use)
+
+    def num_in_use(self):
+        return len(self._in_use)
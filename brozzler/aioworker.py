@@ -0,0 +1,392 @@
+"""
+brozzler/aioworker.py - brozzler worker that brozzles sites in asyncio tasks
+of a single event loop, rather than in a thread per site
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import brozzler
+import brozzler.aiobrowser
+import brozzler.frontier
+import brozzler.worker
+import asyncio
+import concurrent.futures
+import socket
+import time
+import rethinkdb as rdb
+from brozzler.aiobrowser import run_in_thread
+from . import metrics
+from . import ydl
+
+r = rdb.RethinkDB()
+
+
+class AsyncBrozzlerWorker(brozzler.worker.BrozzlerWorker):
+    """
+    Brozzler worker with the same frontier semantics as `BrozzlerWorker`,
+    that brozzles each claimed site in an asyncio task and drives its
+    browsers with `brozzler.aiobrowser.AsyncBrowser`, all in one event loop.
+
+    Rethinkdb queries, robots.txt checks, youtube-dl and the like block, so
+    they run in the event loop's default executor, a pool of
+    `max_browsers + 4` threads.
+
+    Shutting down cancels the site tasks, which disclaim their sites on the
+    way out. Browsers are not kept warm, and each site is brozzled in a
+    single tab.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(
+        self,
+        frontier,
+        service_registry=None,
+        max_browsers=1,
+        chrome_exe="chromium-browser",
+        **kwargs,
+    ):
+        if kwargs.get("warm_browsers") or kwargs.get("tabs_per_site", 1) > 1:
+            raise ValueError(
+                "warm_browsers and tabs_per_site are not supported by "
+                "AsyncBrozzlerWorker"
+            )
+        super().__init__(
+            frontier,
+            service_registry,
+            max_browsers=max_browsers,
+            chrome_exe=chrome_exe,
+            **kwargs,
+        )
+        self._browser_pool = brozzler.aiobrowser.AsyncBrowserPool(
+            max_browsers, chrome_exe=chrome_exe, ignore_cert_errors=True
+        )
+        self._site_tasks = set()
+        self._loop = None
+        self._async_wakeup = None
+
+    def run(self):
+        asyncio.run(self._run())
+
+    def stop(self):
+        self._shutdown.set()
+        self._wake_up_loop()
+
+    def _work_available(self, claimable_at):
+        self._claim_backoff.work_available(claimable_at)
+        self._wake_up_loop()
+
+    def _wake_up_loop(self):
+        loop = self._loop
+        if loop:
+            loop.call_soon_threadsafe(self._async_wakeup.set)
+
+    async def _run(self):
+        self.logger.notice(
+            "brozzler %s - brozzler-worker starting (asyncio)", brozzler.__version__
+        )
+        # set by stop(), whenever a site task finishes, and when a site
+        # becomes claimable
+        self._async_wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_browsers + 4,
+                thread_name_prefix="AsyncBrozzlerWorker",
+            )
+        )
+        self._start_watching_claimable_sites()
+        try:
+            while not self._shutdown.is_set():
+                self._async_wakeup.clear()
+                await run_in_thread(self._service_heartbeat_if_due)
+                if not self._claim_backoff.wait_time():
+                    try:
+                        await self._start_browsing_some_sites()
+                        self._claim_backoff.succeeded()
+                    except brozzler.browser.NoBrowsersAvailable:
+                        logging.trace("all %s browsers are in use", self._max_browsers)
+                    except brozzler.NothingToClaim:
+                        self._claim_backoff.nothing_to_claim()
+                        logging.trace(
+                            "nothing to claim, all available active sites "
+                            "are already claimed by a brozzler worker"
+                        )
+                timeout = self.MAX_IDLE_WAIT
+                if self._browser_pool.num_available():
+                    timeout = min(timeout, self._claim_backoff.wait_time())
+                try:
+                    await asyncio.wait_for(self._async_wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.logger.notice("shutdown requested")
+        except r.ReqlError as e:
+            self.logger.error(
+                "caught rethinkdb exception, will try to proceed", exc_info=True
+            )
+        except:
+            self.logger.critical(
+                "event loop exiting due to unexpected exception", exc_info=True
+            )
+        finally:
+            if self._service_registry and hasattr(self, "status_info"):
+                try:
+                    await run_in_thread(
+                        self._service_registry.unregister, self.status_info["id"]
+                    )
+                except:
+                    self.logger.error(
+                        "failed to unregister from service registry", exc_info=True
+                    )
+
+            self.logger.info("shutting down %s site tasks", len(self._site_tasks))
+            tasks = set(self._site_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._browser_pool.shutdown_now()
+            try:
+                await run_in_thread(self._frontier.flush_writes)
+            except:
+                self.logger.error("failed to flush buffered writes", exc_info=True)
+            await run_in_thread(self._frontier.close)
+            await run_in_thread(self._shutdown_executors)
+            self._loop = None
+
+    async def _start_browsing_some_sites(self):
+        """
+        Starts browsing some sites.
+
+        Raises:
+            NoBrowsersAvailable if none available
+        """
+        browsers = self._browser_pool.acquire_multi(
+            (self._browser_pool.num_available() + 1) // 2
+        )
+        try:
+            sites = await run_in_thread(self._frontier.claim_sites, len(browsers))
+        except BaseException:
+            for browser in browsers:
+                await self._browser_pool.release(browser)
+            raise
+
+        for i, browser in enumerate(browsers):
+            if i < len(sites):
+                task = self._loop.create_task(
+                    self._brozzle_site_task(browser, sites[i]),
+                    name="BrozzlingTask:%s" % browser.chrome.port,
+                )
+                self._site_tasks.add(task)
+                task.add_done_callback(self._site_task_done)
+            else:
+                await self._browser_pool.release(browser)
+
+    def _site_task_done(self, task):
+        self._site_tasks.discard(task)
+        self._async_wakeup.set()
+
+    async def _brozzle_site_task(self, browser, site):
+        try:
+            await self.brozzle_site(browser, site)
+        finally:
+            await self._browser_pool.release(browser)
+
+    async def brozzle_site(self, browser, site):
+        worker_id = "%s:%s" % (socket.gethostname(), browser.chrome.port)
+        page_queue = brozzler.frontier.ClaimedPageQueue(
+            self._frontier, site, worker_id, self._page_claim_batch_size
+        )
+        page = None
+        start = time.time()
+        try:
+            site.last_claimed_by = worker_id
+            await run_in_thread(site.save)
+            await run_in_thread(self._frontier.enforce_time_limit, site)
+            await run_in_thread(self._frontier.honor_stop_request, site)
+            if self._seen_pages_cache:
+                await run_in_thread(self._frontier.warm_seen_pages, site)
+            proxy = await run_in_thread(self._proxy_for, site)
+            self.logger.info("brozzling site (proxy=%r) %s", proxy, site)
+            if self._frontier.prefetch_robots:
+                brozzler.robots.prefetch_robots(site, site.seed, proxy)
+            while time.time() - start < self.SITE_SESSION_MINUTES * 60:
+                page = await run_in_thread(self._claim_page, site, page_queue)
+                if page.needs_robots_check and not await run_in_thread(
+                    brozzler.is_permitted_by_robots, site, page.url, proxy
+                ):
+                    logging.warning("page %s is blocked by robots.txt", page.url)
+                    page.blocked_by_robots = True
+                    await run_in_thread(self._frontier.completed_page, site, page)
+                else:
+                    wait = await run_in_thread(self._reserve_host_turn, site, page)
+                    if wait is not None:
+                        await asyncio.sleep(wait)
+                        outlinks = await self.brozzle_page(browser, site, page)
+                        await run_in_thread(
+                            self._page_brozzled, browser, site, page, outlinks, proxy
+                        )
+                page = None
+        except asyncio.CancelledError:
+            self.logger.info("shutdown requested")
+            raise
+        except Exception as e:
+            page = await run_in_thread(self._site_session_failed, site, page, e)
+        finally:
+            site.active_brozzling_time = (
+                (site.active_brozzling_time or 0) + time.time() - start
+            )
+            await run_in_thread(self._end_site_session, site, page, page_queue)
+
+    def _claim_page(self, site, page_queue):
+        self._frontier.refresh_site(site)
+        self._frontier.enforce_time_limit(site)
+        self._frontier.honor_stop_request(site)
+        return page_queue.claim()
+
+    def _page_brozzled(self, browser, site, page, outlinks, proxy):
+        self._frontier.completed_page(site, page)
+        self._frontier.scope_and_schedule_outlinks(site, page, outlinks, proxy=proxy)
+        if browser.is_running():
+            site.cookie_db = browser.chrome.persist_and_read_cookie_db()
+
+    def _end_site_session(self, site, page, page_queue):
+        self._frontier.forget_seen_pages(site)
+        self._content_type_prober.forget_site(site)
+        try:
+            page_queue.release()
+        except Exception as e:
+            # disclaim the site regardless, lest it stay claimed until the
+            # claim goes stale
+            self.logger.error(
+                "problem disclaiming pages of site %s", site, exc_info=True
+            )
+        self._frontier.disclaim_site(site, page)
+
+    async def brozzle_page(self, browser, site, page):
+        self.logger.info("brozzling {}".format(page))
+        outlinks = set()
+
+        page_headers = await run_in_thread(self._get_page_headers, site, page)
+
+        if not self._needs_browsing(page_headers):
+            self.logger.info("needs fetch: %s", page)
+            await run_in_thread(self._fetch_url, site, page=page)
+        else:
+            self.logger.info("needs browsing: %s", page)
+            status_code = None
+            try:
+                outlinks.update(await self._browse_page(browser, site, page))
+                status_code = browser.session.page_status
+                if status_code in [502, 504]:
+                    raise brozzler.PageConnectionError()
+            except brozzler.PageInterstitialShown:
+                self.logger.info("page interstitial shown (http auth): %s", page)
+
+            if not self._skip_youtube_dl and ydl.should_ytdlp(
+                site, page, status_code, self._skip_av_seeds
+            ):
+                outlinks.update(await run_in_thread(self._do_youtube_dl, site, page))
+        return outlinks
+
+    async def _browse_page(self, browser, site, page):
+        using_warcprox = await run_in_thread(self._using_warcprox, site)
+        proxy = await run_in_thread(self._proxy_for, site)
+        # screenshot records and service worker scripts are sent while
+        # browsing goes on
+        pending = []
+
+        def on_screenshot(screenshot_jpeg):
+            if using_warcprox:
+                self.logger.info(
+                    "sending WARCPROX_WRITE_RECORD request to %s with "
+                    "screenshot for %s",
+                    proxy,
+                    page,
+                )
+                future = self._screenshot_executor.submit(
+                    self._write_screenshot_records,
+                    proxy,
+                    page.url,
+                    screenshot_jpeg,
+                    site.extra_headers(page),
+                )
+                pending.append(asyncio.wrap_future(future))
+
+        def on_response(chrome_msg):
+            video = brozzler.worker.embedded_video(chrome_msg)
+            if video:
+                logging.debug("embedded video %s", video)
+                if not "videos" in page:
+                    page.videos = []
+                page.videos.append(video)
+
+        sw_fetched = set()
+
+        def on_service_worker_version_updated(chrome_msg):
+            # https://github.com/internetarchive/brozzler/issues/140
+            if chrome_msg.get("params", {}).get("versions"):
+                url = chrome_msg.get("params", {}).get("versions")[0].get("scriptURL")
+                if url and url.startswith("http") and url not in sw_fetched:
+                    self.logger.info("fetching service worker script %s", url)
+                    pending.append(run_in_thread(self._fetch_url, site, url=url))
+                    sw_fetched.add(url)
+
+        if not browser.is_running():
+            await browser.start(
+                proxy=proxy,
+                cookie_db=site.get("cookie_db"),
+                window_height=self._window_height,
+                window_width=self._window_width,
+            )
+        try:
+            final_page_url, outlinks = await browser.browse_page(
+                page.url,
+                extra_headers=site.extra_headers(page),
+                behavior_parameters=site.get("behavior_parameters"),
+                username=site.get("username"),
+                password=site.get("password"),
+                user_agent=site.get("user_agent"),
+                on_screenshot=on_screenshot,
+                on_response=on_response,
+                on_service_worker_version_updated=on_service_worker_version_updated,
+                hashtags=page.hashtags,
+                skip_extract_outlinks=self._skip_extract_outlinks,
+                skip_visit_hashtags=self._skip_visit_hashtags,
+                skip_youtube_dl=self._skip_youtube_dl,
+                ytdlp_tmpdir=self._ytdlp_tmpdir,
+                simpler404=self._simpler404,
+                screenshot_full_page=self._screenshot_full_page,
+                page_timeout=self._page_timeout,
+                behavior_timeout=self._behavior_timeout,
+                extract_outlinks_timeout=self._extract_outlinks_timeout,
+                download_throughput=self._download_throughput,
+                stealth=self._stealth,
+            )
+        except BaseException:
+            # not worth waiting for now, but failures must not go unnoticed
+            for future in pending:
+                future.add_done_callback(self._log_pending_failure)
+            raise
+        # raises brozzler.ProxyError if a record couldn't be sent
+        for future in pending:
+            await future
+        if final_page_url != page.url:
+            page.note_redirect(final_page_url)
+        metrics.brozzler_last_page_crawled_time.set_to_current_time()
+        metrics.brozzler_pages_crawled.inc(1)
+        metrics.brozzler_outlinks_found.inc(len(outlinks))
+        return outlinks
@@ -28,12 +28,34 @@ import brozzler
 from requests.structures import CaseInsensitiveDict
 import datetime
 import base64
+import binascii
+import concurrent.futures
 from ipaddress import AddressValueError
 from brozzler.chrome import Chrome
 import socket
 import urlcanon
 
 
+def b64decode_to_buffer(data, chunk_size=4 * 1024 * 1024):
+    """
+    Decodes base64 string `data` a chunk at a time into a buffer of exactly the
+    decoded size, avoiding the full size intermediate copies that
+    `base64.b64decode()` makes.
+
+    Returns:
+        memoryview of the decoded bytes
+    """
+    if len(data) % 4 or chunk_size % 4:
+        return memoryview(base64.b64decode(data))
+    buf = bytearray(len(data) // 4 * 3 - data[-2:].count("="))
+    pos = 0
+    for i in range(0, len(data), chunk_size):
+        decoded = binascii.a2b_base64(data[i : i + chunk_size])
+        buf[pos : pos + len(decoded)] = decoded
+        pos += len(decoded)
+    return memoryview(buf)
+
+
 class BrowsingException(Exception):
     pass
 
@@ -50,21 +72,29 @@ class BrowserPool:
     """
     Manages pool of browsers. Automatically chooses available port for the
     debugging protocol.
+
+    If `warm` is true, released browsers are kept running instead of being
+    stopped, and handed out again by `acquire()` and `acquire_multi()`. Their
+    per-site state (cookies, cache, proxy) lives in a browser context which is
+    disposed on release, see `Browser.reset()`.
     """
 
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
-    def __init__(self, size=3, **kwargs):
+    def __init__(self, size=3, warm=False, **kwargs):
         """
         Initializes the pool.
 
         Args:
             size: size of pool (default 3)
+            warm: keep browsers running between uses (default False)
             **kwargs: arguments for Browser(...)
         """
         self.size = size
+        self.warm = warm
         self.kwargs = kwargs
         self._in_use = set()
+        self._idle = []
         self._lock = threading.Lock()
 
     def _fresh_browser(self):
@@ -74,9 +104,15 @@ class BrowserPool:
         port = sock.getsockname()[1]
         sock.close()
 
-        browser = Browser(port=port, **self.kwargs)
+        browser = Browser(port=port, warm=self.warm, **self.kwargs)
         return browser
 
+    def _next_browser(self):
+        # must be called with self._lock held
+        if self._idle:
+            return self._idle.pop()
+        return self._fresh_browser()
+
     def acquire_multi(self, n=1):
         """
         Returns a list of up to `n` browsers.
@@ -89,7 +125,7 @@ class BrowserPool:
             if len(self._in_use) >= self.size:
                 raise NoBrowsersAvailable
             while len(self._in_use) < self.size and len(browsers) < n:
-                browser = self._fresh_browser()
+                browser = self._next_browser()
                 browsers.append(browser)
                 self._in_use.add(browser)
         return browsers
@@ -107,29 +143,44 @@ class BrowserPool:
         with self._lock:
             if len(self._in_use) >= self.size:
                 raise NoBrowsersAvailable
-            browser = self._fresh_browser()
+            browser = self._next_browser()
             self._in_use.add(browser)
             return browser
 
+    def _retire(self, browser):
+        if self.warm:
+            browser.reset()
+        else:
+            browser.stop()  # make sure
+
     def release(self, browser):
-        browser.stop()  # make sure
+        self._retire(browser)
         with self._lock:
             self._in_use.remove(browser)
+            if self.warm and browser.chrome.is_running():
+                self._idle.append(browser)
 
     def release_all(self, browsers):
         for browser in browsers:
-            browser.stop()  # make sure
+            self._retire(browser)
         with self._lock:
             for browser in browsers:
                 self._in_use.remove(browser)
+                if self.warm and browser.chrome.is_running():
+                    self._idle.append(browser)
 
     def shutdown_now(self):
         self.logger.info(
-            "shutting down browser pool (%s browsers in use)", len(self._in_use)
+            "shutting down browser pool (%s browsers in use, %s idle)",
+            len(self._in_use),
+            len(self._idle),
         )
         with self._lock:
             for browser in self._in_use:
                 browser.stop()
+            for browser in self._idle:
+                browser.stop()
+            self._idle = []
 
     def num_available(self):
         return self.size - len(self._in_use)
@@ -142,20 +193,59 @@ class BrowserPool:
 # websocket.enableTrace(True)
 
 
-class WebsockReceiverThread(threading.Thread):
-    logger = logging.getLogger(__module__ + "." + __qualname__)
+def session_setup_messages(debug=False):
+    """
+    Returns the messages, without ids, that get a freshly connected tab ready
+    for browsing.
 
-    def __init__(self, websock, name=None, daemon=True):
-        super().__init__(name=name, daemon=daemon)
+    Args:
+        debug: also enable console and runtime events, which are only ever
+            logged at debug level (default False)
+    """
+    # tell browser to send us messages we're interested in
+    messages = [dict(method="Network.enable"), dict(method="Page.enable")]
+    if debug:
+        messages.append(dict(method="Console.enable"))
+        messages.append(dict(method="Runtime.enable"))
+    messages.append(dict(method="ServiceWorker.enable"))
+    messages.append(dict(method="ServiceWorker.setForceUpdateOnPageLoad"))
+
+    # disable google analytics and amp analytics
+    messages.append(
+        dict(
+            method="Network.setBlockedURLs",
+            params={
+                "urls": [
+                    "*google-analytics.com/analytics.js*",
+                    "*google-analytics.com/ga.js*",
+                    "*google-analytics.com/ga_exp.js*",
+                    "*google-analytics.com/urchin.js*",
+                    "*google-analytics.com/collect*",
+                    "*google-analytics.com/r/collect*",
+                    "*google-analytics.com/__utm.gif*",
+                    "*google-analytics.com/gtm/js?*",
+                    "*google-analytics.com/cx/api.js*",
+                    "*cdn.ampproject.org/*/amp-analytics*.js",
+                ]
+            },
+        )
+    )
+    return messages
 
-        self.websock = websock
 
-        self.calling_thread = threading.current_thread()
+class CdpSession:
+    """
+    State of a chrome devtools protocol session with a tab, and handlers for
+    the messages chrome sends over it.
 
-        self.websock.on_open = self._on_open
-        self.websock.on_message = self._on_message
-        self.websock.on_error = self._on_error
-        self.websock.on_close = self._on_close
+    Events are dispatched by method name through `self._event_handlers`.
+    Subclasses deliver messages to `dispatch()` and implement `send()`.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self):
+        self.calling_thread = threading.current_thread()
 
         self.is_open = False
         self.got_page_load_event = None
@@ -168,6 +258,60 @@ class WebsockReceiverThread(threading.Thread):
 
         self._result_messages = {}
 
+        # notified whenever something that `Browser._wait_for()` callbacks
+        # look at changes
+        self.changed = threading.Condition()
+
+        # for `Browser.wait_for_network_idle()`
+        self._inflight_requests = set()
+        self.last_network_activity = time.monotonic()
+
+        self._event_handlers = {
+            "Page.loadEventFired": self._page_load_event_fired,
+            "Network.responseReceived": self._network_response_received,
+            "Network.requestWillBeSent": self._network_request_will_be_sent,
+            "Network.loadingFinished": self._network_loading_finished,
+            "Network.loadingFailed": self._network_loading_failed,
+            "Page.interstitialShown": self._page_interstitial_shown,
+            "Inspector.targetCrashed": self._inspector_target_crashed,
+            "Console.messageAdded": self._console_message_added,
+            "Runtime.exceptionThrown": self._runtime_exception_thrown,
+            "Page.javascriptDialogOpening": self._javascript_dialog_opening,
+            "ServiceWorker.workerVersionUpdated": (
+                self._service_worker_version_updated
+            ),
+        }
+
+    def send(self, message):
+        """
+        Sends `message`, a dict, to chrome.
+        """
+        raise NotImplementedError
+
+    def _notify_changed(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def note_network_activity(self):
+        self.last_network_activity = time.monotonic()
+
+    def reset_network_activity(self):
+        """
+        Forgets in-flight requests, e.g. before navigating to a new page.
+        """
+        self._inflight_requests.clear()
+        self.note_network_activity()
+
+    def network_idle_for(self, seconds, max_inflight=0):
+        """
+        Returns `True` if at most `max_inflight` requests are in flight and no
+        request has started or finished for `seconds` seconds.
+        """
+        return (
+            len(self._inflight_requests) <= max_inflight
+            and time.monotonic() - self.last_network_activity >= seconds
+        )
+
     def expect_result(self, msg_id):
         self._result_messages[msg_id] = None
 
@@ -177,16 +321,10 @@ class WebsockReceiverThread(threading.Thread):
     def pop_result(self, msg_id):
         return self._result_messages.pop(msg_id)
 
-    def _on_close(self, websock, close_status_code, close_msg):
-        pass
-        # self.logger.info('GOODBYE GOODBYE WEBSOCKET')
-
-    def _on_open(self, websock):
-        self.is_open = True
-
-    def _on_error(self, websock, e):
+    def _raise_in_calling_thread(self, e):
         """
-        Raises BrowsingException in the thread that created this instance.
+        Raises BrowsingException in the thread that created this instance,
+        after a websocket error `e`.
         """
         if isinstance(
             e, (websocket.WebSocketConnectionClosedException, ConnectionResetError)
@@ -194,30 +332,34 @@ class WebsockReceiverThread(threading.Thread):
             self.logger.error("websocket closed, did chrome die?")
         else:
             self.logger.error("exception from websocket receiver thread", exc_info=1)
-        brozzler.thread_raise(self.calling_thread, BrowsingException)
+        self._abort(BrowsingException)
+        self._notify_changed()
 
-    def run(self):
-        # ping_timeout is used as the timeout for the call to select.select()
-        # in addition to its documented purpose, and must have a value to avoid
-        # hangs in certain situations
-        #
-        # skip_ut8_validation is a recommended performance improvement:
-        # https://websocket-client.readthedocs.io/en/latest/faq.html#why-is-this-library-slow
-        self.websock.run_forever(
-            sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
-            ping_timeout=0.5,
-            skip_utf8_validation=True,
-        )
+    def _abort(self, exception_class):
+        """
+        Interrupts whatever the calling thread is doing with the browser by
+        raising `exception_class` in it.
+        """
+        brozzler.thread_raise(self.calling_thread, exception_class)
 
-    def _on_message(self, websock, message):
-        try:
-            self._handle_message(websock, message)
-        except:
-            self.logger.error(
-                "uncaught exception in _handle_message message=%s",
-                message,
-                exc_info=True,
-            )
+    def _handle_message(self, websock, json_message):
+        self.dispatch(json.loads(json_message))
+
+    def dispatch(self, message):
+        if "method" in message:
+            handler = self._event_handlers.get(message["method"])
+            if handler:
+                handler(message)
+            # else:
+            #     self.logger.debug("%s %s", message["method"], message)
+        elif "result" in message:
+            if message["id"] in self._result_messages:
+                self._result_messages[message["id"]] = message
+                self._notify_changed()
+
+    def _page_load_event_fired(self, message):
+        self.got_page_load_event = datetime.datetime.utcnow()
+        self._notify_changed()
 
     def _network_response_received(self, message):
         status = message["params"]["response"].get("status")
@@ -232,7 +374,7 @@ class WebsockReceiverThread(threading.Thread):
                 )
                 self.reached_limit = brozzler.ReachedLimit(warcprox_meta=warcprox_meta)
                 self.logger.info("reached limit %s", self.reached_limit)
-                brozzler.thread_raise(self.calling_thread, brozzler.ReachedLimit)
+                self._abort(brozzler.ReachedLimit)
             else:
                 self.logger.info(
                     "reached limit but self.reached_limit is already set, "
@@ -244,77 +386,284 @@ class WebsockReceiverThread(threading.Thread):
         if status and self.page_status is None:
             self.page_status = status
 
+    def _network_request_will_be_sent(self, message):
+        self._inflight_requests.add(message["params"]["requestId"])
+        self.note_network_activity()
+        if self.on_request:
+            self.on_request(message)
+
+    def _network_loading_finished(self, message):
+        self._inflight_requests.discard(message["params"]["requestId"])
+        self.note_network_activity()
+
+    def _network_loading_failed(self, message):
+        self._inflight_requests.discard(message["params"]["requestId"])
+        self.note_network_activity()
+        if message["params"].get("errorText") == "net::ERR_PROXY_CONNECTION_FAILED":
+            self._abort(brozzler.ProxyError)
+
+    def _page_interstitial_shown(self, message):
+        # AITFIVE-1529: handle http auth
+        # we should kill the browser when we receive Page.interstitialShown and
+        # consider the page finished, until this is fixed:
+        # https://bugs.chromium.org/p/chromium/issues/detail?id=764505
+        self.logger.info("Page.interstialShown (likely unsupported http auth request)")
+        self._abort(brozzler.PageInterstitialShown)
+
+    def _inspector_target_crashed(self, message):
+        self.logger.error("""chrome tab went "aw snap" or "he's dead jim"!""")
+        self._abort(BrowsingException)
+
+    def _console_message_added(self, message):
+        self.logger.debug(
+            "console.%s %s",
+            message["params"]["message"]["level"],
+            message["params"]["message"]["text"],
+        )
+
+    def _runtime_exception_thrown(self, message):
+        self.logger.debug("uncaught exception: %s", message)
+
     def _javascript_dialog_opening(self, message):
         self.logger.info("javascript dialog opened: %s", message)
         if message["params"]["type"] == "alert":
             accept = True
         else:
             accept = False
-        self.websock.send(
-            json.dumps(
-                dict(
-                    id=0,
-                    method="Page.handleJavaScriptDialog",
-                    params={"accept": accept},
-                ),
-                separators=",:",
+        self.send(
+            dict(
+                id=0,
+                method="Page.handleJavaScriptDialog",
+                params={"accept": accept},
             )
         )
 
-    def _handle_message(self, websock, json_message):
-        message = json.loads(json_message)
-        if "method" in message:
-            if message["method"] == "Page.loadEventFired":
-                self.got_page_load_event = datetime.datetime.utcnow()
-            elif message["method"] == "Network.responseReceived":
-                self._network_response_received(message)
-            elif message["method"] == "Network.requestWillBeSent":
-                if self.on_request:
-                    self.on_request(message)
-            elif message["method"] == "Page.interstitialShown":
-                # AITFIVE-1529: handle http auth
-                # we should kill the browser when we receive Page.interstitialShown and
-                # consider the page finished, until this is fixed:
-                # https://bugs.chromium.org/p/chromium/issues/detail?id=764505
-                self.logger.info(
-                    "Page.interstialShown (likely unsupported http auth request)"
-                )
-                brozzler.thread_raise(
-                    self.calling_thread, brozzler.PageInterstitialShown
-                )
-            elif message["method"] == "Inspector.targetCrashed":
-                self.logger.error("""chrome tab went "aw snap" or "he's dead jim"!""")
-                brozzler.thread_raise(self.calling_thread, BrowsingException)
-            elif message["method"] == "Console.messageAdded":
-                self.logger.debug(
-                    "console.%s %s",
-                    message["params"]["message"]["level"],
-                    message["params"]["message"]["text"],
-                )
-            elif message["method"] == "Runtime.exceptionThrown":
-                self.logger.debug("uncaught exception: %s", message)
-            elif message["method"] == "Page.javascriptDialogOpening":
-                self._javascript_dialog_opening(message)
-            elif (
-                message["method"] == "Network.loadingFailed"
-                and "params" in message
-                and "errorText" in message["params"]
-                and message["params"]["errorText"] == "net::ERR_PROXY_CONNECTION_FAILED"
-            ):
-                brozzler.thread_raise(self.calling_thread, brozzler.ProxyError)
-            elif message["method"] == "ServiceWorker.workerVersionUpdated":
-                if self.on_service_worker_version_updated:
-                    self.on_service_worker_version_updated(message)
-            # else:
-            #     self.logger.debug("%s %s", message["method"], json_message)
-        elif "result" in message:
-            if message["id"] in self._result_messages:
-                self._result_messages[message["id"]] = message
+    def _service_worker_version_updated(self, message):
+        if self.on_service_worker_version_updated:
+            self.on_service_worker_version_updated(message)
+
+
+class WebsockReceiverThread(CdpSession, threading.Thread):
+    """
+    Session with a tab over a websocket connection of its own, with a thread
+    receiving its messages.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, websock, name=None, daemon=True):
+        threading.Thread.__init__(self, name=name, daemon=daemon)
+        CdpSession.__init__(self)
+
+        self.websock = websock
+
+        self.websock.on_open = self._on_open
+        self.websock.on_message = self._on_message
+        self.websock.on_error = self._on_error
+        self.websock.on_close = self._on_close
+
+    def send(self, message):
+        self.websock.send(json.dumps(message, separators=",:"))
+
+    def _on_close(self, websock, close_status_code, close_msg):
+        self._notify_changed()
+        # self.logger.info('GOODBYE GOODBYE WEBSOCKET')
+
+    def _on_open(self, websock):
+        self.is_open = True
+        self._notify_changed()
+
+    def _on_error(self, websock, e):
+        self._raise_in_calling_thread(e)
+
+    def run(self):
+        # ping_timeout is used as the timeout for the call to select.select()
+        # in addition to its documented purpose, and must have a value to avoid
+        # hangs in certain situations
+        #
+        # skip_ut8_validation is a recommended performance improvement:
+        # https://websocket-client.readthedocs.io/en/latest/faq.html#why-is-this-library-slow
+        self.websock.run_forever(
+            sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+            ping_timeout=0.5,
+            skip_utf8_validation=True,
+        )
+
+    def _on_message(self, websock, message):
+        try:
+            self._handle_message(websock, message)
+        except:
+            self.logger.error(
+                "uncaught exception in _handle_message message=%s",
+                message,
+                exc_info=True,
+            )
+
+
+class MultiplexedCdpSession(CdpSession):
+    """
+    Flattened session with a tab over a shared `CdpConnection`, see
+    `CdpConnection.attach()`.
+
+    Out-of-process iframes of the tab are auto-attached, and their network
+    events are handled as if they came from the tab itself, so that network
+    idleness and embedded videos take them into account.
+    """
+
+    def __init__(self, connection, session_id):
+        super().__init__()
+        self.connection = connection
+        self.session_id = session_id
+        self.is_open = True
+        self._event_handlers["Target.attachedToTarget"] = self._attached_to_target
+        self._event_handlers["Target.detachedFromTarget"] = self._detached_from_target
+
+    def send(self, message):
+        self.connection.send(message, session_id=self.session_id)
+
+    def _attached_to_target(self, message):
+        if message["params"]["targetInfo"]["type"] != "iframe":
+            return
+        child_session_id = message["params"]["sessionId"]
+        self.connection.route_events(child_session_id, self)
+        self.connection.send(
+            dict(id=0, method="Network.enable"), session_id=child_session_id
+        )
+
+    def _detached_from_target(self, message):
+        self.connection.route_events(message["params"]["sessionId"], None)
+
+
+class CdpConnection(threading.Thread):
+    """
+    Websocket connection to chrome's browser target, over which any number
+    of tabs can be driven as flattened sessions, all served by this one
+    receiver thread.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, websocket_url, name=None):
+        super().__init__(name=name, daemon=True)
+        self.websock = websocket.WebSocketApp(
+            websocket_url,
+            on_open=self._on_open,
+            on_message=self._on_message,
+            on_error=self._on_error,
+            on_close=self._on_close,
+        )
+        self.opened = threading.Event()
+        self._send_lock = threading.Lock()
+        # commands are sent from several tab threads at once, unlike
+        # `Counter`, next() on itertools.count() is atomic
+        self._command_id = itertools.count()
+        self._results = {}  # {msg_id: Future} of browser level commands
+        self._sessions = {}  # {session_id: MultiplexedCdpSession}
+        self._event_routes = {}  # {child session_id: MultiplexedCdpSession}
+
+    def run(self):
+        # see WebsockReceiverThread.run()
+        self.websock.run_forever(
+            sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+            ping_timeout=0.5,
+            skip_utf8_validation=True,
+        )
 
-    #      else:
-    #          self.logger.debug("%s", json_message)
-    #  else:
-    #      self.logger.debug("%s", json_message)
+    def open(self, timeout=30):
+        self.start()
+        if not self.opened.wait(timeout):
+            raise BrowsingTimeout(
+                "timed out after %ss connecting to browser target" % timeout
+            )
+
+    def close(self):
+        try:
+            self.websock.close()
+        except BaseException as e:
+            self.logger.error("exception closing websocket %s - %s", self.websock, e)
+        if self is not threading.current_thread():
+            self.join(timeout=30)
+
+    def send(self, message, session_id=None):
+        if session_id:
+            message = dict(message, sessionId=session_id)
+        with self._send_lock:
+            self.websock.send(json.dumps(message, separators=",:"))
+
+    def command(self, method, timeout=30, **params):
+        """
+        Sends browser level command `method` and returns its result.
+        """
+        msg_id = next(self._command_id)
+        future = concurrent.futures.Future()
+        self._results[msg_id] = future
+        try:
+            self.send(dict(id=msg_id, method=method, params=params))
+            message = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise BrowsingTimeout(
+                "timed out after %ss waiting for result of %s" % (timeout, method)
+            )
+        finally:
+            self._results.pop(msg_id, None)
+        if "error" in message:
+            raise BrowsingException("%s failed: %s" % (method, message["error"]))
+        return message.get("result", {})
+
+    def attach(self, target_id):
+        """
+        Attaches to target `target_id` and returns a `MultiplexedCdpSession`
+        driving it.
+        """
+        result = self.command("Target.attachToTarget", targetId=target_id, flatten=True)
+        session = MultiplexedCdpSession(self, result["sessionId"])
+        self._sessions[session.session_id] = session
+        return session
+
+    def detach(self, session):
+        self._sessions.pop(session.session_id, None)
+        for child_session_id, parent in list(self._event_routes.items()):
+            if parent is session:
+                self._event_routes.pop(child_session_id, None)
+
+    def route_events(self, child_session_id, session):
+        """
+        Dispatches events of child session `child_session_id` to `session`,
+        or stops doing so if `session` is `None`.
+        """
+        if session:
+            self._event_routes[child_session_id] = session
+        else:
+            self._event_routes.pop(child_session_id, None)
+
+    def _on_open(self, websock):
+        self.opened.set()
+
+    def _on_close(self, websock, close_status_code, close_msg):
+        for session in list(self._sessions.values()):
+            session.is_open = False
+            session._notify_changed()
+
+    def _on_error(self, websock, e):
+        for session in list(self._sessions.values()):
+            session._raise_in_calling_thread(e)
+
+    def _on_message(self, websock, json_message):
+        try:
+            message = json.loads(json_message)
+            session_id = message.get("sessionId")
+            if session_id in self._sessions:
+                self._sessions[session_id].dispatch(message)
+            elif session_id in self._event_routes:
+                # results of commands sent to child sessions are of no interest
+                if "method" in message:
+                    self._event_routes[session_id].dispatch(message)
+            elif not session_id and message.get("id") in self._results:
+                self._results[message["id"]].set_result(message)
+        except:
+            self.logger.error(
+                "uncaught exception handling message=%s", json_message, exc_info=True
+            )
 
 
 class Browser:
@@ -324,20 +673,30 @@ class Browser:
 
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
-    def __init__(self, **kwargs):
+    def __init__(self, warm=False, chrome=None, **kwargs):
         """
         Initializes the Browser.
 
         Args:
+            warm: browse in a disposable browser context of a long-running
+                chrome, so that `reset()` can hand the browser to another
+                site without restarting chrome (default False)
+            chrome: `Chrome` instance to use instead of a new one made with
+                **kwargs (default None)
             **kwargs: arguments for Chrome(...)
         """
-        self.chrome = Chrome(**kwargs)
+        self.chrome = chrome or Chrome(**kwargs)
+        self.warm = warm
+        self._browser_context_id = None
         self.websock_url = None
         self.websock = None
         self.websock_thread = None
         self.is_browsing = False
         self._command_id = Counter()
         self._wait_interval = 0.5
+        # shared by the tabs opened with `open_tab()`, see `_tab_connection()`
+        self._cdp_connection = None
+        self._cdp_connection_lock = threading.Lock()
 
     def __enter__(self):
         self.start()
@@ -346,122 +705,292 @@ class Browser:
     def __exit__(self, *args):
         self.stop()
 
-    def _wait_for(self, callback, timeout=None):
+    def _wait_for(self, callback, timeout=None, interval=None):
         """
-        Spins until callback() returns truthy.
+        Waits until callback() returns truthy.
+
+        Wakes up as soon as the websocket receiver thread notifies a change,
+        and otherwise every `interval` (default `self._wait_interval`)
+        seconds, because exceptions from `brozzler.thread_raise()` can't
+        interrupt a blocking wait.
         """
+        interval = interval or self._wait_interval
         start = time.time()
         while True:
-            if callback():
-                return
-            elapsed = time.time() - start
-            if timeout and elapsed > timeout:
-                raise BrowsingTimeout(
-                    "timed out after %.1fs waiting for: %s" % (elapsed, callback)
-                )
-            brozzler.sleep(self._wait_interval)
+            websock_thread = self.websock_thread
+            if not websock_thread:
+                if callback():
+                    return
+                self._check_wait_timeout(callback, start, timeout)
+                brozzler.sleep(interval)
+                continue
+            # checking callback() with the lock held means a notification
+            # can't slip in between the check and the wait
+            with websock_thread.changed:
+                if callback():
+                    return
+                self._check_wait_timeout(callback, start, timeout)
+                websock_thread.changed.wait(interval)
+
+    def _check_wait_timeout(self, callback, start, timeout):
+        elapsed = time.time() - start
+        if timeout and elapsed > timeout:
+            raise BrowsingTimeout(
+                "timed out after %.1fs waiting for: %s" % (elapsed, callback)
+            )
+
+    def wait_for_network_idle(self, idle_ms=500, timeout=30, max_inflight=0):
+        """
+        Waits until at most `max_inflight` requests are in flight and no
+        request has started or finished for `idle_ms` milliseconds.
+
+        Returns:
+            `True` if the network went idle, `False` if `timeout` seconds
+            passed first
+        """
+        idle = idle_ms / 1000
+        try:
+            self._wait_for(
+                lambda: self.websock_thread.network_idle_for(idle, max_inflight),
+                timeout=timeout,
+                interval=min(idle, self._wait_interval) or None,
+            )
+            return True
+        except BrowsingTimeout:
+            return False
 
     def send_to_chrome(self, suppress_logging=False, **kwargs):
         msg_id = next(self._command_id)
         kwargs["id"] = msg_id
-        msg = json.dumps(kwargs, separators=",:")
         logging.log(
             logging.TRACE if suppress_logging else logging.DEBUG,
             "sending message to %s: %s",
-            self.websock,
-            msg,
+            self.websock_url,
+            kwargs,
         )
-        self.websock.send(msg)
+        self.websock_thread.send(kwargs)
         return msg_id
 
-    def start(self, **kwargs):
+    def _browser_command(self, method, timeout=30, **params):
+        """
+        Sends a command to the browser-level debugging target over a
+        short-lived websocket connection and returns the result.
+        """
+        websock = websocket.create_connection(
+            self.chrome.browser_websocket_url(), timeout=timeout
+        )
+        try:
+            websock.send(
+                json.dumps(dict(id=0, method=method, params=params), separators=",:")
+            )
+            while True:
+                message = json.loads(websock.recv())
+                if message.get("id") == 0:
+                    if "error" in message:
+                        raise BrowsingException(
+                            "%s failed: %s" % (method, message["error"])
+                        )
+                    return message.get("result", {})
+        finally:
+            websock.close()
+
+    def _new_browser_context(self, proxy=None, cookies=None):
+        """
+        Creates a fresh browser context, with its own cookies, cache and
+        proxy, opens about:blank in it and returns the tab's websocket url.
+        """
+        params = {}
+        if proxy:
+            params["proxyServer"] = proxy
+        result = self._browser_command("Target.createBrowserContext", **params)
+        self._browser_context_id = result["browserContextId"]
+        if cookies:
+            self._browser_command(
+                "Storage.setCookies",
+                cookies=cookies,
+                browserContextId=self._browser_context_id,
+            )
+        result = self._browser_command(
+            "Target.createTarget",
+            url="about:blank",
+            browserContextId=self._browser_context_id,
+        )
+        return self._target_websocket_url(result["targetId"])
+
+    def _target_websocket_url(self, target_id):
+        return "ws://localhost:%s/devtools/page/%s" % (self.chrome.port, target_id)
+
+    def _dispose_browser_context(self):
+        if self._browser_context_id:
+            try:
+                self._browser_command(
+                    "Target.disposeBrowserContext",
+                    browserContextId=self._browser_context_id,
+                )
+            finally:
+                self._browser_context_id = None
+
+    def read_cookies(self):
+        """
+        Returns the cookies of the current browser context of a warm browser,
+        in the form accepted by `start(cookies=...)`.
+        """
+        result = self._browser_command(
+            "Storage.getCookies", browserContextId=self._browser_context_id
+        )
+        cookies = []
+        for cookie in result.get("cookies", []):
+            cookie = {k: v for k, v in cookie.items() if k in _COOKIE_PARAM_FIELDS}
+            if cookie.get("expires", -1) < 0:
+                cookie.pop("expires", None)  # session cookie
+            cookies.append(cookie)
+        return cookies
+
+    def start(self, proxy=None, cookies=None, **kwargs):
         """
         Starts chrome if it's not running.
 
+        A warm browser starts chrome only the first time, without a proxy,
+        and on every start opens a fresh browser context configured with
+        `proxy` and `cookies`.
+
         Args:
+            proxy: http proxy 'host:port' (default None)
+            cookies: list of cookies to set in the fresh browser context of
+                a warm browser, as returned by `read_cookies()` (default None)
             **kwargs: arguments for self.chrome.start(...)
         """
         if not self.is_running():
-            self.websock_url = self.chrome.start(**kwargs)
-            self.websock = websocket.WebSocketApp(self.websock_url)
-            self.websock_thread = WebsockReceiverThread(
-                self.websock, name="WebsockThread:%s" % self.chrome.port
-            )
-            self.websock_thread.start()
-
-            self._wait_for(lambda: self.websock_thread.is_open, timeout=30)
-
-            # tell browser to send us messages we're interested in
-            self.send_to_chrome(method="Network.enable")
-            self.send_to_chrome(method="Page.enable")
-            # Enable Console & Runtime output only when debugging.
-            # After all, we just print these events with debug(), we don't use
-            # them in Brozzler logic.
-            if self.logger.isEnabledFor(logging.DEBUG):
-                self.send_to_chrome(method="Console.enable")
-                self.send_to_chrome(method="Runtime.enable")
-            self.send_to_chrome(method="ServiceWorker.enable")
-            self.send_to_chrome(method="ServiceWorker.setForceUpdateOnPageLoad")
-
-            # disable google analytics and amp analytics
-            self.send_to_chrome(
-                method="Network.setBlockedURLs",
-                params={
-                    "urls": [
-                        "*google-analytics.com/analytics.js*",
-                        "*google-analytics.com/ga.js*",
-                        "*google-analytics.com/ga_exp.js*",
-                        "*google-analytics.com/urchin.js*",
-                        "*google-analytics.com/collect*",
-                        "*google-analytics.com/r/collect*",
-                        "*google-analytics.com/__utm.gif*",
-                        "*google-analytics.com/gtm/js?*",
-                        "*google-analytics.com/cx/api.js*",
-                        "*cdn.ampproject.org/*/amp-analytics*.js",
-                    ]
-                },
-            )
+            if self.warm:
+                if not self.chrome.is_running():
+                    kwargs.pop("cookie_db", None)
+                    self.chrome.start(**kwargs)
+                self.websock_url = self._new_browser_context(proxy, cookies)
+            else:
+                self.websock_url = self.chrome.start(proxy=proxy, **kwargs)
+            self._connect()
 
-    def stop(self):
+    def open_tab(self):
         """
-        Stops chrome if it's running.
+        Opens another tab in this browser's chrome, in the same browser
+        context, so with the same proxy and cookies, for browsing another page
+        at the same time.
+
+        The browser must be running. The returned `BrowserTab` connects to the
+        tab when started, which should happen in the thread that browses with
+        it, since exceptions from the tab are raised in that thread.
         """
-        try:
-            if self.websock and self.websock.sock and self.websock.sock.connected:
-                self.logger.info("shutting down websocket connection")
-                try:
-                    self.websock.close()
-                except BaseException as e:
-                    self.logger.error(
-                        "exception closing websocket %s - %s", self.websock, e
-                    )
+        if not self.is_running():
+            raise BrowsingException("browser has not been started")
+        params = {"url": "about:blank"}
+        if self._browser_context_id:
+            params["browserContextId"] = self._browser_context_id
+        result = self._tab_connection().command("Target.createTarget", **params)
+        return BrowserTab(self, result["targetId"])
 
-            self.chrome.stop()
+    def _tab_connection(self):
+        """
+        Returns the `CdpConnection` over which the tabs opened by `open_tab()`
+        are driven, connecting first if need be.
+        """
+        with self._cdp_connection_lock:
+            if not self._cdp_connection or not self._cdp_connection.is_alive():
+                connection = CdpConnection(
+                    self.chrome.browser_websocket_url(),
+                    name="CdpConnection:%s" % self.chrome.port,
+                )
+                connection.open()
+                self._cdp_connection = connection
+            return self._cdp_connection
+
+    def _close_tab_connection(self):
+        with self._cdp_connection_lock:
+            if self._cdp_connection:
+                self._cdp_connection.close()
+                self._cdp_connection = None
+
+    def _connect(self):
+        """
+        Connects to the tab at `self.websock_url` and sets it up for browsing.
+        """
+        self.websock = websocket.WebSocketApp(self.websock_url)
+        self.websock_thread = WebsockReceiverThread(
+            self.websock, name="WebsockThread:%s" % self.chrome.port
+        )
+        self.websock_thread.start()
+
+        self._wait_for(lambda: self.websock_thread.is_open, timeout=30)
+        self._set_up_session()
 
-            if self.websock_thread and (
-                self.websock_thread != threading.current_thread()
-            ):
+    def _set_up_session(self):
+        for message in session_setup_messages(self.logger.isEnabledFor(logging.DEBUG)):
+            self.send_to_chrome(**message)
+
+    def _stop_websock(self):
+        if self.websock and self.websock.sock and self.websock.sock.connected:
+            self.logger.info("shutting down websocket connection")
+            try:
+                self.websock.close()
+            except BaseException as e:
+                self.logger.error(
+                    "exception closing websocket %s - %s", self.websock, e
+                )
+
+    def _join_websock_thread(self):
+        if self.websock_thread and (self.websock_thread != threading.current_thread()):
+            self.websock_thread.join(timeout=30)
+            if self.websock_thread.is_alive():
+                self.logger.error(
+                    "%s still alive 30 seconds after closing %s, will "
+                    "forcefully nudge it again",
+                    self.websock_thread,
+                    self.websock,
+                )
+                self.websock.keep_running = False
                 self.websock_thread.join(timeout=30)
                 if self.websock_thread.is_alive():
-                    self.logger.error(
-                        "%s still alive 30 seconds after closing %s, will "
-                        "forcefully nudge it again",
+                    self.logger.critical(
+                        "%s still alive 60 seconds after closing %s",
                         self.websock_thread,
                         self.websock,
                     )
-                    self.websock.keep_running = False
-                    self.websock_thread.join(timeout=30)
-                    if self.websock_thread.is_alive():
-                        self.logger.critical(
-                            "%s still alive 60 seconds after closing %s",
-                            self.websock_thread,
-                            self.websock,
-                        )
 
+    def stop(self):
+        """
+        Stops chrome if it's running.
+        """
+        try:
+            self._stop_websock()
+            self._close_tab_connection()
+            self.chrome.stop()
+            self._join_websock_thread()
+            self._browser_context_id = None
             self.websock_url = None
         except:
             self.logger.error("problem stopping", exc_info=True)
 
+    def reset(self):
+        """
+        Gets a warm browser ready for another site, leaving chrome running.
+
+        Disposing of the browser context throws away its cookies, cache and
+        tab (and thereby whatever page was loaded), and the proxy setting goes
+        with it. The next `start()` opens a fresh context. If anything goes
+        wrong the browser is stopped altogether.
+        """
+        if not self.warm:
+            self.stop()
+            return
+        try:
+            self._stop_websock()
+            self._join_websock_thread()
+            self._close_tab_connection()
+            self.websock_url = None
+            self._dispose_browser_context()
+        except:
+            self.logger.error("problem resetting, stopping browser", exc_info=True)
+            self.stop()
+
     def is_running(self):
         return self.websock_url is not None
 
@@ -584,7 +1113,16 @@ class Browser:
                     behavior_script = brozzler.behavior_script(
                         page_url, behavior_parameters, behaviors_dir=behaviors_dir
                     )
-                    self.run_behavior(behavior_script, timeout=behavior_timeout)
+                    behavior = brozzler.matching_behavior(
+                        page_url, behaviors_dir=behaviors_dir
+                    )
+                    self.run_behavior(
+                        behavior_script,
+                        timeout=behavior_timeout,
+                        request_idle_timeout=(
+                            behavior and behavior.get("request_idle_timeout_sec")
+                        ),
+                    )
                 final_page_url = self.url()
                 if on_screenshot:
                     if simpler404:
@@ -648,8 +1186,11 @@ class Browser:
             url = urlcanon.whatwg(page_url)
             url.hash_sign = b"#"
             url.fragment = hashtag[1:].encode("utf-8")
+            self.websock_thread.note_network_activity()
             self.send_to_chrome(method="Page.navigate", params={"url": str(url)})
-            time.sleep(5)  # um.. wait for idleness or something?
+            # give the page up to 5 seconds to fetch whatever the hashtag
+            # leads it to fetch
+            self.wait_for_network_idle(idle_ms=1000, timeout=5)
             # take another screenshot?
             # run behavior again with short timeout?
             # retrieve outlinks again and append to list?
@@ -687,6 +1228,7 @@ class Browser:
         self.logger.info("navigating to page %s", page_url)
         self.websock_thread.got_page_load_event = None
         self.websock_thread.page_status = None
+        self.websock_thread.reset_network_activity()
         self.send_to_chrome(method="Page.navigate", params={"url": page_url})
         self._wait_for(lambda: self.websock_thread.got_page_load_event, timeout=timeout)
 
@@ -727,6 +1269,9 @@ class Browser:
         """Optionally capture full page screenshot using puppeteer as an
         inspiration:
         https://github.com/GoogleChrome/puppeteer/blob/master/lib/Page.js#L898
+
+        Returns:
+            memoryview of the jpeg bytes
         """
         self.logger.info("taking screenshot")
         if full_page:
@@ -751,9 +1296,14 @@ class Browser:
                     screenOrientation=screenOrientation,
                 ),
             )
-            capture_params = {"format": "jpeg", "quality": 95, "clip": clip}
+            capture_params = {
+                "format": "jpeg",
+                "quality": 95,
+                "clip": clip,
+                "optimizeForSpeed": True,
+            }
         else:
-            capture_params = {"format": "jpeg", "quality": 95}
+            capture_params = {"format": "jpeg", "quality": 95, "optimizeForSpeed": True}
         self.websock_thread.expect_result(self._command_id.peek())
         msg_id = self.send_to_chrome(
             method="Page.captureScreenshot", params=capture_params
@@ -761,9 +1311,9 @@ class Browser:
         self._wait_for(
             lambda: self.websock_thread.received_result(msg_id), timeout=timeout
         )
-        message = self.websock_thread.pop_result(msg_id)
-        jpeg_bytes = base64.b64decode(message["result"]["data"])
-        return jpeg_bytes
+        # don't keep the base64 around any longer than necessary
+        data = self.websock_thread.pop_result(msg_id)["result"].pop("data")
+        return b64decode_to_buffer(data)
 
     def url(self, timeout=30):
         """
@@ -779,7 +1329,13 @@ class Browser:
         message = self.websock_thread.pop_result(msg_id)
         return message["result"]["result"]["value"]
 
-    def run_behavior(self, behavior_script, timeout=900):
+    def run_behavior(self, behavior_script, timeout=900, request_idle_timeout=None):
+        """
+        Runs `behavior_script` until it says it has finished, or until
+        `timeout` seconds have passed, or, if `request_idle_timeout` is set,
+        until no requests have started or finished for that many seconds.
+        """
+        self.websock_thread.note_network_activity()
         self.send_to_chrome(
             method="Runtime.evaluate",
             suppress_logging=True,
@@ -794,7 +1350,17 @@ class Browser:
                 logging.info("behavior reached hard timeout after %.1fs", elapsed)
                 return
 
-            brozzler.sleep(check_interval)
+            if request_idle_timeout:
+                if self.wait_for_network_idle(
+                    idle_ms=request_idle_timeout * 1000, timeout=check_interval
+                ):
+                    self.logger.info(
+                        "behavior finished, no network activity for %ss",
+                        request_idle_timeout,
+                    )
+                    return
+            else:
+                brozzler.sleep(check_interval)
 
             self.websock_thread.expect_result(self._command_id.peek())
             msg_id = self.send_to_chrome(
@@ -879,6 +1445,84 @@ class Browser:
         self._wait_for(lambda: self.websock_thread.got_page_load_event, timeout=timeout)
 
 
+# fields of devtools protocol Network.Cookie that are also accepted as
+# Network.CookieParam by Storage.setCookies
+_COOKIE_PARAM_FIELDS = {
+    "name",
+    "value",
+    "domain",
+    "path",
+    "expires",
+    "secure",
+    "httpOnly",
+    "sameSite",
+    "priority",
+    "sourceScheme",
+    "sourcePort",
+}
+
+
+class BrowserTab(Browser):
+    """
+    An extra tab of a running `Browser`, see `Browser.open_tab()`.
+
+    Starting and stopping a tab connects to and closes just the tab, chrome
+    itself belongs to the browser that opened it. Rather than a websocket
+    connection and receiver thread of their own, tabs share their browser's
+    `CdpConnection`, each as a flattened session.
+    """
+
+    def __init__(self, browser, target_id):
+        super().__init__(warm=browser.warm, chrome=browser.chrome)
+        self._browser = browser
+        self._target_id = target_id
+        self._browser_context_id = browser._browser_context_id
+
+    def start(self, **kwargs):
+        """
+        Connects to the tab. Arguments are accepted for compatibility with
+        `Browser.start()` and ignored, the tab has its browser's settings.
+        """
+        if not self.is_running():
+            connection = self._browser._tab_connection()
+            self.websock_thread = connection.attach(self._target_id)
+            self.websock_url = self._target_websocket_url(self._target_id)
+            self._set_up_session()
+            # attach to out-of-process iframes too, so that their network
+            # activity counts, see `MultiplexedCdpSession`
+            self.send_to_chrome(
+                method="Target.setAutoAttach",
+                params={
+                    "autoAttach": True,
+                    "waitForDebuggerOnStart": False,
+                    "flatten": True,
+                },
+            )
+
+    def _join_websock_thread(self):
+        # the receiver thread belongs to the browser's connection
+        pass
+
+    def stop(self):
+        """
+        Closes the tab.
+        """
+        try:
+            if self.websock_thread:
+                self.websock_thread.connection.detach(self.websock_thread)
+            if self.chrome.is_running():
+                self._browser._tab_connection().command(
+                    "Target.closeTarget", targetId=self._target_id
+                )
+        except:
+            self.logger.error("problem closing tab", exc_info=True)
+        finally:
+            self.websock_url = None
+
+    def reset(self):
+        self.stop()
+
+
 class Counter:
     def __init__(self):
         self.next_value = 0
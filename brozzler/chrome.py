@@ -84,6 +84,7 @@ class Chrome:
         self.ignore_cert_errors = ignore_cert_errors
         self._shutdown = threading.Event()
         self.chrome_process = None
+        self._browser_websocket_url = None
 
     def __enter__(self):
         """
@@ -177,6 +178,7 @@ class Chrome:
         if cookie_db:
             self._init_cookie_db(cookie_db)
         self._shutdown.clear()
+        self._browser_websocket_url = None
 
         new_env = os.environ.copy()
         new_env["HOME"] = self._home_tmpdir.name
@@ -300,6 +302,21 @@ class Chrome:
                     self.stop()
                     raise e
 
+    def browser_websocket_url(self, timeout_sec=30):
+        """
+        Returns the websocket url of the browser-level debugging target, which
+        accepts commands like `Target.createBrowserContext`.
+        """
+        if not self._browser_websocket_url:
+            json_url = "http://localhost:%s/json/version" % self.port
+            raw_json = urllib.request.urlopen(json_url, timeout=timeout_sec).read()
+            version_info = json.loads(raw_json.decode("utf-8"))
+            self._browser_websocket_url = version_info["webSocketDebuggerUrl"]
+        return self._browser_websocket_url
+
+    def is_running(self):
+        return bool(self.chrome_process and self.chrome_process.poll() is None)
+
     def _read_stderr_stdout(self):
         # XXX select doesn't work on windows
         def readline_nonblock(f):
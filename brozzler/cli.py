@@ -491,6 +491,157 @@ def brozzler_worker(argv=None):
         default="1",
         help="max number of chrome instances simultaneously browsing pages",
     )
+    arg_parser.add_argument(
+        "--warm-browsers",
+        dest="warm_browsers",
+        action="store_true",
+        help=(
+            "keep chrome instances running between site sessions, resetting "
+            "cookies, cache and proxy with a fresh browser context per site, "
+            "instead of starting a new chrome for every site"
+        ),
+    )
+    arg_parser.add_argument(
+        "--page-claim-batch-size",
+        dest="page_claim_batch_size",
+        type=int,
+        default=1,
+        help=(
+            "number of pages of a site to claim from rethinkdb at a time; "
+            "pages claimed but not brozzled are disclaimed when the worker "
+            "disclaims the site"
+        ),
+    )
+    arg_parser.add_argument(
+        "--seen-pages-cache",
+        dest="seen_pages_cache",
+        action="store_true",
+        help=(
+            "keep the ids of the pages of each claimed site in memory, to "
+            "skip fetching outlinks that are certainly already queued or "
+            "certainly new from rethinkdb"
+        ),
+    )
+    arg_parser.add_argument(
+        "--write-behind",
+        dest="write_behind",
+        action="store_true",
+        help=(
+            "buffer page writes to rethinkdb and flush them in bulk in the "
+            "background, so that brozzling the next page doesn't wait on them"
+        ),
+    )
+    arg_parser.add_argument(
+        "--watch-sites",
+        dest="watch_sites",
+        action="store_true",
+        help=(
+            "keep stop requests and time limits of claimed sites and their "
+            "jobs in memory, kept up to date by rethinkdb changefeeds, "
+            "instead of reloading them from rethinkdb before each page"
+        ),
+    )
+    arg_parser.add_argument(
+        "--tabs-per-site",
+        dest="tabs_per_site",
+        type=int,
+        default=1,
+        help=(
+            "brozzle up to this many pages of a site at the same time, in "
+            "tabs of the same browser"
+        ),
+    )
+    arg_parser.add_argument(
+        "--async",
+        dest="async_worker",
+        action="store_true",
+        help=(
+            "brozzle sites in asyncio tasks of a single event loop instead of "
+            "a thread per site (requires brozzler[async]; not compatible with "
+            "--warm-browsers or --tabs-per-site)"
+        ),
+    )
+    arg_parser.add_argument(
+        "--outlink-processes",
+        dest="outlink_processes",
+        type=int,
+        default=0,
+        help=(
+            "canonicalize the outlinks of pages with thousands of links in a "
+            "pool of this many processes, instead of in the browsing thread"
+        ),
+    )
+    arg_parser.add_argument(
+        "--robots-cache-size",
+        dest="robots_cache_size",
+        type=int,
+        default=10000,
+        help=(
+            "keep robots.txt rules of up to this many hosts in memory, a host "
+            "counting once per user agent, and through warcprox once per "
+            "warc-prefix and stats buckets"
+        ),
+    )
+    robots_store = arg_parser.add_mutually_exclusive_group()
+    robots_store.add_argument(
+        "--robots-cache-dir",
+        dest="robots_cache_dir",
+        default=None,
+        help=(
+            "also keep fetched robots.txt in files in this directory, so "
+            "that they survive restarts"
+        ),
+    )
+    robots_store.add_argument(
+        "--shared-robots-cache",
+        dest="shared_robots_cache",
+        action="store_true",
+        help=(
+            "also keep fetched robots.txt in the rethinkdb table 'robots', "
+            "shared by all brozzler workers"
+        ),
+    )
+    arg_parser.add_argument(
+        "--separate-outlinks",
+        dest="separate_outlinks",
+        action="store_true",
+        help=(
+            "save the outlinks of brozzled pages in the rethinkdb table "
+            "'page_outlinks' rather than in the pages themselves, so that "
+            "page documents stay small"
+        ),
+    )
+    arg_parser.add_argument(
+        "--prefetch-robots",
+        dest="prefetch_robots",
+        action="store_true",
+        help=(
+            "fetch robots.txt of seeds and of newly discovered hosts in the "
+            "background, instead of making outlink scheduling wait on them; "
+            "outlinks to hosts whose robots.txt hasn't arrived yet are "
+            "checked just before they are brozzled"
+        ),
+    )
+    arg_parser.add_argument(
+        "--min-host-delay",
+        dest="min_host_delay",
+        type=float,
+        default=0,
+        help=(
+            "leave at least this many seconds between page fetches from the "
+            "same host, by all sites and brozzler workers"
+        ),
+    )
+    arg_parser.add_argument(
+        "--honor-crawl-delay",
+        dest="honor_crawl_delay",
+        action="store_true",
+        help=(
+            "leave as many seconds between page fetches from the same host, "
+            "by all sites and brozzler workers, as its robots.txt Crawl-delay "
+            "says (up to 30), unless the site ignores robots.txt"
+        ),
+    )
     arg_parser.add_argument("--proxy", dest="proxy", default=None, help="http proxy")
     arg_parser.add_argument(
         "--browser_throughput",
@@ -574,6 +725,10 @@ def brozzler_worker(argv=None):
     add_common_options(arg_parser, argv)
 
     args = arg_parser.parse_args(args=argv[1:])
+    if args.async_worker and (args.warm_browsers or args.tabs_per_site > 1):
+        arg_parser.error(
+            "--async is not compatible with --warm-browsers or --tabs-per-site"
+        )
     configure_logging(args)
     brozzler.chrome.check_version(args.chrome_exe)
 
@@ -612,14 +767,32 @@ def brozzler_worker(argv=None):
         return skip_av_seeds
 
     rr = rethinker(args)
-    frontier = brozzler.RethinkDbFrontier(rr)
+    frontier = brozzler.RethinkDbFrontier(
+        rr,
+        write_behind=args.write_behind,
+        outlink_processes=args.outlink_processes,
+        watch_sites=args.watch_sites,
+        prefetch_robots=args.prefetch_robots,
+        separate_outlinks=args.separate_outlinks,
+    )
     service_registry = doublethink.ServiceRegistry(rr)
+    if args.shared_robots_cache:
+        robots_store = brozzler.robots.RethinkDbRobotsStore(rr)
+    elif args.robots_cache_dir:
+        robots_store = brozzler.robots.DirectoryRobotsStore(args.robots_cache_dir)
+    else:
+        robots_store = None
+    brozzler.robots.configure_robots_cache(
+        max_entries=args.robots_cache_size, store=robots_store
+    )
     skip_av_seeds_from_file = get_skip_av_seeds()
-    worker = brozzler.worker.BrozzlerWorker(
-        frontier,
-        service_registry,
+    worker_kwargs = dict(
         skip_av_seeds=skip_av_seeds_from_file,
         max_browsers=int(args.max_browsers),
+        page_claim_batch_size=args.page_claim_batch_size,
+        seen_pages_cache=args.seen_pages_cache,
+        min_host_delay=args.min_host_delay,
+        honor_crawl_delay=args.honor_crawl_delay,
         chrome_exe=args.chrome_exe,
         proxy=args.proxy,
         warcprox_auto=args.warcprox_auto,
@@ -632,6 +805,20 @@ def brozzler_worker(argv=None):
         registry_url=args.registry_url,
         env=args.env,
     )
+    if args.async_worker:
+        import brozzler.aioworker
+
+        worker = brozzler.aioworker.AsyncBrozzlerWorker(
+            frontier, service_registry, **worker_kwargs
+        )
+    else:
+        worker = brozzler.worker.BrozzlerWorker(
+            frontier,
+            service_registry,
+            warm_browsers=args.warm_browsers,
+            tabs_per_site=args.tabs_per_site,
+            **worker_kwargs,
+        )
 
     signal.signal(signal.SIGQUIT, dump_state)
     signal.signal(signal.SIGTERM, lambda s, f: worker.stop())
@@ -866,6 +1053,7 @@ def brozzler_list_pages(argv=None):
         except ValueError:
             site_ids = [args.site]
 
+    separate_outlinks = "page_outlinks" in rr.table_list().run()
     for site_id in site_ids:
         reql = rr.table("pages")
         if args.queued:
@@ -887,6 +1075,15 @@ def brozzler_list_pages(argv=None):
         reql = reql.order_by(index="least_hops")
         if args.claimed:
             reql = reql.filter({"claimed": True})
+        if separate_outlinks:
+            # see brozzler.PageOutlinks
+            reql = reql.merge(
+                lambda page: r.db(rr.dbname)
+                .table("page_outlinks")
+                .get(page["id"])
+                .pluck("outlinks")
+                .default({})
+            )
         logging.debug("querying rethinkb: %s", reql)
         results = reql.run()
         if args.yaml:
@@ -1028,6 +1225,12 @@ def _purge_site(rr, site_id):
     result = reql.run()
     logging.info("purged pages for site %s: %s", site_id, result)
 
+    if "page_outlinks" in rr.table_list().run():
+        reql = rr.table("page_outlinks").get_all(site_id, index="site_id").delete()
+        logging.debug("purging page outlinks for site %s: %s", site_id, reql)
+        result = reql.run()
+        logging.info("purged page outlinks for site %s: %s", site_id, result)
+
     reql = rr.table("sites").get(site_id).delete()
     logging.debug("purging site %s: %s", site_id, reql)
     result = reql.run()
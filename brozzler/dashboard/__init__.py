@@ -135,21 +135,34 @@ def pages(site_id):
     return flask.jsonify(pages=list(pages_))
 
 
-@app.route("/api/pages/<page_id>")
-@app.route("/api/page/<page_id>")
-def page(page_id):
+def get_page(page_id):
     reql = rr.table("pages").get(page_id)
     logging.debug("querying rethinkdb: %s", reql)
     page_ = reql.run()
+    if page_ and not "outlinks" in page_:
+        # brozzler-worker --separate-outlinks keeps outlinks apart from pages
+        try:
+            reql = rr.table("page_outlinks").get(page_id)
+            logging.debug("querying rethinkdb: %s", reql)
+            outlinks = reql.run()
+        except r.errors.ReqlOpFailedError:
+            outlinks = None  # no such table
+        if outlinks:
+            page_["outlinks"] = outlinks["outlinks"]
+    return page_
+
+
+@app.route("/api/pages/<page_id>")
+@app.route("/api/page/<page_id>")
+def page(page_id):
+    page_ = get_page(page_id)
     return flask.jsonify(page_)
 
 
 @app.route("/api/pages/<page_id>/yaml")
 @app.route("/api/page/<page_id>/yaml")
 def page_yaml(page_id):
-    reql = rr.table("pages").get(page_id)
-    logging.debug("querying rethinkdb: %s", reql)
-    page_ = reql.run()
+    page_ = get_page(page_id)
     return app.response_class(
         yaml.dump(page_, default_flow_style=False), mimetype="application/yaml"
     )
@@ -18,12 +18,17 @@ limitations under the License.
 
 import logging
 import brozzler
+import collections
 import random
+import threading
 import time
 import datetime
+import concurrent.futures
+import multiprocessing
 import rethinkdb as rdb
 import doublethink
 import urlcanon
+from brozzler.seen import SeenPages
 
 r = rdb.RethinkDB()
 
@@ -32,14 +37,169 @@ class UnexpectedDbResult(Exception):
     pass
 
 
+def canonicalize_outlink(url):
+    """
+    Canonicalizes outlink `url` for scoping and for crawling in one pass.
+
+    Returns:
+        tuple (semantically canonicalized `urlcanon.ParsedUrl` for scoping,
+            whatwg canonicalized url string without fragment for crawling,
+            fragment including hash sign, or empty string)
+    """
+    url_for_scoping = urlcanon.semantic(url)
+    url_for_crawling = urlcanon.whatwg(url)
+    hashtag = (url_for_crawling.hash_sign + url_for_crawling.fragment).decode("utf-8")
+    urlcanon.canon.remove_fragment(url_for_crawling)
+    return url_for_scoping, str(url_for_crawling), hashtag
+
+
+def _canonicalize_outlinks(urls):
+    # runs in the outlink process pool, so returns only strings
+    results = []
+    for url in urls:
+        url_for_scoping, url_for_crawling, hashtag = canonicalize_outlink(url)
+        results.append((str(url_for_scoping), url_for_crawling, hashtag))
+    return results
+
+
+# stand-in for missing timestamps in index values, where null isn't allowed
+_EPOCH = r.epoch_time(0)
+
+
+def _site_claimable_key(site):
+    """
+    Value of the "sites_claimable" index: sites of jobs with
+    `max_claimed_sites` are kept apart from the others, and unclaimed sites
+    are ordered by when they were last disclaimed, claimed ones by when they
+    were last claimed.
+    """
+    claimed = site["claimed"].default(False)
+    return [
+        site["status"],
+        site.has_fields("max_claimed_sites"),
+        claimed,
+        r.branch(
+            claimed,
+            site["last_claimed"].default(_EPOCH),
+            site["last_disclaimed"].default(_EPOCH),
+        ),
+    ]
+
+
+def _site_job_claimable_key(site):
+    """
+    Value of the "sites_job_claimable" index, for finding claimable sites of
+    a job.
+    """
+    return [
+        site["job_id"],
+        site["status"],
+        site["claimed"].default(False),
+        site["last_disclaimed"].default(_EPOCH),
+    ]
+
+
 class RethinkDbFrontier:
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
-    def __init__(self, rr, shards=None, replicas=None):
+    # seconds after being disclaimed that a site can be claimed again
+    DISCLAIMED_SITE_COOLDOWN = 20
+
+    def __init__(
+        self,
+        rr,
+        shards=None,
+        replicas=None,
+        write_behind=False,
+        outlink_processes=0,
+        outlink_pool_threshold=2000,
+        watch_sites=False,
+        prefetch_robots=False,
+        separate_outlinks=False,
+    ):
+        """
+        Args:
+            write_behind: if true, page writes by `completed_page()` and
+                `scope_and_schedule_outlinks()` are buffered and flushed in
+                bulk from a background thread, see `WriteBehind`
+            watch_sites: if true, `refresh_site()` and `honor_stop_request()`
+                look up stop requests, statuses and time limits of sites and
+                jobs in memory, kept up to date by changefeeds, see
+                `SiteWatcher`
+            outlink_processes: if nonzero, outlinks of pages with at least
+                `outlink_pool_threshold` distinct outlinks are canonicalized
+                in a pool of this many processes, so that canonicalizing
+                them doesn't hog the GIL
+            prefetch_robots: if true, `scope_and_schedule_outlinks()` doesn't
+                wait on fetching robots.txt of new hosts, it fetches them in
+                the background and marks outlinks to those hosts
+                `needs_robots_check` instead
+            separate_outlinks: if true, `scope_and_schedule_outlinks()` saves
+                the outlinks of the page in the "page_outlinks" table, see
+                `brozzler.PageOutlinks`, instead of in the page itself
+        """
         self.rr = rr
         self.shards = shards or len(rr.servers)
         self.replicas = replicas or min(len(rr.servers), 3)
         self._ensure_db()
+        self.write_behind = WriteBehind(rr) if write_behind else None
+        self.site_watcher = SiteWatcher(rr) if watch_sites else None
+        self.prefetch_robots = prefetch_robots
+        self.separate_outlinks = separate_outlinks
+        self._seen_pages = {}  # {site_id: SeenPages}
+        self.outlink_processes = outlink_processes
+        self.outlink_pool_threshold = outlink_pool_threshold
+        self._outlink_pool = None
+        self._outlink_pool_lock = threading.Lock()
+
+    def _save_page(self, page):
+        # also used for other documents that go along with pages
+        if self.write_behind:
+            self.write_behind.save(page)
+        else:
+            page.save()
+
+    def _save_pages(self, pages):
+        """
+        Saves `pages`, or buffers them if write-behind is enabled.
+        """
+        if self.write_behind:
+            for page in pages:
+                self.write_behind.save(page)
+            return
+
+        # insert/replace in batches of 50 to try to avoid this error:
+        # "rethinkdb.errors.ReqlDriverError: Query size (167883036) greater than maximum (134217727) in:"
+        # there can be many pages and each one can be very large (many videos,
+        # in and out of scope links, etc)
+        for batch in (pages[i : i + 50] for i in range(0, len(pages), 50)):
+            try:
+                self.logger.debug("inserting/replacing batch of %s pages", len(batch))
+                reql = self.rr.table("pages").insert(batch, conflict="replace")
+                self.logger.trace(
+                    'running query self.rr.table("pages").insert(%r, '
+                    'conflict="replace")',
+                    batch,
+                )
+                result = reql.run()
+            except Exception as e:
+                self.logger.error(
+                    "problem inserting/replacing batch of %s pages",
+                    len(batch),
+                    exc_info=True,
+                )
+
+    def flush_writes(self):
+        """Writes out any page writes buffered by write-behind."""
+        if self.write_behind:
+            self.write_behind.flush()
+
+    def close(self):
+        """Shuts down the outlink process pool, if it was started."""
+        with self._outlink_pool_lock:
+            if self._outlink_pool:
+                self._outlink_pool.shutdown()
+                self._outlink_pool = None
 
     def _ensure_db(self):
         dbs = self.rr.db_list().run()
@@ -58,6 +218,18 @@ class RethinkDbFrontier:
                 "sites_last_disclaimed", [r.row["status"], r.row["last_disclaimed"]]
             ).run()
             self.rr.table("sites").index_create("job_id").run()
+        site_indexes = self.rr.table("sites").index_list().run()
+        if not "sites_claimable" in site_indexes:
+            self.logger.info("creating rethinkdb index 'sites_claimable'")
+            self.rr.table("sites").index_create(
+                "sites_claimable", _site_claimable_key
+            ).run()
+        if not "sites_job_claimable" in site_indexes:
+            self.logger.info("creating rethinkdb index 'sites_job_claimable'")
+            self.rr.table("sites").index_create(
+                "sites_job_claimable", _site_job_claimable_key
+            ).run()
+        self.rr.table("sites").index_wait().run()
         if not "pages" in tables:
             self.logger.info(
                 "creating rethinkdb table 'pages' in database %r", self.rr.dbname
@@ -87,6 +259,42 @@ class RethinkDbFrontier:
             self.rr.table_create(
                 "jobs", shards=self.shards, replicas=self.replicas
             ).run()
+        if not "job_claims" in tables:
+            # counts of claimed sites of jobs with max_claimed_sites, kept
+            # apart from the jobs themselves because `Job.save()` replaces
+            # the whole document
+            self.logger.info(
+                "creating rethinkdb table 'job_claims' in database %r",
+                self.rr.dbname,
+            )
+            self.rr.table_create(
+                "job_claims", shards=self.shards, replicas=self.replicas
+            ).run()
+            self.reset_claimed_site_counts()
+        if not "has_room" in self.rr.table("job_claims").index_list().run():
+            # jobs that can have more sites claimed
+            self.logger.info("creating rethinkdb index 'has_room'")
+            self.rr.table("job_claims").index_create(
+                "has_room", r.row["claimed_sites"].lt(r.row["max_claimed_sites"])
+            ).run()
+            self.rr.table("job_claims").index_wait().run()
+        if not "page_outlinks" in tables:
+            self.logger.info(
+                "creating rethinkdb table 'page_outlinks' in database %r",
+                self.rr.dbname,
+            )
+            self.rr.table_create(
+                "page_outlinks", shards=self.shards, replicas=self.replicas
+            ).run()
+            self.rr.table("page_outlinks").index_create("site_id").run()
+        if not "hosts" in tables:
+            # turns to fetch from each host, see `reserve_host_turn()`
+            self.logger.info(
+                "creating rethinkdb table 'hosts' in database %r", self.rr.dbname
+            )
+            self.rr.table_create(
+                "hosts", shards=self.shards, replicas=self.replicas
+            ).run()
 
     def _vet_result(self, result, **kwargs):
         # self.logger.debug("vetting expected=%s result=%s", kwargs, result)
@@ -108,97 +316,269 @@ class RethinkDbFrontier:
                     )
 
     def claim_sites(self, n=1):
+        """
+        Claims up to `n` sites to brozzle.
+
+        Sites that were claimed more than an hour ago, presumably by a worker
+        that died, come first, then unclaimed sites in order of when they
+        were last disclaimed. Jobs with `max_claimed_sites` keep count of
+        their claimed sites in the "job_claims" table, so that finding
+        claimable sites takes index lookups rather than a pass over all
+        active sites.
+
+        Raises:
+            brozzler.NothingToClaim: if there is no site to claim
+        """
         self.logger.trace("claiming up to %s sites to brozzle", n)
-        result = (
-            self.rr.table("sites")
-            .get_all(
-                r.args(
-                    r.db(self.rr.dbname)
-                    .table("sites", read_mode="majority")
-                    .between(
-                        ["ACTIVE", r.minval],
-                        ["ACTIVE", r.maxval],
-                        index="sites_last_disclaimed",
-                    )
-                    .order_by(r.desc("claimed"), "last_disclaimed")
-                    .fold(
-                        {},
-                        lambda acc, site: acc.merge(
-                            r.branch(
-                                site.has_fields("job_id"),
-                                r.object(
-                                    site["job_id"].coerce_to("string"),
-                                    acc[site["job_id"].coerce_to("string")]
-                                    .default(0)
-                                    .add(1),
-                                ),
-                                {},
-                            )
-                        ),
-                        emit=lambda acc, site, new_acc: r.branch(
+        candidates = self._claimable_sites(n)
+        # reserve claims of jobs with max_claimed_sites before claiming
+        # their sites, so that workers claiming at the same time can't go
+        # over the limit
+        wanted = collections.Counter(c["job_id"] for c in candidates if c["reserve"])
+        reserved = {
+            job_id: self._reserve_job_claims(job_id, count)
+            for job_id, count in wanted.items()
+        }
+        site_ids = []
+        reserved_ids = set()
+        stale_ids = [c["id"] for c in candidates if c["stale"]]
+        available = dict(reserved)
+        for candidate in candidates:
+            if candidate["reserve"]:
+                if not available[candidate["job_id"]]:
+                    continue
+                available[candidate["job_id"]] -= 1
+                reserved_ids.add(candidate["id"])
+            site_ids.append(candidate["id"])
+
+        result = {"replaced": 0, "changes": []}
+        if site_ids:
+            result = (
+                self.rr.table("sites")
+                .get_all(r.args(site_ids))
+                .update(
+                    # try to avoid a race condition resulting in multiple
+                    # brozzler-workers claiming the same site
+                    # see https://github.com/rethinkdb/rethinkdb/issues/3235#issuecomment-60283038
+                    r.branch(
+                        r.or_(
+                            # a stale claim that has since been disclaimed
+                            # is left for a claim with a reservation
                             r.and_(
-                                r.or_(
-                                    # Avoid tight loop when unclaimed site was recently disclaimed
-                                    r.and_(
-                                        site["claimed"].not_(),
-                                        r.or_(
-                                            site.has_fields("last_disclaimed").not_(),
-                                            site["last_disclaimed"].lt(r.now().sub(20)),
-                                        ),
-                                    ),
-                                    site["last_claimed"].lt(r.now().sub(60 * 60)),
-                                ),
-                                r.or_(
-                                    site.has_fields("max_claimed_sites").not_(),
-                                    new_acc[site["job_id"].coerce_to("string")].le(
-                                        site["max_claimed_sites"]
-                                    ),
-                                ),
+                                r.row["claimed"].default(False).not_(),
+                                r.expr(stale_ids).contains(r.row["id"]).not_(),
+                            ),
+                            r.and_(
+                                r.row["claimed"].default(False),
+                                r.row["last_claimed"].lt(r.now().sub(60 * 60)),
                             ),
-                            [site["id"]],
-                            [],
                         ),
-                    )
-                    .limit(n)
-                )
-            )
-            .update(
-                # try to avoid a race condition resulting in multiple
-                # brozzler-workers claiming the same site
-                # see https://github.com/rethinkdb/rethinkdb/issues/3235#issuecomment-60283038
-                r.branch(
-                    r.or_(
-                        r.row["claimed"].not_(),
-                        r.row["last_claimed"].lt(r.now().sub(60 * 60)),
+                        {"claimed": True, "last_claimed": r.now()},
+                        {},
                     ),
-                    {"claimed": True, "last_claimed": r.now()},
-                    {},
-                ),
-                return_changes=True,
+                    return_changes=True,
+                )
+            ).run()
+            self._vet_result(
+                result, replaced=list(range(n + 1)), unchanged=list(range(n + 1))
             )
-        ).run()
 
-        self._vet_result(
-            result, replaced=list(range(n + 1)), unchanged=list(range(n + 1))
-        )
         sites = []
-        for i in range(result["replaced"]):
-            if result["changes"][i]["old_val"]["claimed"]:
+        newly_claimed = collections.Counter()
+        for change in result["changes"]:
+            if change["old_val"]["claimed"]:
                 self.logger.warning(
                     "re-claimed site that was still marked 'claimed' "
                     "because it was last claimed a long time ago "
                     "at %s, and presumably some error stopped it from "
                     "being disclaimed",
-                    result["changes"][i]["old_val"]["last_claimed"],
+                    change["old_val"]["last_claimed"],
                 )
-            site = brozzler.Site(self.rr, result["changes"][i]["new_val"])
+            elif change["new_val"]["id"] in reserved_ids:
+                newly_claimed[change["new_val"]["job_id"]] += 1
+            site = brozzler.Site(self.rr, change["new_val"])
             sites.append(site)
+        for job_id, count in reserved.items():
+            if count > newly_claimed[job_id]:
+                # another worker claimed some of the sites first
+                self._release_job_claims(job_id, count - newly_claimed[job_id])
         self.logger.debug("claimed %s sites", len(sites))
         if sites:
             return sites
         else:
             raise brozzler.NothingToClaim
 
+    def _claimable_sites(self, n):
+        """
+        Returns up to `n` sites that look claimable, as dicts with keys
+        "id", "job_id", "stale" and "reserve". "stale" is true for sites
+        claimed over an hour ago, oldest claims first. "reserve" is true for
+        unclaimed sites of jobs with `max_claimed_sites`, which need a claim
+        reserved with `_reserve_job_claims()`.
+        """
+        sites = r.db(self.rr.dbname).table("sites", read_mode="majority")
+
+        def stale(capped):
+            return (
+                sites.between(
+                    ["ACTIVE", capped, True, r.minval],
+                    ["ACTIVE", capped, True, r.now().sub(60 * 60)],
+                    index="sites_claimable",
+                )
+                .order_by(index="sites_claimable")
+                .limit(n)
+                .pluck("id", "job_id", "last_claimed")
+            )
+
+        # avoid tight loop when unclaimed site was recently disclaimed
+        recently = r.now().sub(self.DISCLAIMED_SITE_COOLDOWN)
+        uncapped = (
+            sites.between(
+                ["ACTIVE", False, False, r.minval],
+                ["ACTIVE", False, False, recently],
+                index="sites_claimable",
+            )
+            .order_by(index="sites_claimable")
+            .limit(n)
+            .pluck("id", "job_id", "last_disclaimed")
+        )
+        capped = (
+            r.db(self.rr.dbname)
+            .table("job_claims", read_mode="majority")
+            .get_all(True, index="has_room")
+            .concat_map(
+                lambda claims: sites.between(
+                    [claims["id"], "ACTIVE", False, r.minval],
+                    [claims["id"], "ACTIVE", False, recently],
+                    index="sites_job_claimable",
+                )
+                .order_by(index="sites_job_claimable")
+                .limit(
+                    r.expr(
+                        [n, claims["max_claimed_sites"].sub(claims["claimed_sites"])]
+                    ).min()
+                )
+                .pluck("id", "job_id", "last_disclaimed")
+            )
+        )
+        result = r.expr(
+            {
+                "stale": stale(False).union(stale(True)).coerce_to("array"),
+                "uncapped": uncapped.coerce_to("array"),
+                "capped": capped.coerce_to("array"),
+            }
+        ).run()
+
+        candidates = [
+            dict(site, stale=True, reserve=False)
+            for site in sorted(
+                result["stale"],
+                key=lambda site: site.get("last_claimed") or brozzler.EPOCH_UTC,
+            )
+        ]
+        unclaimed = [
+            dict(site, stale=False, reserve=False) for site in result["uncapped"]
+        ]
+        unclaimed.extend(
+            dict(site, stale=False, reserve=True) for site in result["capped"]
+        )
+        unclaimed.sort(
+            key=lambda site: site.get("last_disclaimed") or brozzler.EPOCH_UTC
+        )
+        candidates.extend(unclaimed)
+        return candidates[:n]
+
+    def claimable_site_notifications(self):
+        """
+        Watches the sites table with a changefeed, for sites that become
+        claimable: new and resumed sites, and sites disclaimed by workers.
+
+        Blocks until there is something to yield, so it should be consumed
+        in a thread of its own.
+
+        Yields:
+            the time, as seconds since the epoch, at which a site that changed
+            becomes claimable
+        """
+        feed = (
+            self.rr.table("sites")
+            .filter({"status": "ACTIVE", "claimed": False})
+            .changes()
+        )
+        for change in feed.run():
+            new_val = change.get("new_val")
+            if not new_val:
+                continue
+            claimable_at = time.time()
+            if new_val.get("last_disclaimed"):
+                claimable_at = max(
+                    claimable_at,
+                    new_val["last_disclaimed"].timestamp()
+                    + self.DISCLAIMED_SITE_COOLDOWN,
+                )
+            yield claimable_at
+
+    def _reserve_job_claims(self, job_id, n):
+        """
+        Reserves up to `n` claims of sites of job `job_id`, within the job's
+        `max_claimed_sites`, and returns how many were reserved.
+        """
+        result = (
+            self.rr.table("job_claims")
+            .get(job_id)
+            .update(
+                lambda claims: {
+                    "claimed_sites": r.expr(
+                        [claims["max_claimed_sites"], claims["claimed_sites"].add(n)]
+                    ).min()
+                },
+                return_changes=True,
+            )
+            .run()
+        )
+        if not result["changes"]:
+            return 0
+        change = result["changes"][0]
+        return change["new_val"]["claimed_sites"] - change["old_val"]["claimed_sites"]
+
+    def _release_job_claims(self, job_id, n=1):
+        self.rr.table("job_claims").get(job_id).update(
+            lambda claims: {
+                "claimed_sites": r.expr([0, claims["claimed_sites"].sub(n)]).max()
+            }
+        ).run()
+
+    def _site_disclaimed(self, site):
+        if site.get("max_claimed_sites") and site.get("job_id"):
+            self._release_job_claims(site.job_id)
+
+    def reset_claimed_site_counts(self, job_id=None):
+        """
+        Counts the claimed sites of job `job_id`, or of every active job, if
+        it has `max_claimed_sites`, and stores the counts in the "job_claims"
+        table.
+
+        `claim_sites()` and `disclaim_site()` keep the counts up to date, this
+        is for new and resumed jobs, and for setting up the counts in the
+        first place.
+        """
+        jobs = r.db(self.rr.dbname).table("jobs")
+        if job_id:
+            jobs = jobs.get_all(job_id)
+        else:
+            jobs = jobs.filter({"status": "ACTIVE"})
+        sites = r.db(self.rr.dbname).table("sites")
+        counts = jobs.filter(r.row.has_fields("max_claimed_sites")).map(
+            lambda job: {
+                "id": job["id"],
+                "max_claimed_sites": job["max_claimed_sites"],
+                "claimed_sites": sites.get_all(job["id"], index="job_id")
+                .filter({"status": "ACTIVE", "claimed": True})
+                .count(),
+            }
+        )
+        self.rr.table("job_claims").insert(counts, conflict="replace").run()
+
     def enforce_time_limit(self, site):
         """
         Raises `brozzler.ReachedTimeLimit` if appropriate.
@@ -212,11 +592,27 @@ class RethinkDbFrontier:
             )
             raise brozzler.ReachedTimeLimit
 
-    def claim_page(self, site, worker_id):
+    def claim_pages(self, site, worker_id, n=1):
+        """
+        Claims up to `n` of the highest priority unbrozzled pages of `site` in
+        a single query.
+
+        Returns:
+            list of `brozzler.Page`, highest priority first
+
+        Raises:
+            brozzler.NothingToClaim: if there are no pages to claim
+        """
         # ignores the "claimed" field of the page, because only one
         # brozzler-worker can be working on a site at a time, and that would
         # have to be the worker calling this method, so if something is claimed
         # already, it must have been left that way because of some error
+        #
+        # pages with buffered writes, e.g. the page just completed, still look
+        # unbrozzled in rethinkdb, so skip those
+        pending_ids = (
+            self.write_behind.pending_ids("pages") if self.write_behind else []
+        )
         result = (
             self.rr.table("pages")
             .between(
@@ -226,21 +622,89 @@ class RethinkDbFrontier:
             )
             .order_by(index=r.desc("priority_by_site"))
             .filter(
-                lambda page: r.or_(
-                    page.has_fields("retry_after").not_(), r.now() > page["retry_after"]
+                lambda page: r.and_(
+                    r.or_(
+                        page.has_fields("retry_after").not_(),
+                        r.now() > page["retry_after"],
+                    ),
+                    r.expr(pending_ids).contains(page["id"]).not_(),
                 )
             )
-            .limit(1)
+            .limit(n)
             .update(
                 {"claimed": True, "last_claimed_by": worker_id}, return_changes="always"
             )
             .run()
         )
-        self._vet_result(result, unchanged=[0, 1], replaced=[0, 1])
+        self._vet_result(
+            result, unchanged=list(range(n + 1)), replaced=list(range(n + 1))
+        )
         if result["unchanged"] == 0 and result["replaced"] == 0:
             raise brozzler.NothingToClaim
-        else:
-            return brozzler.Page(self.rr, result["changes"][0]["new_val"])
+        pages = [
+            brozzler.Page(self.rr, change["new_val"]) for change in result["changes"]
+        ]
+        # order of "changes" is not guaranteed to follow order_by()
+        pages.sort(key=lambda page: page.priority, reverse=True)
+        return pages
+
+    def claim_page(self, site, worker_id):
+        return self.claim_pages(site, worker_id, 1)[0]
+
+    def disclaim_pages(self, pages):
+        """Releases claims on pages that were claimed but not brozzled."""
+        if not pages:
+            return
+        # buffered writes of these pages must not land after this update
+        self.flush_writes()
+        self.logger.debug("disclaiming %s unbrozzled pages", len(pages))
+        self.rr.table("pages").get_all(*[page.id for page in pages]).update(
+            {"claimed": False}
+        ).run()
+        for page in pages:
+            page.claimed = False
+
+    def defer_page(self, page, until):
+        """
+        Releases the claim on `page`, which is not to be claimed again before
+        `until`, a datetime.
+        """
+        page.claimed = False
+        page.retry_after = until
+        self._save_page(page)
+
+    def reserve_host_turn(self, host, delay, max_wait):
+        """
+        Reserves the next turn of any brozzler worker to fetch from `host`,
+        the turn after it coming `delay` seconds later, unless the next turn
+        is more than `max_wait` seconds away.
+
+        Returns:
+            tuple (whether the turn was reserved, datetime of the turn)
+        """
+        now = r.now()
+        result = (
+            self.rr.table("hosts")
+            .get(host)
+            .replace(
+                lambda doc: r.branch(
+                    doc.eq(None), now, doc["next_turn"].gt(now), doc["next_turn"], now
+                ).do(
+                    lambda turn: r.branch(
+                        turn.gt(now.add(max_wait)),
+                        doc,
+                        {"id": host, "turn": turn, "next_turn": turn.add(delay)},
+                    )
+                ),
+                return_changes="always",
+            )
+            .run()
+        )
+        self._vet_result(result, inserted=[0, 1], replaced=[0, 1], unchanged=[0, 1])
+        doc = result["changes"][0]["new_val"]
+        if result["unchanged"]:
+            return False, doc["next_turn"]
+        return True, doc["turn"]
 
     def has_outstanding_pages(self, site):
         results_iter = (
@@ -259,7 +723,7 @@ class RethinkDbFrontier:
         page.brozzle_count += 1
         page.claimed = False
         # XXX set priority?
-        page.save()
+        self._save_page(page)
         if page.redirect_url and page.hops_from_seed == 0:
             site.note_seed_redirect(page.redirect_url)
             site.save()
@@ -269,19 +733,39 @@ class RethinkDbFrontier:
         for result in results:
             yield brozzler.Job(self.rr, result)
 
+    def refresh_site(self, site):
+        """
+        Reloads `site` from rethinkdb or, if watching sites, updates the
+        fields that say whether to keep brozzling it from `SiteWatcher`.
+        """
+        if not self.site_watcher:
+            site.refresh()
+            return
+        doc = self.site_watcher.get("sites", site.id)
+        if not doc:
+            return
+        for field in SiteWatcher.SITE_FIELDS:
+            if field in doc:
+                site[field] = doc[field]
+            else:
+                site.pop(field, None)
+
     def honor_stop_request(self, site):
         """Raises brozzler.CrawlStopped if stop has been requested."""
-        site.refresh()
+        self.refresh_site(site)
         if site.stop_requested and site.stop_requested <= doublethink.utcnow():
             self.logger.info("stop requested for site %s", site.id)
             raise brozzler.CrawlStopped
 
         if site.job_id:
-            job = brozzler.Job.load(self.rr, site.job_id)
+            if self.site_watcher:
+                job = self.site_watcher.get("jobs", site.job_id)
+            else:
+                job = brozzler.Job.load(self.rr, site.job_id)
             if (
                 job
-                and job.stop_requested
-                and job.stop_requested <= doublethink.utcnow()
+                and job.get("stop_requested")
+                and job["stop_requested"] <= doublethink.utcnow()
             ):
                 self.logger.info("stop requested for job %s", site.job_id)
                 raise brozzler.CrawlStopped
@@ -307,10 +791,13 @@ class RethinkDbFrontier:
         self.logger.info("all %s sites finished, job %s is FINISHED!", n, job.id)
         job.finish()
         job.save()
+        self.rr.table("job_claims").get(job.id).delete().run()
         return True
 
     def finished(self, site, status):
         self.logger.info("%s %s", status, site)
+        if site.claimed:
+            self._site_disclaimed(site)
         site.status = status
         site.claimed = False
         site.last_disclaimed = doublethink.utcnow()
@@ -321,8 +808,13 @@ class RethinkDbFrontier:
 
     def disclaim_site(self, site, page=None):
         self.logger.info("disclaiming %s", site)
+        self.flush_writes()
+        if site.claimed:
+            self._site_disclaimed(site)
         site.claimed = False
         site.last_disclaimed = doublethink.utcnow()
+        if self.site_watcher:
+            self.site_watcher.forget("sites", site.id)
         if not page and not self.has_outstanding_pages(site):
             self.finished(site, "FINISHED")
         else:
@@ -340,6 +832,7 @@ class RethinkDbFrontier:
             site.status = "ACTIVE"
             site.starts_and_stops.append({"start": doublethink.utcnow(), "stop": None})
             site.save()
+        self.reset_claimed_site_counts(job.id)
 
     def resume_site(self, site):
         if site.job_id:
@@ -352,23 +845,20 @@ class RethinkDbFrontier:
         site.status = "ACTIVE"
         site.starts_and_stops.append({"start": doublethink.utcnow(), "stop": None})
         site.save()
+        if site.job_id:
+            self.reset_claimed_site_counts(site.job_id)
 
-    def _build_fresh_page(self, site, parent_page, url, hops_off=0):
-        url_for_scoping = urlcanon.semantic(url)
-        url_for_crawling = urlcanon.whatwg(url)
-        hashtag = (url_for_crawling.hash_sign + url_for_crawling.fragment).decode(
-            "utf-8"
-        )
-        urlcanon.canon.remove_fragment(url_for_crawling)
+    def _build_fresh_page(
+        self, site, parent_page, url_for_crawling, hashtag, hops_off=0
+    ):
         page = brozzler.Page(
             self.rr,
             {
-                "url": str(url_for_crawling),
+                "url": url_for_crawling,
                 "site_id": site.id,
                 "job_id": site.job_id,
                 "hops_from_seed": parent_page.hops_from_seed + 1,
-                "hop_path": str(parent_page.hop_path if parent_page.hop_path else "")
-                + "L",
+                "hop_path": brozzler.model.append_hop(parent_page.hop_path, "L"),
                 "via_page_id": parent_page.id,
                 "via_page_url": parent_page.url,
                 "hops_off_surt": hops_off,
@@ -388,7 +878,117 @@ class RethinkDbFrontier:
         )
         existing_page.hops_off = min(existing_page.hops_off, fresh_page.hops_off)
 
-    def _scope_and_enforce_robots(self, site, parent_page, outlinks):
+    def _upsert_pages(self, pages):
+        """
+        Inserts `pages`, merging each one into the existing page with the same
+        id, if any, on the rethinkdb side, like `_merge_page()` does. Batches
+        that fail are logged and skipped, like in `_save_pages()`.
+
+        Returns:
+            tuple (number of pages added, number of existing pages updated)
+        """
+
+        def merge(page_id, existing, fresh):
+            return existing.merge(
+                {
+                    "priority": existing["priority"].add(fresh["priority"]),
+                    "hashtags": existing["hashtags"]
+                    .default([])
+                    .set_union(fresh["hashtags"].default([])),
+                    "hops_off": r.branch(
+                        existing["hops_off"].default(0).lt(fresh["hops_off"]),
+                        existing["hops_off"].default(0),
+                        fresh["hops_off"],
+                    ),
+                }
+            )
+
+        added = updated = 0
+        for batch in (pages[i : i + 50] for i in range(0, len(pages), 50)):
+            try:
+                self.logger.debug("upserting batch of %s pages", len(batch))
+                result = self.rr.table("pages").insert(batch, conflict=merge).run()
+            except Exception as e:
+                self.logger.error(
+                    "problem upserting batch of %s pages", len(batch), exc_info=True
+                )
+                continue
+            added += result["inserted"]
+            updated += result["replaced"] + result["unchanged"]
+        return added, updated
+
+    def warm_seen_pages(self, site, lru_size=100000, bloom=True):
+        """
+        Sets up a `brozzler.seen.SeenPages` cache of the ids of the pages of
+        `site`, used by `scope_and_schedule_outlinks()` to skip fetching
+        outlinks that are certainly already queued (or certainly new), and
+        fills it with the ids of the pages in rethinkdb.
+        """
+        seen = SeenPages(lru_size=lru_size, bloom=bloom)
+        start = time.time()
+        results = (
+            self.rr.table("pages")
+            .between(
+                [site.id, r.minval, r.minval, r.minval],
+                [site.id, r.maxval, r.maxval, r.maxval],
+                index="priority_by_site",
+            )
+            .get_field("id")
+            .run()
+        )
+        for page_id in results:
+            seen.add(page_id)
+        seen.complete = True
+        self.logger.info(
+            "loaded %s page ids of %s into seen pages cache in %.1fs",
+            len(seen),
+            site,
+            time.time() - start,
+        )
+        self._seen_pages[site.id] = seen
+        return seen
+
+    def forget_seen_pages(self, site):
+        self._seen_pages.pop(site.id, None)
+
+    def _canonicalize_outlinks(self, outlinks):
+        """
+        Canonicalizes each distinct url in `outlinks` once, in the outlink
+        process pool if enabled and there are enough of them.
+
+        Returns:
+            dict of {url: (url_for_scoping, url_for_crawling, hashtag)}, see
+            `canonicalize_outlink()`
+        """
+        urls = list(dict.fromkeys(outlinks or []))
+        if not self.outlink_processes or len(urls) < self.outlink_pool_threshold:
+            return {url: canonicalize_outlink(url) for url in urls}
+
+        with self._outlink_pool_lock:
+            if not self._outlink_pool:
+                # spawn rather than fork, we have threads
+                self._outlink_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.outlink_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        chunk_size = -(-len(urls) // self.outlink_processes)
+        chunks = [urls[i : i + chunk_size] for i in range(0, len(urls), chunk_size)]
+        canonicalized = {}
+        for chunk, results in zip(
+            chunks, self._outlink_pool.map(_canonicalize_outlinks, chunks)
+        ):
+            for url, (url_for_scoping, url_for_crawling, hashtag) in zip(
+                chunk, results
+            ):
+                # already canonical, parsing is enough
+                canonicalized[url] = (
+                    urlcanon.parse_url(url_for_scoping),
+                    url_for_crawling,
+                    hashtag,
+                )
+        return canonicalized
+
+    def _scope_and_enforce_robots(self, site, parent_page, outlinks, proxy=None):
         """
         Returns tuple (
             dict of {page_id: Page} of fresh `brozzler.Page` representing in
@@ -399,11 +999,12 @@ class RethinkDbFrontier:
         pages = {}  # {page_id: Page, ...}
         blocked = set()
         out_of_scope = set()
-        for url in outlinks or []:
-            url_for_scoping = urlcanon.semantic(url)
-            url_for_crawling = urlcanon.whatwg(url)
+        in_scope = []  # [(url_for_crawling, hashtag, hops_off), ...]
+        parent_urls = site.parent_urls_for_scoping(parent_page)
+        canonicalized = self._canonicalize_outlinks(outlinks)
+        for url_for_scoping, url_for_crawling, hashtag in canonicalized.values():
             decision = site.accept_reject_or_neither(
-                url_for_scoping, parent_page=parent_page
+                url_for_scoping, parent_page=parent_page, parent_urls=parent_urls
             )
             if decision is True:
                 hops_off = 0
@@ -411,35 +1012,109 @@ class RethinkDbFrontier:
                 decision = parent_page.hops_off < site.scope.get("max_hops_off", 0)
                 hops_off = parent_page.hops_off + 1
             if decision is True:
-                if brozzler.is_permitted_by_robots(site, str(url_for_crawling)):
-                    fresh_page = self._build_fresh_page(
-                        site, parent_page, url, hops_off
-                    )
-                    if fresh_page.id in pages:
-                        self._merge_page(pages[fresh_page.id], fresh_page)
-                    else:
-                        pages[fresh_page.id] = fresh_page
-                else:
-                    blocked.add(str(url_for_crawling))
+                in_scope.append((url_for_crawling, hashtag, hops_off))
             else:
-                out_of_scope.add(str(url_for_crawling))
+                out_of_scope.add(url_for_crawling + hashtag)
+
+        # robots.txt rules are looked up once per host
+        verdicts = brozzler.robots.check_robots(
+            site,
+            [url_for_crawling + hashtag for url_for_crawling, hashtag, _ in in_scope],
+            proxy,
+            wait=not self.prefetch_robots,
+        )
+        for url_for_crawling, hashtag, hops_off in in_scope:
+            permitted = verdicts[url_for_crawling + hashtag]
+            if permitted is False:
+                blocked.add(url_for_crawling + hashtag)
+                continue
+            fresh_page = self._build_fresh_page(
+                site, parent_page, url_for_crawling, hashtag, hops_off
+            )
+            if permitted is None:
+                # robots.txt is on its way, check before brozzling
+                fresh_page.needs_robots_check = True
+            if fresh_page.id in pages:
+                self._merge_page(pages[fresh_page.id], fresh_page)
+            else:
+                pages[fresh_page.id] = fresh_page
         return pages, blocked, out_of_scope
 
-    def scope_and_schedule_outlinks(self, site, parent_page, outlinks):
+    def scope_and_schedule_outlinks(
+        self, site, parent_page, outlinks, claimed_pages=None, proxy=None
+    ):
+        """
+        Scopes `outlinks` of `parent_page` and saves new and updated pages.
+
+        Args:
+            claimed_pages: optional dict of {page_id: Page} of pages of `site`
+                claimed by the caller but not yet brozzled, e.g.
+                `ClaimedPageQueue.pages`; outlinks to these pages are merged
+                into the caller's copies, so that saving them later doesn't
+                clobber the update
+            proxy: proxy to fetch robots.txt through, the one `site` is
+                brozzled through, so that robots.txt is archived and looked
+                up in the robots.txt cache under the same key as the worker's
+                own checks
+        """
         decisions = {"accepted": set(), "blocked": set(), "rejected": set()}
         counts = {"added": 0, "updated": 0, "rejected": 0, "blocked": 0}
 
         fresh_pages, blocked, out_of_scope = self._scope_and_enforce_robots(
-            site, parent_page, outlinks
+            site, parent_page, outlinks, proxy
         )
         decisions["blocked"] = blocked
         decisions["rejected"] = out_of_scope
         counts["blocked"] += len(blocked)
         counts["rejected"] += len(out_of_scope)
 
+        # pages that the seen pages cache can vouch for as existing or new can
+        # be upserted without fetching them first
+        seen = self._seen_pages.get(site.id)
+        upserts = {}
+        if seen:
+            for page_id in list(fresh_pages):
+                if (
+                    page_id == parent_page.id
+                    or (claimed_pages and page_id in claimed_pages)
+                    or (self.write_behind and self.write_behind.get("pages", page_id))
+                ):
+                    continue
+                if seen.classify(page_id) is not None:
+                    upserts[page_id] = fresh_pages.pop(page_id)
+        if upserts and self.write_behind:
+            # a buffered write of one of these pages replaces the whole
+            # document, it must not land after the upsert and undo it
+            try:
+                self.write_behind.flush()
+            except Exception as e:
+                self.logger.error(
+                    "problem flushing buffered writes, not upserting", exc_info=True
+                )
+                fresh_pages.update(upserts)
+                upserts = {}
+        if upserts:
+            decisions["accepted"].update(page.url for page in upserts.values())
+            added, updated = self._upsert_pages(list(upserts.values()))
+            counts["added"] += added
+            counts["updated"] += updated
+
         # get existing pages from rethinkdb
-        results = self.rr.table("pages").get_all(*fresh_pages.keys()).run()
-        pages = {doc["id"]: brozzler.Page(self.rr, doc) for doc in results}
+        if fresh_pages:
+            results = self.rr.table("pages").get_all(*fresh_pages.keys()).run()
+            pages = {doc["id"]: brozzler.Page(self.rr, doc) for doc in results}
+        else:
+            pages = {}
+        if self.write_behind:
+            # buffered writes are newer than what's in rethinkdb
+            for page_id in fresh_pages:
+                doc = self.write_behind.get("pages", page_id)
+                if doc:
+                    pages[page_id] = brozzler.Page(self.rr, doc)
+        if claimed_pages:
+            for page_id in pages:
+                if page_id in claimed_pages:
+                    pages[page_id] = claimed_pages[page_id]
 
         # build list of pages to save, consisting of new pages, and existing
         # pages updated with higher priority and new hashtags
@@ -459,32 +1134,23 @@ class RethinkDbFrontier:
             self._merge_page(parent_page, pages[parent_page.id])
             del pages[parent_page.id]
 
-        # insert/replace in batches of 50 to try to avoid this error:
-        # "rethinkdb.errors.ReqlDriverError: Query size (167883036) greater than maximum (134217727) in:"
-        # there can be many pages and each one can be very large (many videos,
-        # in and out of scope links, etc)
-        l = list(pages.values())
-        for batch in (l[i : i + 50] for i in range(0, len(l), 50)):
-            try:
-                self.logger.debug("inserting/replacing batch of %s pages", len(batch))
-                reql = self.rr.table("pages").insert(batch, conflict="replace")
-                self.logger.trace(
-                    'running query self.rr.table("pages").insert(%r, '
-                    'conflict="replace")',
-                    batch,
-                )
-                result = reql.run()
-            except Exception as e:
-                self.logger.error(
-                    "problem inserting/replacing batch of %s pages",
-                    len(batch),
-                    exc_info=True,
-                )
+        self._save_pages(list(pages.values()))
+        if seen:
+            for page_id in list(pages) + list(upserts):
+                seen.add(page_id)
 
-        parent_page.outlinks = {}
-        for k in decisions:
-            parent_page.outlinks[k] = list(decisions[k])
-        parent_page.save()
+        outlinks = {k: list(decisions[k]) for k in decisions}
+        if self.separate_outlinks:
+            parent_page.pop("outlinks", None)
+            self._save_page(
+                brozzler.PageOutlinks(
+                    self.rr,
+                    {"id": parent_page.id, "site_id": site.id, "outlinks": outlinks},
+                )
+            )
+        else:
+            parent_page.outlinks = outlinks
+        self._save_page(parent_page)
 
         self.logger.info(
             "%s new links added, %s existing links updated, %s links "
@@ -555,3 +1221,257 @@ class RethinkDbFrontier:
         for result in results:
             self.logger.trace("yielding result: %r", result)
             yield brozzler.Page(self.rr, result)
+
+
+class WriteBehind:
+    """
+    Buffers document writes and flushes them to rethinkdb in bulk from a
+    background thread, once `max_docs` documents are buffered or `max_delay`
+    seconds have passed, and whenever `flush()` is called.
+
+    Writes of the same document are coalesced: only the latest version is
+    written. Readers that need to see buffered writes can look them up with
+    `get()` and `pending_ids()`.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, rr, max_docs=500, max_delay=2.0):
+        self.rr = rr
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self._pending = {}  # {(table, id): doc}
+        self._in_flight = {}  # {(table, id): doc}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # held while writing, so that writes land in the order buffered
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run, name="WriteBehindThread", daemon=True
+        )
+        self._thread.start()
+
+    def save(self, doc):
+        """Buffers a write of `doc`, a `doublethink.Document`."""
+        with self._lock:
+            # shallow copy so the caller can keep modifying its document
+            self._pending[(doc.table, doc.id)] = dict(doc)
+            if len(self._pending) >= self.max_docs:
+                self._wakeup.notify()
+
+    def get(self, table, doc_id):
+        """Returns the buffered version of a document, or None."""
+        with self._lock:
+            return self._pending.get(
+                (table, doc_id), self._in_flight.get((table, doc_id))
+            )
+
+    def pending_ids(self, table):
+        """Returns ids of documents in `table` not yet written."""
+        with self._lock:
+            return [
+                doc_id
+                for t, doc_id in list(self._pending) + list(self._in_flight)
+                if t == table
+            ]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(
+                    lambda: len(self._pending) >= self.max_docs,
+                    timeout=self.max_delay,
+                )
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error("problem flushing buffered writes: %s", e)
+
+    def flush(self):
+        """
+        Writes all buffered documents.
+
+        If a write fails, the documents that were not superseded in the
+        meantime are put back in the buffer and the exception is raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._in_flight = batch
+            if not batch:
+                return
+            try:
+                by_table = {}
+                for (table, doc_id), doc in batch.items():
+                    by_table.setdefault(table, []).append(doc)
+                for table, docs in by_table.items():
+                    # batches of 50 for the same reason as in
+                    # RethinkDbFrontier._save_pages()
+                    for i in range(0, len(docs), 50):
+                        self.logger.debug(
+                            "writing %s buffered %s", len(docs[i : i + 50]), table
+                        )
+                        self.rr.table(table).insert(
+                            docs[i : i + 50], conflict="replace"
+                        ).run()
+            except:
+                with self._lock:
+                    for key, doc in batch.items():
+                        self._pending.setdefault(key, doc)
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+
+
+class SiteWatcher:
+    """
+    Keeps in-memory copies of the fields of sites and jobs that say whether
+    brozzling a site should go on: status, stop request and time limit.
+
+    Documents are cached the first time they are looked up with `get()`, and
+    kept up to date from then on by watching the sites and jobs tables with
+    rethinkdb changefeeds, one background thread each. While a changefeed is
+    down, `get()` reads from rethinkdb instead.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    SITE_FIELDS = ("status", "stop_requested", "time_limit")
+    JOB_FIELDS = ("status", "stop_requested")
+
+    def __init__(self, rr):
+        self.rr = rr
+        self._fields = {"sites": self.SITE_FIELDS, "jobs": self.JOB_FIELDS}
+        self._docs = {}  # {(table, id): doc}
+        self._live = set()  # tables whose changefeed is up
+        # {table: count of changefeed ups and downs}, so that a document read
+        # before a changefeed came back up doesn't get cached
+        self._generation = {table: 0 for table in self._fields}
+        self._lock = threading.Lock()
+        for table in self._fields:
+            th = threading.Thread(
+                target=self._watch,
+                args=(table,),
+                name="SiteWatcher:%s" % table,
+                daemon=True,
+            )
+            th.start()
+
+    def _watch(self, table):
+        retry_delay = 1
+        while True:
+            try:
+                feed = (
+                    self.rr.table(table)
+                    .pluck("id", *self._fields[table])
+                    .changes()
+                    .run()
+                )
+                with self._lock:
+                    # changes made while the changefeed was down are lost,
+                    # start over
+                    for key in [key for key in self._docs if key[0] == table]:
+                        del self._docs[key]
+                    self._live.add(table)
+                    self._generation[table] += 1
+                retry_delay = 1
+                for change in feed:
+                    doc = change.get("new_val") or change.get("old_val")
+                    if not doc:
+                        continue
+                    key = (table, doc["id"])
+                    with self._lock:
+                        if key not in self._docs:
+                            continue
+                        if change.get("new_val"):
+                            self._docs[key] = change["new_val"]
+                        else:
+                            del self._docs[key]
+            except Exception as e:
+                self.logger.warning(
+                    "problem watching %s, will try again in %ss: %s",
+                    table,
+                    retry_delay,
+                    e,
+                )
+            with self._lock:
+                self._live.discard(table)
+                self._generation[table] += 1
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+
+    def get(self, table, doc_id):
+        """
+        Returns a dict with the watched fields of document `doc_id` in
+        `table`, "sites" or "jobs", or None if there is no such document.
+        """
+        key = (table, doc_id)
+        generation = None
+        with self._lock:
+            if table in self._live:
+                if key in self._docs:
+                    return self._docs[key]
+                generation = self._generation[table]
+        doc = self.rr.table(table).get(doc_id).run()
+        if doc:
+            doc = {
+                k: v for k, v in doc.items() if k == "id" or k in self._fields[table]
+            }
+            with self._lock:
+                if generation == self._generation[table]:
+                    # if the changefeed got here first its version is newer
+                    doc = self._docs.setdefault(key, doc)
+        return doc
+
+    def forget(self, table, doc_id):
+        """Stops caching document `doc_id` in `table`."""
+        with self._lock:
+            self._docs.pop((table, doc_id), None)
+
+
+class ClaimedPageQueue:
+    """
+    Local queue of pages of one site, which a brozzler worker claims from the
+    frontier in batches of up to `batch_size` with one query, and hands out
+    one at a time.
+
+    Pages that are claimed but never handed out must be given back with
+    `release()` when the worker disclaims the site.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, frontier, site, worker_id, batch_size=1):
+        self.frontier = frontier
+        self.site = site
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self._queue = []
+
+    @property
+    def pages(self):
+        """Dict of {page_id: Page} of pages claimed but not yet handed out."""
+        return {page.id: page for page in self._queue}
+
+    def __len__(self):
+        return len(self._queue)
+
+    def claim(self):
+        """
+        Returns the next page to brozzle, claiming another batch from the
+        frontier if the local queue is empty.
+
+        Raises:
+            brozzler.NothingToClaim: if there are no pages to claim
+        """
+        if not self._queue:
+            self._queue = self.frontier.claim_pages(
+                self.site, self.worker_id, self.batch_size
+            )
+        return self._queue.pop(0)
+
+    def release(self):
+        """Disclaims any pages claimed but not yet handed out."""
+        pages, self._queue = self._queue, []
+        self.frontier.disclaim_pages(pages)
@@ -20,9 +20,9 @@ limitations under the License.
 import brozzler
 import base64
 import cerberus
-import copy
 import datetime
 import doublethink
+import functools
 import hashlib
 import json
 import logging
@@ -122,6 +122,8 @@ def new_job(frontier, job_conf):
     for batch in (sites[i : i + 100] for i in range(0, len(sites), 100)):
         logging.info("inserting batch of %s sites", len(batch))
         result = frontier.rr.table("sites").insert(batch).run()
+    if job.get("max_claimed_sites"):
+        frontier.reset_claimed_site_counts(job.id)
     logging.info("job %s fully started", job.id)
 
     return job
@@ -281,6 +283,7 @@ class Site(doublethink.Document, ElapsedMixIn):
         if not any(ssurt.startswith(ss) for ss in simple_rule_ssurts):
             self.logger.info("adding ssurt %s to scope accept rules", ssurt)
             self.scope["accepts"].append({"ssurt": ssurt})
+            self._compiled_scope = None
 
     def note_seed_redirect(self, url):
         canon_seed_redirect = brozzler.site_surt_canon(url)
@@ -300,32 +303,75 @@ class Site(doublethink.Document, ElapsedMixIn):
     def extra_headers(self, page: Optional["Page"] = None):
         hdrs = {}
         if self.warcprox_meta:
-            temp_warcprox_meta = copy.deepcopy(self.warcprox_meta)
-            if "blocks" in self.warcprox_meta:
-                # delete temp_warcprox_meta's 'blocks' (they may be big!)
-                del temp_warcprox_meta["blocks"]
-                # str-ify blocks
-                blocks_str = json.dumps(
-                    self.warcprox_meta["blocks"], separators=(",", ":")
-                )
-                # encode(), compress, b64encode, decode()
-                temp_warcprox_meta["compressed_blocks"] = base64.b64encode(
-                    zlib.compress(blocks_str.encode())
-                ).decode()
+            header, metadata = self._warcprox_meta_header()
             if page is not None:
-                temp_warcprox_meta["metadata"]["hop_path"] = page.hop_path
-                temp_warcprox_meta["metadata"]["brozzled_url"] = page.url
-                temp_warcprox_meta["metadata"]["hop_via_url"] = page.via_page_url
-            hdrs["Warcprox-Meta"] = json.dumps(
-                temp_warcprox_meta, separators=(",", ":")
-            )
+                # splice the page's metadata into the cached header
+                metadata = dict(metadata or {})
+                metadata["hop_path"] = expand_hop_path(page.hop_path)
+                metadata["brozzled_url"] = page.url
+                metadata["hop_via_url"] = page.via_page_url
+                header = self._warcprox_meta_without_metadata
+                if len(header) > 1:
+                    header += ","
+                header += '"metadata":%s}' % json.dumps(metadata, separators=(",", ":"))
+            hdrs["Warcprox-Meta"] = header
         return hdrs
 
-    def accept_reject_or_neither(self, url, parent_page=None):
+    def _warcprox_meta_header(self):
+        """
+        Returns tuple (Warcprox-Meta header value for `self.warcprox_meta`,
+        its "metadata" or `None`).
+
+        The header has "blocks" compressed into "compressed_blocks", and
+        "metadata" last. The header without "metadata" and the closing brace
+        is kept in `self._warcprox_meta_without_metadata`, for
+        `extra_headers()` to add page metadata to.
+
+        Recomputed only when `self.warcprox_meta` is replaced, e.g. by
+        `refresh()`, with something different, since compressing the blocks
+        is expensive. Changes made to `self.warcprox_meta` in place are not
+        noticed.
+        """
+        warcprox_meta = self.warcprox_meta
+        if self._warcprox_meta_of is not warcprox_meta:
+            if self._warcprox_meta_of != warcprox_meta:
+                without_metadata = {
+                    k: v
+                    for k, v in warcprox_meta.items()
+                    if k not in ("blocks", "metadata")
+                }
+                if "blocks" in warcprox_meta:
+                    # the blocks may be big! str-ify, encode(), compress,
+                    # b64encode, decode()
+                    blocks_str = json.dumps(
+                        warcprox_meta["blocks"], separators=(",", ":")
+                    )
+                    without_metadata["compressed_blocks"] = base64.b64encode(
+                        zlib.compress(blocks_str.encode())
+                    ).decode()
+                self._warcprox_meta_without_metadata = json.dumps(
+                    without_metadata, separators=(",", ":")
+                )[:-1]
+                header = self._warcprox_meta_without_metadata
+                if "metadata" in warcprox_meta:
+                    if len(header) > 1:
+                        header += ","
+                    header += '"metadata":%s' % json.dumps(
+                        warcprox_meta["metadata"], separators=(",", ":")
+                    )
+                self._warcprox_meta_header_value = header + "}"
+            self._warcprox_meta_of = warcprox_meta
+        return self._warcprox_meta_header_value, warcprox_meta.get("metadata")
+
+    def accept_reject_or_neither(self, url, parent_page=None, parent_urls=None):
         """
         Returns `True` (accepted), `False` (rejected), or `None` (no decision).
 
         `None` usually means rejected, unless `max_hops_off` comes into play.
+
+        `parent_urls` is the optional result of `self.parent_urls_for_scoping(
+        parent_page)`, to avoid recomputing it when scoping many urls with the
+        same parent page.
         """
         if not isinstance(url, urlcanon.ParsedUrl):
             url = urlcanon.semantic(url)
@@ -335,11 +381,10 @@ class Site(doublethink.Document, ElapsedMixIn):
             # schemes?)
             return False
 
-        try_parent_urls = []
-        if parent_page:
-            try_parent_urls.append(urlcanon.semantic(parent_page.url))
-            if parent_page.redirect_url:
-                try_parent_urls.append(urlcanon.semantic(parent_page.redirect_url))
+        if parent_urls is not None:
+            try_parent_urls = parent_urls
+        else:
+            try_parent_urls = self.parent_urls_for_scoping(parent_page)
 
         # enforce max_hops
         if (
@@ -349,31 +394,170 @@ class Site(doublethink.Document, ElapsedMixIn):
         ):
             return False
 
+        compiled_scope = self.compiled_scope()
+        ssurt = url.ssurt()
+
         # enforce reject rules
-        if "blocks" in self.scope:
-            for block_rule in self.scope["blocks"]:
-                rule = urlcanon.MatchRule(**block_rule)
-                if try_parent_urls:
-                    for parent_url in try_parent_urls:
-                        if rule.applies(url, parent_url):
-                            return False
-                else:
-                    if rule.applies(url):
-                        return False
+        if compiled_scope.blocks.applies(url, ssurt, try_parent_urls):
+            return False
 
         # honor accept rules
-        for accept_rule in self.scope["accepts"]:
-            rule = urlcanon.MatchRule(**accept_rule)
-            if try_parent_urls:
-                for parent_url in try_parent_urls:
+        if compiled_scope.accepts.applies(url, ssurt, try_parent_urls):
+            return True
+
+        # no decision if we reach here
+        return None
+
+    def parent_urls_for_scoping(self, parent_page):
+        """
+        Returns list of semantically canonicalized urls of `parent_page`, to be
+        checked against rules with `parent_url_regex`.
+        """
+        try_parent_urls = []
+        if parent_page:
+            try_parent_urls.append(urlcanon.semantic(parent_page.url))
+            if parent_page.redirect_url:
+                try_parent_urls.append(urlcanon.semantic(parent_page.redirect_url))
+        return try_parent_urls
+
+    def compiled_scope(self):
+        """
+        Returns `CompiledScope` for the current `self.scope`.
+
+        Recompiled only when the scope changes, which is to say when
+        `self.scope` is replaced, e.g. by `refresh()`, and its contents
+        differ from before, or when `_accept_ssurt_if_not_redundant()` adds a
+        rule.
+        """
+        if self._compiled_scope is None or self._compiled_scope_of is not self.scope:
+            self._compiled_scope = _compile_scope(
+                json.dumps(self.scope, sort_keys=True, separators=(",", ":"))
+            )
+            self._compiled_scope_of = self.scope
+        return self._compiled_scope
+
+
+class SsurtTrie:
+    """
+    Byte-wise prefix trie of ssurts, for finding out whether any ssurt in the
+    trie is a prefix of a given ssurt.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, ssurt):
+        node = self._root
+        for b in ssurt:
+            node = node.setdefault(b, {})
+        node[None] = True
+
+    def has_prefix_of(self, ssurt):
+        node = self._root
+        if None in node:
+            return True
+        for b in ssurt:
+            node = node.get(b)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class CompiledRules:
+    """
+    List of scope rules, with simple ssurt rules (`{"ssurt": ...}`) in a
+    `SsurtTrie` and the rest as `urlcanon.MatchRule`, whose regexes are
+    compiled once up front.
+    """
+
+    def __init__(self, rules):
+        self.trie = SsurtTrie()
+        self.match_rules = []
+        for rule in rules:
+            if set(rule.keys()) == {"ssurt"}:
+                self.trie.add(rule["ssurt"].encode("utf-8"))
+            else:
+                self.match_rules.append(urlcanon.MatchRule(**rule))
+
+    def applies(self, url, ssurt, parent_urls):
+        """
+        Returns true if any rule applies to `url` (with ssurt `ssurt`), with
+        any of `parent_urls` as parent url.
+        """
+        if self.trie.has_prefix_of(ssurt):
+            return True
+        for rule in self.match_rules:
+            if rule.parent_url_regex and parent_urls:
+                # only rules with parent_url_regex care about the parent url
+                for parent_url in parent_urls:
                     if rule.applies(url, parent_url):
                         return True
-            else:
-                if rule.applies(url):
-                    return True
+            elif rule.applies(url):
+                return True
+        return False
 
-        # no decision if we reach here
+
+class CompiledScope:
+    """
+    `Site.scope` compiled for `Site.accept_reject_or_neither()`.
+    """
+
+    def __init__(self, scope):
+        self.blocks = CompiledRules(scope.get("blocks", []))
+        self.accepts = CompiledRules(scope.get("accepts", []))
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_scope(scope_json):
+    # keyed by json so that sites with identical scope share, and refreshing
+    # a site from rethinkdb doesn't force a recompile
+    return CompiledScope(json.loads(scope_json))
+
+
+_HOP_RUN_RE = re.compile(r"([A-Za-z])([0-9]*)")
+
+
+def _hop_runs(hop_path):
+    runs = []
+    for hop, count in _HOP_RUN_RE.findall(hop_path or ""):
+        count = int(count) if count else 1
+        if runs and runs[-1][0] == hop:
+            runs[-1][1] += count
+        else:
+            runs.append([hop, count])
+    return runs
+
+
+def _format_hop_runs(runs):
+    return "".join(hop if count == 1 else "%s%s" % (hop, count) for hop, count in runs)
+
+
+def append_hop(hop_path, hop):
+    """
+    Returns `hop_path` with `hop`, e.g. "L", appended, in compact form.
+
+    Hop paths are stored run-length encoded, e.g. "L12" for twelve "L" hops,
+    so that they don't grow with every hop of deep crawls. A hop path without
+    counts, like the ones brozzler used to store, reads the same either way.
+    See `expand_hop_path()`.
+    """
+    runs = _hop_runs(hop_path)
+    if runs and runs[-1][0] == hop:
+        runs[-1][1] += 1
+    else:
+        runs.append([hop, 1])
+    return _format_hop_runs(runs)
+
+
+def expand_hop_path(hop_path):
+    """
+    Returns the full hop path, e.g. "LLLRL" for "L3RL", or `None` for `None`.
+    """
+    if hop_path is None:
         return None
+    return "".join(hop * count for hop, count in _hop_runs(hop_path))
 
 
 class Page(doublethink.Document):
@@ -433,3 +617,14 @@ class Page(doublethink.Document):
         if self._canon_hurl is None:
             self._canon_hurl = urlcanon.semantic(self.url)
         return str(self._canon_hurl)
+
+
+class PageOutlinks(doublethink.Document):
+    """
+    Outlinks of a page, `{"accepted": [...], "blocked": [...], "rejected":
+    [...]}`, kept apart from the page by
+    `RethinkDbFrontier(separate_outlinks=True)` so that page documents stay
+    small. Has the same id as the page.
+    """
+
+    table = "page_outlinks"
@@ -0,0 +1,98 @@
+"""
+brozzler/politeness.py - spaces out fetches from each host, across sites and
+brozzler workers
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import urllib.parse
+import doublethink
+import brozzler
+import brozzler.robots
+
+
+def host_key(url):
+    """
+    Returns the lowercased host and port, if any, of `url`.
+    """
+    netloc = urllib.parse.urlsplit(url).netloc
+    return netloc.rsplit("@", 1)[-1].lower()
+
+
+class HostPoliteness:
+    """
+    Spaces out page fetches from each host, by all sites and brozzler
+    workers, by at least `min_delay` seconds, or by the host's robots.txt
+    Crawl-delay, up to `max_crawl_delay`, if `honor_crawl_delay` is set.
+
+    Turns to fetch from each host are handed out in order by the rethinkdb
+    "hosts" table, see `RethinkDbFrontier.reserve_host_turn()`. A page whose
+    host has no turn free in the next `max_wait` seconds is put off until
+    then, so that the browser can get on with other pages.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(
+        self,
+        frontier,
+        min_delay=0,
+        honor_crawl_delay=True,
+        max_crawl_delay=30,
+        max_wait=60,
+    ):
+        self.frontier = frontier
+        self.min_delay = min_delay
+        self.honor_crawl_delay = honor_crawl_delay
+        self.max_crawl_delay = max_crawl_delay
+        self.max_wait = max_wait
+
+    def delay(self, site, url, proxy=None):
+        """
+        Returns the number of seconds to leave between fetches from the host
+        of `url`.
+        """
+        delay = self.min_delay
+        if self.honor_crawl_delay:
+            crawl_delay = brozzler.robots.crawl_delay(site, url, proxy)
+            if crawl_delay:
+                delay = max(delay, min(crawl_delay, self.max_crawl_delay))
+        return delay
+
+    def reserve_turn(self, site, page, proxy=None):
+        """
+        Reserves a turn to fetch `page` from its host.
+
+        Returns:
+            number of seconds to wait for the turn, or `None` if the page has
+            been put off because its host is busy
+        """
+        delay = self.delay(site, page.url, proxy)
+        if not delay:
+            return 0
+        host = host_key(page.url)
+        reserved, turn = self.frontier.reserve_host_turn(host, delay, self.max_wait)
+        if not reserved:
+            self.logger.info(
+                "putting off %s until %s, %s is busy (crawl delay %ss)",
+                page,
+                turn,
+                host,
+                delay,
+            )
+            self.frontier.defer_page(page, turn)
+            return None
+        return max(0.0, (turn - doublethink.utcnow()).total_seconds())
@@ -0,0 +1,118 @@
+"""
+brozzler/prober.py - finds out the content-type of pages before brozzling them
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import http.cookiejar
+import logging
+import posixpath
+import threading
+import urllib.parse
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+
+class ContentTypeProber:
+    """
+    Fetches response headers of urls, bypassing warcprox, over a shared pool
+    of keep-alive connections.
+
+    Remembers, per site, the content-type served for each file extension. Once
+    an extension has been seen `trust_after` times with the same content-type
+    and never with a different one, urls with that extension are not probed
+    anymore.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, timeout=10, pool_maxsize=10, trust_after=2):
+        self.timeout = timeout
+        self.trust_after = trust_after
+        self._session = requests.Session()
+        self._session.verify = False
+        # don't carry cookies from one site to another
+        self._session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=100, pool_maxsize=pool_maxsize
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # {site_id: {extension: [content_type, count]}}, content_type is None
+        # if the extension has been seen with different content-types
+        self._content_types = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _extension(url):
+        path = urllib.parse.urlsplit(url).path
+        return posixpath.splitext(path)[1].lower() or None
+
+    def _cached_content_type(self, site, url):
+        extension = self._extension(url)
+        if not extension:
+            return None
+        with self._lock:
+            entry = self._content_types.get(site.id, {}).get(extension)
+        if entry and entry[0] and entry[1] >= self.trust_after:
+            return entry[0]
+        return None
+
+    def _note_content_type(self, site, url, content_type):
+        extension = self._extension(url)
+        if not extension or not content_type:
+            return
+        content_type = content_type.split(";")[0].strip().lower()
+        with self._lock:
+            entries = self._content_types.setdefault(site.id, {})
+            entry = entries.setdefault(extension, [content_type, 0])
+            if entry[0] == content_type:
+                entry[1] += 1
+            else:
+                entry[0] = None
+
+    def probe(self, site, url):
+        """
+        Returns response headers of `url`, or only its content-type if known
+        from the extension, or an empty dict if the request fails.
+        """
+        content_type = self._cached_content_type(site, url)
+        if content_type:
+            self.logger.debug("content-type of %s is probably %s", url, content_type)
+            return CaseInsensitiveDict({"content-type": content_type})
+
+        try:
+            with self._session.head(
+                url, allow_redirects=True, timeout=self.timeout
+            ) as r:
+                headers = r.headers
+            if r.status_code >= 400 or "content-type" not in headers:
+                # some servers don't do HEAD right; requests' stream=True
+                # defers downloading the body of the response
+                with self._session.get(url, stream=True, timeout=self.timeout) as r:
+                    headers = r.headers
+        except requests.exceptions.RequestException as e:
+            self.logger.warning("Failed to get headers for %s: %s", url, e)
+            return {}
+
+        self._note_content_type(site, url, headers.get("content-type"))
+        return headers
+
+    def forget_site(self, site):
+        with self._lock:
+            self._content_types.pop(site.id, None)
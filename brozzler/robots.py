@@ -22,15 +22,36 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import base64
+import collections
+import concurrent.futures
+import hashlib
 import json
 import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+import weakref
 import brozzler
 import reppy
 import reppy.cache
 import reppy.parser
 import requests
 
-__all__ = ["is_permitted_by_robots"]
+__all__ = [
+    "is_permitted_by_robots",
+    "crawl_delay",
+    "RobotsCache",
+    "DirectoryRobotsStore",
+    "RethinkDbRobotsStore",
+    "configure_robots_cache",
+    "is_permitted_by_cached_robots",
+    "check_robots",
+    "filter_permitted_by_robots",
+    "prefetch_robots",
+]
 
 # monkey-patch reppy to do substring user-agent matching, see top of file
 reppy.Utility.short_user_agent = lambda strng: strng
@@ -65,64 +86,447 @@ class _SessionRaiseOn420(requests.Session):
             return res
 
 
-_robots_caches = {}  # {site_id:reppy.cache.RobotsCache}
+class RobotsCache:
+    """
+    Bounded cache of parsed robots.txt rules, keyed by scheme, host and port,
+    user agent and proxy, so that sites on the same host share one fetch.
+
+    Through a proxy, the warc-prefix and stats buckets of the site's
+    Warcprox-Meta are part of the key too. They decide which warcs
+    warcprox writes robots.txt to and which stats it counts against, so
+    every crawl archives its own copy of robots.txt.
+
+    Rules expire when the robots.txt response headers say, as with reppy, but
+    no later than `max_ttl` seconds after being fetched. Beyond `max_entries`,
+    the least recently used rules are evicted.
+
+    With a `store`, see `DirectoryRobotsStore` and `RethinkDbRobotsStore`,
+    fetched robots.txt are also kept outside of the process, so that they
+    survive restarts and, with rethinkdb, are shared by brozzler workers.
+
+    Failures to fetch robots.txt are not cached.
+
+    `prefetch()` fetches robots.txt in the background, in up to
+    `prefetch_threads` threads.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
 
+    def __init__(
+        self, max_entries=10000, max_ttl=24 * 60 * 60, store=None, prefetch_threads=8
+    ):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.store = store
+        self.prefetch_threads = prefetch_threads
+        self._rules = collections.OrderedDict()  # {key: reppy.parser.Rules}
+        self._sessions = {}  # {proxy: _SessionRaiseOn420}
+        self._prefetching = set()  # keys
+        self._prefetch_executor = None
+        self._lock = threading.Lock()
 
-def _robots_cache(site, proxy=None):
-    if not site.id in _robots_caches:
-        req_sesh = _SessionRaiseOn420()
-        req_sesh.verify = False  # ignore cert errors
-        if proxy:
-            proxie = "http://%s" % proxy
-            req_sesh.proxies = {"http": proxie, "https": proxie}
-        if site.extra_headers():
-            req_sesh.headers.update(site.extra_headers())
+    @staticmethod
+    def key(url, user_agent=None, proxy=None, warcprox_routing=None):
+        split = urllib.parse.urlsplit(url)
+        return (
+            split.scheme.lower(),
+            split.netloc.lower(),
+            user_agent,
+            proxy,
+            warcprox_routing,
+        )
+
+    @classmethod
+    def site_key(cls, site, url, proxy=None):
+        """
+        Returns the key of the robots.txt rules for `url` for `site`.
+        """
+        warcprox_routing = None
+        if proxy and site.warcprox_meta:
+            warcprox_routing = json.dumps(
+                {
+                    "warc-prefix": site.warcprox_meta.get("warc-prefix"),
+                    "buckets": (site.warcprox_meta.get("stats") or {}).get("buckets"),
+                },
+                sort_keys=True,
+            )
+        return cls.key(url, site.user_agent, proxy, warcprox_routing)
+
+    def _session(self, proxy):
+        with self._lock:
+            if not proxy in self._sessions:
+                req_sesh = _SessionRaiseOn420()
+                req_sesh.verify = False  # ignore cert errors
+                if proxy:
+                    proxie = "http://%s" % proxy
+                    req_sesh.proxies = {"http": proxie, "https": proxie}
+                self._sessions[proxy] = req_sesh
+            return self._sessions[proxy]
+
+    def _fetch(self, site, url, proxy):
+        """
+        Returns a dict with the url, status code and content of the robots.txt
+        for `url`, and when it expires, as seconds since the epoch.
+        """
+        robots_url = reppy.Utility.roboturl(url)
+        headers = dict(site.extra_headers() or {})
         if site.user_agent:
-            req_sesh.headers["User-Agent"] = site.user_agent
-        _robots_caches[site.id] = reppy.cache.RobotsCache(
-            session=req_sesh, disallow_forbidden=False
+            headers["User-Agent"] = site.user_agent
+        res = self._session(proxy).get(robots_url, headers=headers)
+        ttl = reppy.Utility.get_ttl(res.headers, reppy.cache.RobotsCache.default_ttl)
+        ttl = min(self.max_ttl, max(reppy.cache.RobotsCache.min_ttl, ttl))
+        return {
+            "url": robots_url,
+            "status": res.status_code,
+            "content": res.content,
+            "expires": time.time() + ttl,
+        }
+
+    @staticmethod
+    def _parse(robots):
+        return reppy.parser.Rules(
+            robots["url"],
+            robots["status"],
+            robots["content"],
+            robots["expires"],
+            disallow_forbidden=False,
         )
 
-    return _robots_caches[site.id]
+    def _load(self, key):
+        try:
+            robots = self.store.get(key)
+            if robots and robots["expires"] > time.time():
+                return self._parse(robots)
+        except Exception as e:
+            self.logger.warning("problem loading robots.txt for %s: %s", key, e)
+        return None
 
+    def _cached(self, key):
+        # call with self._lock held
+        rules = self._rules.get(key)
+        if rules and rules.expired:
+            del self._rules[key]
+            rules = None
+        if rules:
+            self._rules.move_to_end(key)
+        return rules
 
-def is_permitted_by_robots(site, url, proxy=None):
+    def cached_rules(self, site, url, proxy=None):
+        """
+        Returns the robots.txt rules for `url` if they are in memory, without
+        fetching anything, otherwise `None`.
+        """
+        with self._lock:
+            return self._cached(self.site_key(site, url, proxy))
+
+    def prefetch(self, site, url, proxy=None):
+        """
+        Fetches the robots.txt rules for `url` in the background, unless they
+        are in memory or already being fetched.
+        """
+        key = self.site_key(site, url, proxy)
+        with self._lock:
+            if key in self._prefetching or self._cached(key):
+                return
+            if not self._prefetch_executor:
+                self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.prefetch_threads,
+                    thread_name_prefix="RobotsPrefetch",
+                )
+            self._prefetching.add(key)
+        self._prefetch_executor.submit(self._prefetch, site, url, proxy, key)
+
+    def _prefetch(self, site, url, proxy, key):
+        try:
+            self.rules(site, url, proxy)
+        except Exception as e:
+            # will be fetched again when needed, and dealt with then
+            self.logger.info("problem prefetching robots.txt for %s: %r", url, e)
+        finally:
+            with self._lock:
+                self._prefetching.discard(key)
+
+    def rules(self, site, url, proxy=None):
+        """
+        Returns the robots.txt rules for `url`, as a `reppy.parser.Rules`,
+        fetching robots.txt if need be.
+
+        Raises:
+            brozzler.ReachedLimit: if warcprox responded with 420 Reached Limit
+            requests.exceptions.ProxyError: if the proxy is down
+            whatever else goes wrong fetching or parsing robots.txt
+        """
+        key = self.site_key(site, url, proxy)
+        with self._lock:
+            rules = self._cached(key)
+            if rules:
+                return rules
+
+        rules = self._load(key) if self.store else None
+        if not rules:
+            robots = self._fetch(site, url, proxy)
+            rules = self._parse(robots)
+            if self.store:
+                try:
+                    self.store.put(key, robots)
+                except Exception as e:
+                    self.logger.warning("problem storing robots.txt for %s: %s", key, e)
+
+        with self._lock:
+            self._rules[key] = rules
+            self._rules.move_to_end(key)
+            while len(self._rules) > self.max_entries:
+                self._rules.popitem(last=False)
+        return rules
+
+    def __len__(self):
+        return len(self._rules)
+
+
+def _store_id(key):
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+class DirectoryRobotsStore:
     """
-    Checks if `url` is permitted by robots.txt.
+    Keeps fetched robots.txt for `RobotsCache` in files in a local directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, _store_id(key)), "r") as f:
+                robots = json.load(f)
+        except FileNotFoundError:
+            return None
+        robots["content"] = base64.b64decode(robots["content"])
+        return robots
+
+    def put(self, key, robots):
+        robots = dict(robots, content=base64.b64encode(robots["content"]).decode())
+        path = os.path.join(self.path, _store_id(key))
+        # write and rename so that readers never see a partial file
+        with open(path + ".tmp", "w") as f:
+            json.dump(robots, f)
+        os.replace(path + ".tmp", path)
+
+
+class RethinkDbRobotsStore:
+    """
+    Keeps fetched robots.txt for `RobotsCache` in the rethinkdb table
+    "robots", shared by all brozzler workers.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, rr, table="robots"):
+        self.rr = rr
+        self.table = table
+        tables = self.rr.table_list().run()
+        if not self.table in tables:
+            self.logger.info(
+                "creating rethinkdb table %r in database %r", self.table, rr.dbname
+            )
+            self.rr.table_create(self.table).run()
+
+    def get(self, key):
+        return self.rr.table(self.table).get(_store_id(key)).run()
+
+    def put(self, key, robots):
+        self.rr.table(self.table).insert(
+            dict(robots, id=_store_id(key)), conflict="replace"
+        ).run()
+
+
+_robots_cache = RobotsCache()
+
+
+def configure_robots_cache(max_entries=10000, store=None):
+    """
+    Replaces the robots.txt cache used by `is_permitted_by_robots()` and
+    `crawl_delay()`.
+    """
+    global _robots_cache
+    _robots_cache = RobotsCache(max_entries=max_entries, store=store)
+
+
+class _AgentMatcher:
+    """
+    Evaluates the robots.txt rules of one user agent, like
+    `reppy.parser.Agent.allowed()`, but with all the rules compiled into a
+    single regular expression.
+
+    The rules are tried longest first, and an alternation matches its first
+    matching alternative, so the capture group that matched is the rule that
+    wins. Of rules of the same length, allow wins over disallow.
+    """
+
+    def __init__(self, agent):
+        allowances = sorted(agent.allowances, key=lambda a: (a[0], a[2]), reverse=True)
+        self._allowed = [a[2] for a in allowances]
+        self._regex = (
+            re.compile("|".join("(%s)" % a[1].pattern for a in allowances))
+            if allowances
+            else None
+        )
+
+    def allowed(self, url):
+        if not self._regex:
+            return True
+        path = urllib.parse.unquote(
+            reppy.parser.Agent.extract_path(url).replace("%2f", "%252f")
+        )
+        if path == "/robots.txt":
+            return True
+        m = self._regex.match(path)
+        return self._allowed[m.lastindex - 1] if m else True
+
+
+_agent_matchers = weakref.WeakKeyDictionary()  # {reppy.parser.Agent: _AgentMatcher}
+
+
+def _agent_matcher(rules, user_agent):
+    agent = rules[user_agent]
+    if agent is None:
+        return None
+    matcher = _agent_matchers.get(agent)
+    if not matcher:
+        matcher = _agent_matchers[agent] = _AgentMatcher(agent)
+    return matcher
+
+
+def check_robots(site, urls, proxy=None, wait=True):
+    """
+    Checks `urls` against robots.txt in bulk. The urls are grouped by host,
+    and rules are looked up and compiled once per host, see `_AgentMatcher`.
 
     Treats any kind of error fetching robots.txt as "allow all". See
     http://builds.archive.org/javadoc/heritrix-3.x-snapshot/org/archive/modules/net/CrawlServer.html#updateRobots(org.archive.modules.CrawlURI)
     for some background on that policy.
 
+    Args:
+        wait: if false, robots.txt rules that are not in memory are fetched
+            in the background, and urls of those hosts are left undecided
+
     Returns:
-        bool: `True` if `site.ignore_robots` is set, or if `url` is permitted
-            by robots.txt, `False` otherwise
+        dict of {url: verdict}, verdict being `True` if `site.ignore_robots`
+        is set or if the url is permitted by robots.txt, `False` if it is
+        not, `None` if undecided
 
     Raises:
         brozzler.ReachedLimit: if warcprox responded with 420 Reached Limit
-        requests.exceptions.ProxyError: if the proxy is down
+        brozzler.ProxyError: if the proxy is down
     """
     if site.ignore_robots:
-        return True
+        return {url: True for url in urls}
 
-    try:
-        result = _robots_cache(site, proxy).allowed(url, site.user_agent or "brozzler")
-        return result
-    except Exception as e:
-        if isinstance(e, reppy.exceptions.ServerError) and isinstance(
-            e.args[0], brozzler.ReachedLimit
-        ):
-            raise e.args[0]
-        elif hasattr(e, "args") and isinstance(
-            e.args[0], requests.exceptions.ProxyError
-        ):
-            # reppy has wrapped an exception that we want to bubble up
+    user_agent = site.user_agent or "brozzler"
+    by_host = collections.defaultdict(list)
+    for url in urls:
+        by_host[_robots_cache.site_key(site, url, proxy)].append(url)
+
+    verdicts = {}
+    for host_urls in by_host.values():
+        try:
+            if wait:
+                rules = _robots_cache.rules(site, host_urls[0], proxy)
+            else:
+                rules = _robots_cache.cached_rules(site, host_urls[0], proxy)
+                if not rules:
+                    _robots_cache.prefetch(site, host_urls[0], proxy)
+                    verdicts.update((url, None) for url in host_urls)
+                    continue
+            matcher = _agent_matcher(rules, user_agent)
+            for url in host_urls:
+                verdicts[url] = matcher.allowed(url) if matcher else True
+        except brozzler.ReachedLimit:
+            raise
+        except requests.exceptions.ProxyError as e:
             raise brozzler.ProxyError(e)
-        else:
+        except Exception as e:
             logging.warning(
                 "returning true (permitted) after problem fetching "
                 "robots.txt for %r: %r",
-                url,
+                host_urls[0],
                 e,
             )
-            return True
+            verdicts.update((url, True) for url in host_urls)
+    return verdicts
+
+
+def filter_permitted_by_robots(site, urls, proxy=None):
+    """
+    Returns the urls among `urls` permitted by robots.txt, in order.
+
+    See `check_robots()`.
+    """
+    verdicts = check_robots(site, urls, proxy)
+    return [url for url in urls if verdicts[url]]
+
+
+def is_permitted_by_robots(site, url, proxy=None):
+    """
+    Checks if `url` is permitted by robots.txt.
+
+    Treats any kind of error fetching robots.txt as "allow all". See
+    http://builds.archive.org/javadoc/heritrix-3.x-snapshot/org/archive/modules/net/CrawlServer.html#updateRobots(org.archive.modules.CrawlURI)
+    for some background on that policy.
+
+    Returns:
+        bool: `True` if `site.ignore_robots` is set, or if `url` is permitted
+            by robots.txt, `False` otherwise
+
+    Raises:
+        brozzler.ReachedLimit: if warcprox responded with 420 Reached Limit
+        brozzler.ProxyError: if the proxy is down
+    """
+    return check_robots(site, [url], proxy)[url]
+
+
+def is_permitted_by_cached_robots(site, url, proxy=None):
+    """
+    Like `is_permitted_by_robots()` but never waits on fetching robots.txt.
+
+    Returns:
+        bool or None: `True` if `site.ignore_robots` is set, or if `url` is
+            permitted by robots.txt, `False` if it is not, `None` if the
+            robots.txt rules are not in memory, in which case robots.txt is
+            fetched in the background
+    """
+    return check_robots(site, [url], proxy, wait=False)[url]
+
+
+def prefetch_robots(site, url, proxy=None):
+    """
+    Fetches robots.txt for `url` in the background, so that it is ready by
+    the time `is_permitted_by_robots()` needs it.
+    """
+    if not site.ignore_robots:
+        _robots_cache.prefetch(site, url, proxy)
+
+
+def crawl_delay(site, url, proxy=None):
+    """
+    Returns the robots.txt Crawl-delay, in seconds, that applies to `url` for
+    `site.user_agent`.
+
+    Returns:
+        float or None: `None` if `site.ignore_robots` is set, if robots.txt
+            has no Crawl-delay for the user agent, or if there was a problem
+            fetching robots.txt
+    """
+    if site.ignore_robots:
+        return None
+
+    try:
+        return _robots_cache.rules(site, url, proxy).delay(
+            site.user_agent or "brozzler"
+        )
+    except Exception as e:
+        # includes AttributeError if robots.txt has no rules for the user
+        # agent at all
+        logging.debug("no crawl-delay for %r: %r", url, e)
+        return None
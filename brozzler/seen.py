@@ -0,0 +1,133 @@
+"""
+brozzler/seen.py - per-site cache of ids of pages known to be in the frontier
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Plain bloom filter sized for `capacity` items at false positive rate
+    `error_rate`.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, see Kirsch and Mitzenmacher, "Less Hashing, Same
+        # Performance: Building a Better Bloom Filter"
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key)
+        )
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that grows as items are added, by adding progressively
+    larger and stricter plain bloom filters, keeping the overall false
+    positive rate under `error_rate`. See Almeida et al, "Scalable Bloom
+    Filters".
+    """
+
+    GROWTH = 2
+    TIGHTENING = 0.9
+
+    def __init__(self, initial_capacity=100000, error_rate=0.001):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self._filters = []
+
+    def add(self, key):
+        if key in self:
+            return
+        if not self._filters or self._filters[-1].count >= self._filters[-1].capacity:
+            n = len(self._filters)
+            self._filters.append(
+                BloomFilter(
+                    self.initial_capacity * self.GROWTH**n,
+                    self.error_rate * (1 - self.TIGHTENING) * self.TIGHTENING**n,
+                )
+            )
+        self._filters[-1].add(key)
+
+    def __contains__(self, key):
+        return any(key in f for f in self._filters)
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+
+class SeenPages:
+    """
+    Cache of ids of pages of a site that are known to be in the frontier.
+
+    Ids in the LRU are certainly known. If there is a bloom filter and it was
+    fed every page id of the site (see `RethinkDbFrontier.warm_seen_pages()`),
+    an id that is not in the bloom filter is certainly new. Anything else has
+    to be looked up.
+    """
+
+    def __init__(self, lru_size=100000, bloom=True):
+        self.lru_size = lru_size
+        self._lru = collections.OrderedDict()
+        self._bloom = ScalableBloomFilter() if bloom else None
+        self.complete = False
+
+    def add(self, page_id):
+        self._lru[page_id] = True
+        self._lru.move_to_end(page_id)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+        if self._bloom is not None:
+            self._bloom.add(page_id)
+
+    def classify(self, page_id):
+        """
+        Returns `True` if `page_id` is certainly known, `False` if it is
+        certainly new, `None` if it needs to be looked up.
+        """
+        if page_id in self._lru:
+            self._lru.move_to_end(page_id)
+            return True
+        if self.complete and self._bloom is not None and page_id not in self._bloom:
+            return False
+        return None
+
+    def __len__(self):
+        return len(self._bloom) if self._bloom is not None else len(self._lru)
@@ -0,0 +1,139 @@
+"""
+brozzler/warcprox_client.py - sends WARCPROX_WRITE_RECORD requests to warcprox
+over persistent connections
+
+Copyright (C) 2024 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import http.client
+import logging
+import threading
+import urllib.request
+import brozzler
+
+
+class WarcproxClient:
+    """
+    Sends WARCPROX_WRITE_RECORD requests, keeping connections to each warcprox
+    alive for reuse.
+    """
+
+    logger = logging.getLogger(__module__ + "." + __qualname__)
+
+    def __init__(self, timeout=600, max_idle_per_address=4):
+        self.timeout = timeout
+        self.max_idle_per_address = max_idle_per_address
+        self._idle = collections.defaultdict(list)  # {address: [connection]}
+        self._lock = threading.Lock()
+
+    def _connection(self, warcprox_address):
+        """
+        Returns tuple (connection, whether it is a reused one).
+        """
+        with self._lock:
+            if self._idle[warcprox_address]:
+                return self._idle[warcprox_address].pop(), True
+        host, port = warcprox_address.rsplit(":", 1)
+        return http.client.HTTPConnection(host, int(port), timeout=self.timeout), False
+
+    def _release(self, warcprox_address, connection):
+        with self._lock:
+            if len(self._idle[warcprox_address]) < self.max_idle_per_address:
+                self._idle[warcprox_address].append(connection)
+                return
+        connection.close()
+
+    def _send(self, warcprox_address, url, headers, payload):
+        connection, reused = self._connection(warcprox_address)
+        try:
+            connection.request(
+                "WARCPROX_WRITE_RECORD", url, body=payload, headers=headers
+            )
+            response = connection.getresponse()
+            # read the body so that the connection can be reused
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if reused and self._rewind(payload):
+                # warcprox probably closed the idle connection, try a fresh one
+                return self._send(warcprox_address, url, headers, payload)
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(warcprox_address, connection)
+        return response
+
+    @staticmethod
+    def _rewind(payload):
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            return True
+        try:
+            payload.seek(0)
+            return True
+        except Exception:
+            return False
+
+    def write_record(
+        self,
+        warcprox_address,
+        url,
+        warc_type,
+        content_type,
+        payload,
+        extra_headers=None,
+    ):
+        """
+        Asks warcprox at `warcprox_address` to write a record.
+
+        Returns:
+            tuple (`urllib.request.Request` describing the request sent,
+            `http.client.HTTPResponse` or `None` if warcprox responded with
+            an error status)
+
+        Raises:
+            brozzler.ProxyError: if warcprox can't be reached
+        """
+        headers = {"Content-Type": content_type, "WARC-Type": warc_type, "Host": "N/A"}
+        if extra_headers:
+            headers.update(extra_headers)
+        request = urllib.request.Request(
+            url, method="WARCPROX_WRITE_RECORD", headers=headers
+        )
+        try:
+            response = self._send(warcprox_address, url, headers, payload)
+        except (http.client.HTTPException, OSError) as e:
+            raise brozzler.ProxyError(
+                "proxy error on WARCPROX_WRITE_RECORD %s" % url
+            ) from e
+        if response.status != 204:
+            self.logger.warning(
+                'got "%s %s" response on warcprox '
+                "WARCPROX_WRITE_RECORD request (expected 204)",
+                response.status,
+                response.reason,
+            )
+            if response.status >= 400:
+                return request, None
+        return request, response
+
+    def close(self):
+        """Closes idle connections."""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
@@ -21,11 +21,17 @@ limitations under the License.
 import logging
 import brozzler
 import brozzler.browser
+import brozzler.frontier
+import brozzler.politeness
+import brozzler.prober
+import brozzler.warcprox_client
+import concurrent.futures
 import datetime
+import multiprocessing
 import threading
 import time
-import urllib.request
 import json
+import os
 import PIL.Image
 import io
 import socket
@@ -42,6 +48,183 @@ from . import ydl
 r = rdb.RethinkDB()
 
 
+class _SiteSession:
+    """
+    State shared by the tabs brozzling pages of one site at the same time,
+    see `BrozzlerWorker.brozzle_site()`.
+    """
+
+    def __init__(self, page_queue):
+        self.page_queue = page_queue
+        # claiming and completing pages and scheduling outlinks happen with
+        # this lock held, so that tabs don't clobber each other's page updates
+        self.lock = threading.RLock()
+        # notified when a tab is done with a page, or the session is stopping
+        self.changed = threading.Condition(self.lock)
+        self.in_flight = {}  # {page_id: Page} being brozzled
+        self.failures = {}  # {thread: (exception, page being brozzled)}
+        self.stopping = threading.Event()
+        self.tab_threads = []
+
+    def claim(self, timeout=10):
+        """
+        Claims the next page to brozzle. Must be called with `self.lock` held.
+
+        If there is nothing to claim but other tabs are brozzling pages, whose
+        outlinks may well be new pages to claim, waits up to `timeout` seconds
+        for one of them to be done.
+
+        Returns:
+            the page, or `None` after waiting, so that the caller can check
+            the site's time limit and stop request before trying again
+
+        Raises:
+            brozzler.NothingToClaim: if there is nothing to claim and no tab
+                is brozzling a page
+        """
+        try:
+            page = self.page_queue.claim()
+        except brozzler.NothingToClaim:
+            if not self.in_flight or self.stopping.is_set():
+                raise
+            self.changed.wait(timeout)
+            return None
+        self.in_flight[page.id] = page
+        return page
+
+    def done(self, page):
+        """
+        Notes that the calling tab is done with `page`. Must be called with
+        `self.lock` held.
+        """
+        del self.in_flight[page.id]
+        self.changed.notify_all()
+
+    def stop(self):
+        with self.lock:
+            self.stopping.set()
+            self.changed.notify_all()
+
+    def claimed_pages(self, page):
+        """
+        Returns dict of {page_id: Page} of pages claimed by this session,
+        other than `page`, for `RethinkDbFrontier.scope_and_schedule_outlinks()`.
+        """
+        pages = self.page_queue.pages
+        pages.update(self.in_flight)
+        pages.pop(page.id, None)
+        return pages
+
+    def failed_page(self):
+        """
+        Returns the page the current thread failed on, or else the page some
+        tab failed on, or `None`.
+        """
+        failure = self.failures.get(threading.current_thread())
+        if not failure and self.failures:
+            failure = next(iter(self.failures.values()))
+        return failure[1] if failure else None
+
+
+class _ClaimBackoff:
+    """
+    Keeps track of when to try claiming sites next.
+
+    After each attempt that finds nothing to claim, the wait doubles, from
+    `initial` up to `maximum` seconds, and is randomized within its upper
+    half so that idle workers don't query rethinkdb in lockstep. Hearing that
+    a site is becoming claimable, see `work_available()`, brings the next
+    attempt forward, give or take up to `jitter` seconds.
+    """
+
+    def __init__(self, initial=1.0, maximum=30.0, jitter=2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self._failures = 0
+        self._next_attempt = 0.0
+        self._lock = threading.Lock()
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._next_attempt = 0.0
+
+    def nothing_to_claim(self):
+        with self._lock:
+            delay = min(self.maximum, self.initial * 2 ** min(self._failures, 16))
+            self._failures += 1
+            self._next_attempt = time.time() + random.uniform(delay / 2, delay)
+
+    def work_available(self, claimable_at):
+        """
+        Args:
+            claimable_at: when a site becomes claimable, in seconds since the
+                epoch
+        """
+        with self._lock:
+            self._failures = 0
+            self._next_attempt = min(
+                self._next_attempt, claimable_at + random.uniform(0, self.jitter)
+            )
+
+    def wait_time(self):
+        """
+        Returns the number of seconds until the next attempt is due.
+        """
+        return max(0.0, self._next_attempt - time.time())
+
+
+def thumb_jpeg(full_jpeg, thumb_width=300):
+    """
+    Returns JPEG thumbnail of JPEG image `full_jpeg`.
+
+    Asks PIL to decode the JPEG at reduced scale when that still leaves
+    enough pixels for the thumbnail, which is much faster for huge full page
+    screenshots.
+    """
+    img = PIL.Image.open(io.BytesIO(full_jpeg))
+    thumb_height = (thumb_width / img.size[0]) * img.size[1]
+    img.draft("RGB", (thumb_width, thumb_height))
+    img.thumbnail((thumb_width, thumb_height))
+    out = io.BytesIO()
+    img.save(out, "jpeg", quality=95)
+    return out.getvalue()
+
+
+def embedded_video(chrome_msg):
+    """
+    Returns a description of the video, for `page.videos`, if
+    Network.responseReceived message `chrome_msg` is the response to a
+    request for one, otherwise `None`.
+    """
+    if (
+        "params" in chrome_msg
+        and "response" in chrome_msg["params"]
+        and "mimeType" in chrome_msg["params"]["response"]
+        and chrome_msg["params"]["response"].get("mimeType", "").startswith("video/")
+        # skip manifests of DASH segmented video -
+        # see https://github.com/internetarchive/brozzler/pull/70
+        and chrome_msg["params"]["response"]["mimeType"] != "video/vnd.mpeg.dash.mpd"
+        and chrome_msg["params"]["response"].get("status") in (200, 206)
+    ):
+        video = {
+            "blame": "browser",
+            "url": chrome_msg["params"]["response"].get("url"),
+            "response_code": chrome_msg["params"]["response"]["status"],
+            "content-type": chrome_msg["params"]["response"]["mimeType"],
+        }
+        response_headers = CaseInsensitiveDict(
+            chrome_msg["params"]["response"]["headers"]
+        )
+        if "content-length" in response_headers:
+            video["content-length"] = int(response_headers["content-length"])
+        if "content-range" in response_headers:
+            video["content-range"] = response_headers["content-range"]
+        return video
+    return None
+
+
 class BrozzlerWorker:
     logger = logging.getLogger(__module__ + "." + __qualname__)
 
@@ -51,6 +234,8 @@ class BrozzlerWorker:
     # cluster with slow rethinkdb.
     HEARTBEAT_INTERVAL = 200.0
     SITE_SESSION_MINUTES = 15
+    # longest the main loop sleeps, so that heartbeats go out on time
+    MAX_IDLE_WAIT = 10.0
 
     def __init__(
         self,
@@ -58,6 +243,11 @@ class BrozzlerWorker:
         service_registry=None,
         skip_av_seeds=None,
         max_browsers=1,
+        warm_browsers=False,
+        page_claim_batch_size=1,
+        seen_pages_cache=False,
+        tabs_per_site=1,
+        thumbnail_processes=None,
         chrome_exe="chromium-browser",
         warcprox_auto=False,
         proxy=None,
@@ -71,6 +261,8 @@ class BrozzlerWorker:
         behavior_timeout=900,
         extract_outlinks_timeout=60,
         download_throughput=-1,
+        min_host_delay=0,
+        honor_crawl_delay=False,
         stealth=False,
         window_height=900,
         window_width=1400,
@@ -82,6 +274,9 @@ class BrozzlerWorker:
         self._service_registry = service_registry
         self._skip_av_seeds = skip_av_seeds
         self._max_browsers = max_browsers
+        self._page_claim_batch_size = page_claim_batch_size
+        self._seen_pages_cache = seen_pages_cache
+        self._tabs_per_site = tabs_per_site
 
         self._warcprox_auto = warcprox_auto
         self._proxy = proxy
@@ -97,6 +292,12 @@ class BrozzlerWorker:
         self._behavior_timeout = behavior_timeout
         self._extract_outlinks_timeout = extract_outlinks_timeout
         self._download_throughput = download_throughput
+        if min_host_delay or honor_crawl_delay:
+            self._politeness = brozzler.politeness.HostPoliteness(
+                frontier, min_delay=min_host_delay, honor_crawl_delay=honor_crawl_delay
+            )
+        else:
+            self._politeness = None
         self._window_height = window_height
         self._window_width = window_width
         self._stealth = stealth
@@ -105,14 +306,35 @@ class BrozzlerWorker:
         self._env = env
 
         self._browser_pool = brozzler.browser.BrowserPool(
-            max_browsers, chrome_exe=chrome_exe, ignore_cert_errors=True
+            max_browsers,
+            warm=warm_browsers,
+            chrome_exe=chrome_exe,
+            ignore_cert_errors=True,
         )
         self._browsing_threads = set()
         self._browsing_threads_lock = threading.Lock()
+        self._content_type_prober = brozzler.prober.ContentTypeProber(
+            pool_maxsize=max_browsers
+        )
+        self._warcprox_client = brozzler.warcprox_client.WarcproxClient()
+        # screenshots are thumbnailed and written to warcprox in the
+        # background, thumbnailing in separate processes
+        self._screenshot_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_browsers, thread_name_prefix="ScreenshotWriter"
+        )
+        self._thumbnail_processes = thumbnail_processes or min(
+            max_browsers, os.cpu_count() or 1
+        )
+        self._thumbnail_executor = None
+        self._screenshot_lock = threading.Lock()
 
         self._thread = None
         self._start_stop_lock = threading.Lock()
         self._shutdown = threading.Event()
+        # wakes up the main loop when a browser frees up, when a site becomes
+        # claimable, and on shutdown
+        self._wakeup = threading.Event()
+        self._claim_backoff = _ClaimBackoff()
 
         # set up metrics
         if self._metrics_port > 0:
@@ -205,54 +427,73 @@ class BrozzlerWorker:
         payload,
         extra_headers=None,
     ):
-        headers = {"Content-Type": content_type, "WARC-Type": warc_type, "Host": "N/A"}
-        if extra_headers:
-            headers.update(extra_headers)
-        request = urllib.request.Request(
-            url, method="WARCPROX_WRITE_RECORD", headers=headers, data=payload
+        return self._warcprox_client.write_record(
+            warcprox_address,
+            url,
+            warc_type,
+            content_type,
+            payload,
+            extra_headers=extra_headers,
         )
 
-        # XXX setting request.type="http" is a hack to stop urllib from trying
-        # to tunnel if url is https
-        request.type = "http"
-        request.set_proxy(warcprox_address, "http")
+    def thumb_jpeg(self, full_jpeg):
+        """Create JPEG thumbnail."""
+        return thumb_jpeg(full_jpeg)
 
-        try:
-            with urllib.request.urlopen(request, timeout=600) as response:
-                if response.getcode() != 204:
-                    self.logger.warning(
-                        'got "%s %s" response on warcprox '
-                        "WARCPROX_WRITE_RECORD request (expected 204)",
-                        response.getcode(),
-                        response.reason,
-                    )
-                return request, response
-        except urllib.error.HTTPError as e:
-            self.logger.warning(
-                'got "%s %s" response on warcprox '
-                "WARCPROX_WRITE_RECORD request (expected 204)",
-                e.getcode(),
-                e.info(),
+    def _thumbnail_pool(self):
+        with self._screenshot_lock:
+            if not self._thumbnail_executor:
+                # spawn rather than fork, we have threads
+                self._thumbnail_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self._thumbnail_processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._thumbnail_executor
+
+    def _log_pending_failure(self, future):
+        """
+        Done callback for records being sent, and the like, while browsing a
+        page that went wrong.
+        """
+        if not future.cancelled() and future.exception():
+            self.logger.error(
+                "problem finishing work started while browsing",
+                exc_info=future.exception(),
             )
-            return request, None
-        except urllib.error.URLError as e:
-            raise brozzler.ProxyError(
-                "proxy error on WARCPROX_WRITE_RECORD %s" % url
-            ) from e
-        except ConnectionError as e:
-            raise brozzler.ProxyError(
-                "proxy error on WARCPROX_WRITE_RECORD %s" % url
-            ) from e
 
-    def thumb_jpeg(self, full_jpeg):
-        """Create JPEG thumbnail."""
-        img = PIL.Image.open(io.BytesIO(full_jpeg))
-        thumb_width = 300
-        thumb_height = (thumb_width / img.size[0]) * img.size[1]
-        img.thumbnail((thumb_width, thumb_height))
-        out = io.BytesIO()
-        img.save(out, "jpeg", quality=95)
-        return out.getbuffer()
+    def _write_screenshot_records(
+        self, warcprox_address, page_url, screenshot_jpeg, extra_headers
+    ):
+        """
+        Makes the thumbnail in the thumbnail process pool while sending the
+        screenshot to warcprox, then sends the thumbnail. Runs in the
+        screenshot executor.
+        """
+        # memoryviews don't pickle, but the buffer Browser.screenshot() returns
+        # a view of does
+        if isinstance(screenshot_jpeg, memoryview) and screenshot_jpeg.nbytes == len(
+            screenshot_jpeg.obj
+        ):
+            picklable_jpeg = screenshot_jpeg.obj
+        else:
+            picklable_jpeg = bytes(screenshot_jpeg)
+        thumbnail = self._thumbnail_pool().submit(thumb_jpeg, picklable_jpeg)
+        self._warcprox_write_record(
+            warcprox_address=warcprox_address,
+            url="screenshot:%s" % str(urlcanon.semantic(page_url)),
+            warc_type="resource",
+            content_type="image/jpeg",
+            payload=screenshot_jpeg,
+            extra_headers=extra_headers,
+        )
+        self._warcprox_write_record(
+            warcprox_address=warcprox_address,
+            url="thumbnail:%s" % str(urlcanon.semantic(page_url)),
+            warc_type="resource",
+            content_type="image/jpeg",
+            payload=thumbnail.result(),
+            extra_headers=extra_headers,
+        )
 
     @metrics.brozzler_page_processing_duration_seconds.time()
     @metrics.brozzler_in_progress_pages.track_inprogress()
@@ -268,7 +509,7 @@ class BrozzlerWorker:
         self.logger.info("brozzling {}".format(page))
         outlinks = set()
 
-        page_headers = self._get_page_headers(page)
+        page_headers = self._get_page_headers(site, page)
 
         if not self._needs_browsing(page_headers):
             self.logger.info("needs fetch: %s", page)
@@ -289,52 +530,55 @@ class BrozzlerWorker:
             if enable_youtube_dl and ydl.should_ytdlp(
                 site, page, status_code, self._skip_av_seeds
             ):
-                try:
-                    ydl_outlinks = ydl.do_youtube_dl(self, site, page)
-                    metrics.brozzler_ydl_urls_checked.inc(1)
-                    outlinks.update(ydl_outlinks)
-                except brozzler.ReachedLimit as e:
-                    raise
-                except brozzler.ShutdownRequested:
-                    raise
-                except brozzler.ProxyError:
-                    raise
-                except brozzler.VideoExtractorError as e:
-                    logging.error(
-                        "error extracting video info: %s",
-                        e,
-                    )
-                except Exception as e:
-                    if (
-                        hasattr(e, "exc_info")
-                        and len(e.exc_info) >= 2
-                        and hasattr(e.exc_info[1], "code")
-                        and e.exc_info[1].code == 430
-                    ):
-                        self.logger.info(
-                            "youtube-dl got %s %s processing %s",
-                            e.exc_info[1].code,
-                            e.exc_info[1].msg,
-                            page.url,
-                        )
-                    else:
-                        self.logger.error(
-                            "youtube_dl raised exception on %s", page, exc_info=True
-                        )
+                outlinks.update(self._do_youtube_dl(site, page))
         return outlinks
 
+    def _do_youtube_dl(self, site, page):
+        """
+        Runs youtube-dl on `page`, logging rather than raising errors other
+        than those that end the site session.
+
+        Returns:
+            set of outlinks found by youtube-dl
+        """
+        try:
+            ydl_outlinks = ydl.do_youtube_dl(self, site, page)
+            metrics.brozzler_ydl_urls_checked.inc(1)
+            return set(ydl_outlinks)
+        except brozzler.ReachedLimit as e:
+            raise
+        except brozzler.ShutdownRequested:
+            raise
+        except brozzler.ProxyError:
+            raise
+        except brozzler.VideoExtractorError as e:
+            logging.error(
+                "error extracting video info: %s",
+                e,
+            )
+        except Exception as e:
+            if (
+                hasattr(e, "exc_info")
+                and len(e.exc_info) >= 2
+                and hasattr(e.exc_info[1], "code")
+                and e.exc_info[1].code == 430
+            ):
+                self.logger.info(
+                    "youtube-dl got %s %s processing %s",
+                    e.exc_info[1].code,
+                    e.exc_info[1].msg,
+                    page.url,
+                )
+            else:
+                self.logger.error(
+                    "youtube_dl raised exception on %s", page, exc_info=True
+                )
+        return set()
+
     @metrics.brozzler_header_processing_duration_seconds.time()
     @metrics.brozzler_in_progress_headers.track_inprogress()
-    def _get_page_headers(self, page):
-        # bypassing warcprox, requests' stream=True defers downloading the body of the response
-        # see https://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
-        try:
-            with requests.get(page.url, stream=True, verify=False) as r:
-                page_headers = r.headers
-            return page_headers
-        except requests.exceptions.RequestException as e:
-            self.logger.warning("Failed to get headers for %s: %s", page.url, e)
-            return {}
+    def _get_page_headers(self, site, page):
+        return self._content_type_prober.probe(site, page.url)
 
     def _needs_browsing(self, page_headers):
         if (
@@ -353,6 +597,10 @@ class BrozzlerWorker:
             metrics.brozzler_pages_crawled.inc(1)
             metrics.brozzler_outlinks_found.inc(len(outlinks))
 
+        # screenshot and thumbnail records are made and sent while browsing
+        # goes on
+        pending_records = []
+
         def _on_screenshot(screenshot_jpeg):
             if on_screenshot:
                 on_screenshot(screenshot_jpeg)
@@ -363,51 +611,19 @@ class BrozzlerWorker:
                     self._proxy_for(site),
                     page,
                 )
-                thumbnail_jpeg = self.thumb_jpeg(screenshot_jpeg)
-                self._warcprox_write_record(
-                    warcprox_address=self._proxy_for(site),
-                    url="screenshot:%s" % str(urlcanon.semantic(page.url)),
-                    warc_type="resource",
-                    content_type="image/jpeg",
-                    payload=screenshot_jpeg,
-                    extra_headers=site.extra_headers(page),
-                )
-                self._warcprox_write_record(
-                    warcprox_address=self._proxy_for(site),
-                    url="thumbnail:%s" % str(urlcanon.semantic(page.url)),
-                    warc_type="resource",
-                    content_type="image/jpeg",
-                    payload=thumbnail_jpeg,
-                    extra_headers=site.extra_headers(page),
+                pending_records.append(
+                    self._screenshot_executor.submit(
+                        self._write_screenshot_records,
+                        self._proxy_for(site),
+                        page.url,
+                        screenshot_jpeg,
+                        site.extra_headers(page),
+                    )
                 )
 
         def _on_response(chrome_msg):
-            if (
-                "params" in chrome_msg
-                and "response" in chrome_msg["params"]
-                and "mimeType" in chrome_msg["params"]["response"]
-                and chrome_msg["params"]["response"]
-                .get("mimeType", "")
-                .startswith("video/")
-                # skip manifests of DASH segmented video -
-                # see https://github.com/internetarchive/brozzler/pull/70
-                and chrome_msg["params"]["response"]["mimeType"]
-                != "video/vnd.mpeg.dash.mpd"
-                and chrome_msg["params"]["response"].get("status") in (200, 206)
-            ):
-                video = {
-                    "blame": "browser",
-                    "url": chrome_msg["params"]["response"].get("url"),
-                    "response_code": chrome_msg["params"]["response"]["status"],
-                    "content-type": chrome_msg["params"]["response"]["mimeType"],
-                }
-                response_headers = CaseInsensitiveDict(
-                    chrome_msg["params"]["response"]["headers"]
-                )
-                if "content-length" in response_headers:
-                    video["content-length"] = int(response_headers["content-length"])
-                if "content-range" in response_headers:
-                    video["content-range"] = response_headers["content-range"]
+            video = embedded_video(chrome_msg)
+            if video:
                 logging.debug("embedded video %s", video)
                 if not "videos" in page:
                     page.videos = []
@@ -426,41 +642,54 @@ class BrozzlerWorker:
                     sw_fetched.add(url)
 
         if not browser.is_running():
-            browser.start(
-                proxy=self._proxy_for(site),
-                cookie_db=site.get("cookie_db"),
-                window_height=self._window_height,
-                window_width=self._window_width,
+            self._start_browser(browser, site)
+        try:
+            final_page_url, outlinks = browser.browse_page(
+                page.url,
+                extra_headers=site.extra_headers(page),
+                behavior_parameters=site.get("behavior_parameters"),
+                username=site.get("username"),
+                password=site.get("password"),
+                user_agent=site.get("user_agent"),
+                on_screenshot=_on_screenshot,
+                on_response=_on_response,
+                on_request=on_request,
+                on_service_worker_version_updated=_on_service_worker_version_updated,
+                hashtags=page.hashtags,
+                skip_extract_outlinks=self._skip_extract_outlinks,
+                skip_visit_hashtags=self._skip_visit_hashtags,
+                skip_youtube_dl=self._skip_youtube_dl,
+                ytdlp_tmpdir=self._ytdlp_tmpdir,
+                simpler404=self._simpler404,
+                screenshot_full_page=self._screenshot_full_page,
+                page_timeout=self._page_timeout,
+                behavior_timeout=self._behavior_timeout,
+                extract_outlinks_timeout=self._extract_outlinks_timeout,
+                download_throughput=self._download_throughput,
+                stealth=self._stealth,
             )
-        final_page_url, outlinks = browser.browse_page(
-            page.url,
-            extra_headers=site.extra_headers(page),
-            behavior_parameters=site.get("behavior_parameters"),
-            username=site.get("username"),
-            password=site.get("password"),
-            user_agent=site.get("user_agent"),
-            on_screenshot=_on_screenshot,
-            on_response=_on_response,
-            on_request=on_request,
-            on_service_worker_version_updated=_on_service_worker_version_updated,
-            hashtags=page.hashtags,
-            skip_extract_outlinks=self._skip_extract_outlinks,
-            skip_visit_hashtags=self._skip_visit_hashtags,
-            skip_youtube_dl=self._skip_youtube_dl,
-            ytdlp_tmpdir=self._ytdlp_tmpdir,
-            simpler404=self._simpler404,
-            screenshot_full_page=self._screenshot_full_page,
-            page_timeout=self._page_timeout,
-            behavior_timeout=self._behavior_timeout,
-            extract_outlinks_timeout=self._extract_outlinks_timeout,
-            download_throughput=self._download_throughput,
-            stealth=self._stealth,
-        )
+        except BaseException:
+            # not worth waiting for now, but failures must not go unnoticed
+            for future in pending_records:
+                future.add_done_callback(self._log_pending_failure)
+            raise
+        # raises brozzler.ProxyError if a record couldn't be sent
+        for future in pending_records:
+            future.result()
         if final_page_url != page.url:
             page.note_redirect(final_page_url)
         update_page_metrics(page, outlinks)
         return outlinks
 
+    def _start_browser(self, browser, site):
+        browser.start(
+            proxy=self._proxy_for(site),
+            cookie_db=site.get("cookie_db"),
+            cookies=site.get("cookies"),
+            window_height=self._window_height,
+            window_width=self._window_width,
+        )
+
     def _fetch_url(self, site, url=None, page=None):
         proxies = None
         if page:
@@ -481,55 +710,81 @@ class BrozzlerWorker:
             raise brozzler.ProxyError("proxy error fetching %s" % url) from e
 
     def brozzle_site(self, browser, site):
+        worker_id = "%s:%s" % (socket.gethostname(), browser.chrome.port)
+        page_queue = brozzler.frontier.ClaimedPageQueue(
+            self._frontier, site, worker_id, self._page_claim_batch_size
+        )
+        session = _SiteSession(page_queue)
+        page = None
         try:
-            site.last_claimed_by = "%s:%s" % (socket.gethostname(), browser.chrome.port)
+            site.last_claimed_by = worker_id
             site.save()
             start = time.time()
-            page = None
             self._frontier.enforce_time_limit(site)
             self._frontier.honor_stop_request(site)
+            if self._seen_pages_cache:
+                self._frontier.warm_seen_pages(site)
             # _proxy_for() call in log statement can raise brozzler.ProxyError
             # which is why we honor time limit and stop request first☝🏻
             self.logger.info(
                 "brozzling site (proxy=%r) %s", self._proxy_for(site), site
             )
-            while time.time() - start < self.SITE_SESSION_MINUTES * 60:
-                site.refresh()
-                self._frontier.enforce_time_limit(site)
-                self._frontier.honor_stop_request(site)
-                page = self._frontier.claim_page(
-                    site, "%s:%s" % (socket.gethostname(), browser.chrome.port)
+            if self._frontier.prefetch_robots:
+                brozzler.robots.prefetch_robots(site, site.seed, self._proxy_for(site))
+            try:
+                self._start_tab_threads(browser, site, session, start)
+                self._brozzle_pages(browser, site, session, start)
+            finally:
+                session.stop()
+                for th in session.tab_threads:
+                    th.join()
+                page = session.failed_page()
+            if session.failures:
+                # a tab ran into trouble, handle it like we would our own
+                raise next(iter(session.failures.values()))[0]
+        except Exception as e:
+            page = self._site_session_failed(site, page, e)
+        finally:
+            if start:
+                site.active_brozzling_time = (
+                    (site.active_brozzling_time or 0) + time.time() - start
+                )
+            self._frontier.forget_seen_pages(site)
+            self._content_type_prober.forget_site(site)
+            try:
+                page_queue.release()
+                # pages other tabs were brozzling when the session ended
+                self._frontier.disclaim_pages(
+                    [p for p in session.in_flight.values() if p is not page]
                 )
+            except Exception as e:
+                # disclaim the site regardless, lest it stay claimed until
+                # the claim goes stale
+                self.logger.error(
+                    "problem disclaiming pages of site %s", site, exc_info=True
+                )
+            self._frontier.disclaim_site(site, page)
 
-                if page.needs_robots_check and not brozzler.is_permitted_by_robots(
-                    site, page.url, self._proxy_for(site)
-                ):
-                    logging.warning("page %s is blocked by robots.txt", page.url)
-                    page.blocked_by_robots = True
-                    self._frontier.completed_page(site, page)
-                else:
-                    outlinks = self.brozzle_page(
-                        browser, site, page, enable_youtube_dl=not self._skip_youtube_dl
-                    )
-                    self._frontier.completed_page(site, page)
-                    self._frontier.scope_and_schedule_outlinks(site, page, outlinks)
-                    if browser.is_running():
-                        site.cookie_db = browser.chrome.persist_and_read_cookie_db()
+    def _site_session_failed(self, site, page, e):
+        """
+        Deals with exception `e`, which ended the session brozzling `site`,
+        `page` being the page brozzled at the time, if any.
 
-                page = None
-        except brozzler.ShutdownRequested:
+        Returns:
+            the page to disclaim the site with, `page` itself unless it has
+            been given up on
+        """
+        if isinstance(e, brozzler.ShutdownRequested):
             self.logger.info("shutdown requested")
-        except brozzler.NothingToClaim:
+        elif isinstance(e, brozzler.NothingToClaim):
             self.logger.info("no pages left for site %s", site)
-        except brozzler.ReachedLimit as e:
+        elif isinstance(e, brozzler.ReachedLimit):
             self._frontier.reached_limit(site, e)
-        except brozzler.ReachedTimeLimit as e:
+        elif isinstance(e, brozzler.ReachedTimeLimit):
             self._frontier.finished(site, "FINISHED_TIME_LIMIT")
-        except brozzler.CrawlStopped:
+        elif isinstance(e, brozzler.CrawlStopped):
             self._frontier.finished(site, "FINISHED_STOP_REQUESTED")
-        # except brozzler.browser.BrowsingAborted:
-        #     self.logger.info("{} shut down".format(browser))
-        except brozzler.ProxyError as e:
+        elif isinstance(e, brozzler.ProxyError):
             if self._warcprox_auto:
                 logging.error(
                     "proxy error (site.proxy=%s), will try to choose a "
@@ -541,18 +796,18 @@ class BrozzlerWorker:
             else:
                 # using brozzler-worker --proxy, nothing to do but try the
                 # same proxy again next time
-                logging.error("proxy error (self._proxy=%r)", self._proxy, exc_info=1)
-        except (brozzler.PageConnectionError, Exception) as e:
+                logging.error("proxy error (self._proxy=%r)", self._proxy, exc_info=e)
+        else:
             if isinstance(e, brozzler.PageConnectionError):
                 self.logger.error(
                     "Page status code possibly indicates connection failure between host and warcprox: site=%r page=%r",
                     site,
                     page,
-                    exc_info=True,
+                    exc_info=e,
                 )
             else:
                 self.logger.error(
-                    "unexpected exception site=%r page=%r", site, page, exc_info=True
+                    "unexpected exception site=%r page=%r", site, page, exc_info=e
                 )
             if page:
                 # Calculate backoff in seconds based on number of failed attempts.
@@ -573,21 +828,175 @@ class BrozzlerWorker:
                     page = None
                 else:
                     page.save()
+        return page
+
+    def _brozzle_pages(self, browser, site, session, start):
+        """
+        Claims and brozzles pages of `site` in `browser` until the site
+        session is over.
+
+        Raises:
+            whatever goes wrong, after recording it in `session.failures`
+            along with the page being brozzled
+        """
+        page = None
+        try:
+            while (
+                time.time() - start < self.SITE_SESSION_MINUTES * 60
+                and not session.stopping.is_set()
+            ):
+                with session.lock:
+                    self._frontier.refresh_site(site)
+                    self._frontier.enforce_time_limit(site)
+                    self._frontier.honor_stop_request(site)
+                    page = session.claim()
+                if not page:
+                    continue
+
+                if page.needs_robots_check and not brozzler.is_permitted_by_robots(
+                    site, page.url, self._proxy_for(site)
+                ):
+                    logging.warning("page %s is blocked by robots.txt", page.url)
+                    page.blocked_by_robots = True
+                    with session.lock:
+                        self._frontier.completed_page(site, page)
+                        session.done(page)
+                elif not self._wait_for_host_turn(site, page):
+                    with session.lock:
+                        session.done(page)
+                else:
+                    outlinks = self.brozzle_page(
+                        browser, site, page, enable_youtube_dl=not self._skip_youtube_dl
+                    )
+                    with session.lock:
+                        self._frontier.completed_page(site, page)
+                        self._frontier.scope_and_schedule_outlinks(
+                            site,
+                            page,
+                            outlinks,
+                            claimed_pages=session.claimed_pages(page),
+                            proxy=self._proxy_for(site),
+                        )
+                        session.done(page)
+                        if browser.is_running():
+                            if browser.warm:
+                                site.cookies = browser.read_cookies()
+                            else:
+                                site.cookie_db = (
+                                    browser.chrome.persist_and_read_cookie_db()
+                                )
+
+                page = None
+        except BaseException as e:
+            session.failures[threading.current_thread()] = (e, page)
+            raise
+
+    def _reserve_host_turn(self, site, page):
+        """
+        Reserves the turn to fetch `page` from its host, if fetches from each
+        host are spaced out, see `brozzler.politeness.HostPoliteness`.
+
+        Returns:
+            number of seconds to wait for the turn, or `None` if the page has
+            been put off because its host is busy
+        """
+        if not self._politeness:
+            return 0
+        return self._politeness.reserve_turn(site, page, self._proxy_for(site))
+
+    def _wait_for_host_turn(self, site, page):
+        """
+        Returns `False` if `page` has been put off, otherwise `True` once it
+        is its host's turn.
+        """
+        wait = self._reserve_host_turn(site, page)
+        if wait is None:
+            return False
+        brozzler.sleep(wait)
+        return True
+
+    def _start_tab_threads(self, browser, site, session, start):
+        """
+        Opens `self._tabs_per_site - 1` more tabs in `browser` and starts a
+        thread brozzling pages of `site` in each.
+        """
+        if self._tabs_per_site <= 1:
+            return
+        if not browser.is_running():
+            self._start_browser(browser, site)
+        for i in range(1, self._tabs_per_site):
+            tab = browser.open_tab()
+            th = threading.Thread(
+                target=self._brozzle_site_tab_thread_target,
+                args=(tab, site, session, start),
+                name="BrozzlingThread:%s:%s" % (browser.chrome.port, i),
+                daemon=True,
+            )
+            with self._browsing_threads_lock:
+                self._browsing_threads.add(th)
+            session.tab_threads.append(th)
+            th.start()
+
+    def _brozzle_site_tab_thread_target(self, tab, site, session, start):
+        try:
+            tab.start()
+            self._brozzle_pages(tab, site, session, start)
+        except brozzler.NothingToClaim:
+            # no tab is brozzling a page either, the others will find out too
+            session.failures.pop(threading.current_thread(), None)
+        except BaseException as e:
+            session.failures.setdefault(threading.current_thread(), (e, None))
+            session.stop()
         finally:
-            if start:
-                site.active_brozzling_time = (
-                    (site.active_brozzling_time or 0) + time.time() - start
-                )
-            self._frontier.disclaim_site(site, page)
+            tab.stop()
+            with self._browsing_threads_lock:
+                self._browsing_threads.remove(threading.current_thread())
 
     def _brozzle_site_thread_target(self, browser, site):
         try:
             self.brozzle_site(browser, site)
         finally:
-            browser.stop()
+            # stops the browser, or resets it if the pool keeps browsers warm
             self._browser_pool.release(browser)
             with self._browsing_threads_lock:
                 self._browsing_threads.remove(threading.current_thread())
+            self._wakeup.set()
+
+    def _work_available(self, claimable_at):
+        self._claim_backoff.work_available(claimable_at)
+        self._wakeup.set()
+
+    def _watch_claimable_sites(self):
+        """
+        Calls `_work_available()` whenever the frontier says a site is
+        becoming claimable, until shutdown.
+        """
+        retry_delay = 1
+        while not self._shutdown.is_set():
+            try:
+                for claimable_at in self._frontier.claimable_site_notifications():
+                    if self._shutdown.is_set():
+                        return
+                    retry_delay = 1
+                    self._work_available(claimable_at)
+            except Exception as e:
+                self.logger.warning(
+                    "problem watching for claimable sites, will try again "
+                    "in %ss: %s",
+                    retry_delay,
+                    e,
+                )
+                self._shutdown.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+    def _start_watching_claimable_sites(self):
+        # daemon because the changefeed blocks until something changes
+        th = threading.Thread(
+            target=self._watch_claimable_sites,
+            name="ClaimableSitesWatcher",
+            daemon=True,
+        )
+        th.start()
 
     def _service_heartbeat(self):
         if hasattr(self, "status_info"):
@@ -662,22 +1071,27 @@ class BrozzlerWorker:
         self.logger.notice(
             "brozzler %s - brozzler-worker starting", brozzler.__version__
         )
-        last_nothing_to_claim = 0
+        self._start_watching_claimable_sites()
         try:
             while not self._shutdown.is_set():
+                self._wakeup.clear()
                 self._service_heartbeat_if_due()
-                if time.time() - last_nothing_to_claim > 20:
+                if not self._claim_backoff.wait_time():
                     try:
                         self._start_browsing_some_sites()
+                        self._claim_backoff.succeeded()
                     except brozzler.browser.NoBrowsersAvailable:
                         logging.trace("all %s browsers are in use", self._max_browsers)
                     except brozzler.NothingToClaim:
-                        last_nothing_to_claim = time.time()
+                        self._claim_backoff.nothing_to_claim()
                         logging.trace(
                             "nothing to claim, all available active sites "
                             "are already claimed by a brozzler worker"
                         )
-                time.sleep(0.5)
+                timeout = self.MAX_IDLE_WAIT
+                if self._browser_pool.num_available():
+                    timeout = min(timeout, self._claim_backoff.wait_time())
+                self._wakeup.wait(timeout)
 
             self.logger.notice("shutdown requested")
         except r.ReqlError as e:
@@ -711,6 +1125,24 @@ class BrozzlerWorker:
             thredz = set(self._browsing_threads)
             for th in thredz:
                 th.join()
+            try:
+                self._frontier.flush_writes()
+            except:
+                self.logger.error("failed to flush buffered writes", exc_info=True)
+            self._frontier.close()
+            self._shutdown_executors()
+
+    def _shutdown_executors(self):
+        """
+        Waits for screenshot records to be sent, shuts down the screenshot
+        and thumbnail executors and closes connections to warcprox.
+        """
+        self._screenshot_executor.shutdown(wait=True)
+        with self._screenshot_lock:
+            if self._thumbnail_executor:
+                self._thumbnail_executor.shutdown(wait=True)
+                self._thumbnail_executor = None
+        self._warcprox_client.close()
 
     def start(self):
         with self._start_stop_lock:
@@ -727,6 +1159,7 @@ class BrozzlerWorker:
 
     def stop(self):
         self._shutdown.set()
+        self._wakeup.set()
 
     def is_alive(self):
         return self._thread and self._thread.is_alive()
@@ -80,6 +80,7 @@ setuptools.setup(
     extras_require={
         "yt-dlp": ["yt-dlp>=2024.7.25"],
         "dashboard": ["flask>=1.0", "gunicorn>=19.8.1"],
+        "async": ["websockets>=12.0"],
         "easy": [
             "warcprox>=2.4.31",
             "pywb>=0.33.2,<2",
@@ -508,6 +508,66 @@ def test_scope_and_schedule_outlinks():
         assert brozzler.Page.load(rr, id)
 
 
+def test_seen_pages_cache():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    site = brozzler.Site(rr, {"seed": "http://example.com/"})
+    brozzler.new_site(frontier, site)
+    seed_page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(
+        site, seed_page, ["http://example.com/a", "http://example.com/b#x"]
+    )
+
+    seen = frontier.warm_seen_pages(site)
+    assert len(seen) == 3
+    page_a = brozzler.Page.compute_id(site.id, "http://example.com/a")
+    page_b = brozzler.Page.compute_id(site.id, "http://example.com/b")
+    page_c = brozzler.Page.compute_id(site.id, "http://example.com/c")
+    assert seen.classify(page_a) is True
+    assert seen.classify(page_c) is False
+
+    priority_a = brozzler.Page.load(rr, page_a).priority
+    frontier.scope_and_schedule_outlinks(
+        site,
+        seed_page,
+        ["http://example.com/a", "http://example.com/b#y", "http://example.com/c"],
+    )
+    # existing pages merged, new page added, all without fetching them
+    assert brozzler.Page.load(rr, page_a).priority == 2 * priority_a
+    assert sorted(brozzler.Page.load(rr, page_b).hashtags) == ["#x", "#y"]
+    assert brozzler.Page.load(rr, page_c).hops_from_seed == 1
+    assert seen.classify(page_c) is True
+    assert sorted(seed_page.outlinks["accepted"]) == [
+        "http://example.com/a",
+        "http://example.com/b",
+        "http://example.com/c",
+    ]
+
+    frontier.forget_seen_pages(site)
+
+
+def test_separate_outlinks():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr, separate_outlinks=True)
+
+    site = brozzler.Site(rr, {"seed": "http://example.com/"})
+    brozzler.new_site(frontier, site)
+    seed_page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(
+        site, seed_page, ["http://example.com/a", "http://example.org/"]
+    )
+
+    assert "outlinks" not in brozzler.Page.load(rr, seed_page.id)
+    page_outlinks = brozzler.PageOutlinks.load(rr, seed_page.id)
+    assert page_outlinks.site_id == site.id
+    assert page_outlinks.outlinks == {
+        "accepted": ["http://example.com/a"],
+        "blocked": [],
+        "rejected": ["http://example.org/"],
+    }
+
+
 def test_parent_url_scoping():
     rr = doublethink.Rethinker("localhost", db="ignoreme")
     frontier = brozzler.RethinkDbFrontier(rr)
@@ -852,6 +912,68 @@ def test_honor_stop_request():
         frontier.honor_stop_request(site)
 
 
+def test_honor_stop_request_watching_sites():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr, watch_sites=True)
+
+    job_conf = {"seeds": [{"url": "http://example.com"}], "time_limit": 60}
+    job = brozzler.new_job(frontier, job_conf)
+    site = list(frontier.job_sites(job.id))[0]
+
+    # caches site and job
+    frontier.honor_stop_request(site)
+    assert frontier.site_watcher.get("sites", site.id)["time_limit"] == 60
+
+    # wait for changefeeds to be up
+    start = time.time()
+    while len(frontier.site_watcher._live) < 2 and time.time() - start < 10:
+        time.sleep(0.1)
+
+    # changes arrive through the changefeeds
+    rr.table("sites").get(site.id).update({"time_limit": 120}).run()
+    start = time.time()
+    while site.time_limit != 120 and time.time() - start < 10:
+        time.sleep(0.1)
+        frontier.refresh_site(site)
+    assert site.time_limit == 120
+
+    rr.table("jobs").get(job.id).update({"stop_requested": doublethink.utcnow()}).run()
+    start = time.time()
+    while time.time() - start < 10:
+        try:
+            frontier.honor_stop_request(site)
+        except brozzler.CrawlStopped:
+            break
+        time.sleep(0.1)
+    with pytest.raises(brozzler.CrawlStopped):
+        frontier.honor_stop_request(site)
+
+
+def test_reserve_host_turn():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr)
+    host = "example-%s.com" % time.time()
+
+    reserved, turn1 = frontier.reserve_host_turn(host, 10, 15)
+    assert reserved
+    assert turn1 <= doublethink.utcnow()
+
+    reserved, turn2 = frontier.reserve_host_turn(host, 10, 15)
+    assert reserved
+    assert turn2 == turn1 + datetime.timedelta(seconds=10)
+
+    # next turn is 20 seconds away, more than max_wait
+    reserved, turn3 = frontier.reserve_host_turn(host, 10, 15)
+    assert not reserved
+    assert turn3 == turn1 + datetime.timedelta(seconds=20)
+
+    page = brozzler.Page(rr, {"url": "http://%s/" % host, "claimed": True})
+    frontier.defer_page(page, turn3)
+    page.refresh()
+    assert page.claimed is False
+    assert page.retry_after == turn3
+
+
 def test_claim_site():
     rr = doublethink.Rethinker("localhost", db="ignoreme")
     frontier = brozzler.RethinkDbFrontier(rr)
@@ -895,6 +1017,49 @@ def test_claim_site():
     rr.table("sites").get(claimed_site.id).delete().run()
 
 
+def test_claim_pages():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    site = brozzler.Site(rr, {"seed": "http://example.com/"})
+    brozzler.new_site(frontier, site)
+    seed_page = frontier.seed_page(site.id)
+    frontier.scope_and_schedule_outlinks(
+        site,
+        seed_page,
+        ["http://example.com/a", "http://example.com/b/c", "http://example.com/d"],
+    )
+
+    pages = frontier.claim_pages(site, "test:1", 3)
+    assert len(pages) == 3
+    assert pages[0].id == seed_page.id
+    assert [page.priority for page in pages] == sorted(
+        (page.priority for page in pages), reverse=True
+    )
+    assert all(page.claimed for page in pages)
+    for page in pages:
+        page.refresh()
+        assert page.claimed
+        assert page.last_claimed_by == "test:1"
+
+    # claimed pages were not brozzled, so they can be claimed again
+    frontier.disclaim_pages(pages[1:])
+    assert not pages[1].claimed
+    pages[1].refresh()
+    assert not pages[1].claimed
+
+    queue = brozzler.frontier.ClaimedPageQueue(frontier, site, "test:1", 2)
+    page = queue.claim()
+    assert page.id == seed_page.id
+    assert len(queue) == 1
+    queue.release()
+    assert len(queue) == 0
+
+    # clean up
+    rr.table("pages").filter({"site_id": site.id}).delete().run()
+    rr.table("sites").get(site.id).delete().run()
+
+
 def test_max_claimed_sites():
     # max_claimed_sites is a brozzler job setting that puts a cap on the number
     # of the job's sites that can be brozzled simultaneously across the cluster
@@ -930,10 +1095,76 @@ def test_max_claimed_sites():
     assert len(claimed_sites) == 2
     with pytest.raises(brozzler.NothingToClaim):
         claimed_site = frontier.claim_sites(3)
+    assert rr.table("job_claims").get(job.id).run()["claimed_sites"] == 3
+
+    # disclaiming a site makes room for another one
+    frontier.disclaim_site(claimed_sites[0])
+    assert rr.table("job_claims").get(job.id).run()["claimed_sites"] == 2
+    claimed_sites = frontier.claim_sites(3)
+    assert len(claimed_sites) == 1
+    assert claimed_sites[0].job_id == job.id
+    with pytest.raises(brozzler.NothingToClaim):
+        claimed_site = frontier.claim_sites(3)
+
+    # counts can be rebuilt from the sites
+    rr.table("job_claims").get(job.id).update({"claimed_sites": 0}).run()
+    frontier.reset_claimed_site_counts(job.id)
+    assert rr.table("job_claims").get(job.id).run()["claimed_sites"] == 3
+
+    # clean slate for the next one
+    rr.table("jobs").delete().run()
+    rr.table("sites").delete().run()
+    rr.table("job_claims").delete().run()
+
+
+def test_max_claimed_sites_stale_claim_disclaimed():
+    rr = doublethink.Rethinker("localhost", db="ignoreme")
+    frontier = brozzler.RethinkDbFrontier(rr)
+
+    # clean slate
+    rr.table("jobs").delete().run()
+    rr.table("sites").delete().run()
+
+    job_conf = {
+        "seeds": [{"url": "http://example.com/%s" % i} for i in range(3)],
+        "max_claimed_sites": 2,
+    }
+    job = brozzler.new_job(frontier, job_conf)
+    stale_site = frontier.claim_sites(1)[0]
+    rr.table("sites").get(stale_site.id).update(
+        {"last_claimed": doublethink.utcnow() - datetime.timedelta(hours=2)}
+    ).run()
+    stale_site.refresh()
+
+    # the stale claim is disclaimed after being picked as a candidate
+    claimable_sites = frontier._claimable_sites
+
+    def disclaiming_claimable_sites(n):
+        candidates = claimable_sites(n)
+        assert candidates[0]["id"] == stale_site.id
+        frontier.disclaim_site(stale_site)
+        return candidates
+
+    frontier._claimable_sites = disclaiming_claimable_sites
+    with pytest.raises(brozzler.NothingToClaim):
+        frontier.claim_sites(1)
+    frontier._claimable_sites = claimable_sites
+
+    def claimed_count():
+        return len([s for s in frontier.job_sites(job.id) if s.claimed])
+
+    # the site was not claimed without a reservation, so the count is right
+    assert claimed_count() == 0
+    assert rr.table("job_claims").get(job.id).run()["claimed_sites"] == 0
+    rr.table("sites").update({"last_disclaimed": brozzler.EPOCH_UTC}).run()
+    assert len(frontier.claim_sites(3)) == 2
+    assert claimed_count() == 2
+    assert rr.table("job_claims").get(job.id).run()["claimed_sites"] == 2
 
     # clean slate for the next one
     rr.table("jobs").delete().run()
     rr.table("sites").delete().run()
+    rr.table("job_claims").delete().run()
 
 
 def test_choose_warcprox():
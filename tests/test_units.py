@@ -18,23 +18,38 @@ limitations under the License.
 """
 
 import pytest
+import asyncio
 import http.server
 import threading
 import os
 import brozzler
+import brozzler.aiobrowser
 import brozzler.chrome
 import brozzler.ydl
+import brozzler.politeness
+import brozzler.prober
+import brozzler.seen
+import brozzler.warcprox_client
 import logging
 import yaml
+import PIL.Image
+import copy
+import base64
 import datetime
+import doublethink
+import io
+import json
+import reppy.parser
 import requests
 import tempfile
 import uuid
+import zlib
 import socket
 import time
 import sys
 import threading
 from unittest import mock
+from requests.structures import CaseInsensitiveDict
 
 logging.basicConfig(
     stream=sys.stderr,
@@ -186,6 +201,209 @@ def test_robots_connection_failure():
     assert brozzler.is_permitted_by_robots(site, url)
 
 
+def test_robots_cache(httpd):
+    url = "http://localhost:%s/" % httpd.server_port
+    with tempfile.TemporaryDirectory(prefix="brzl-robots-") as tmpdir:
+        store = brozzler.robots.DirectoryRobotsStore(tmpdir)
+        cache = brozzler.robots.RobotsCache(max_entries=2, store=store)
+        site1 = brozzler.Site(None, {"seed": url, "user_agent": "im/a bAdBOt/uh huh"})
+        site2 = brozzler.Site(None, {"seed": url + "a", "user_agent": site1.user_agent})
+        site3 = brozzler.Site(None, {"seed": url, "user_agent": "goodbot"})
+        site4 = brozzler.Site(None, {"seed": url, "user_agent": "otherbot"})
+        rules = cache.rules(site1, url)
+        assert not rules.allowed(url, site1.user_agent)
+
+        # sites on the same host share the rules
+        assert cache.rules(site2, url + "b") is rules
+        assert len(os.listdir(tmpdir)) == 1
+
+        # least recently used rules are evicted
+        assert cache.rules(site3, url).allowed(url, site3.user_agent)
+        cache.rules(site4, url)
+        assert len(cache) == 2
+        assert not cache.key(url, site1.user_agent) in cache._rules
+        assert len(os.listdir(tmpdir)) == 3
+
+        # rules in the store don't need fetching
+        cache = brozzler.robots.RobotsCache(store=store)
+        with mock.patch.object(cache, "_fetch") as fetch:
+            assert not cache.rules(site1, url).allowed(url, site1.user_agent)
+            fetch.assert_not_called()
+
+        # expired rules are fetched again
+        cache = brozzler.robots.RobotsCache()
+        rules = cache.rules(site1, url)
+        rules.expires = time.time() - 1
+        assert cache.rules(site1, url) is not rules
+
+
+def test_robots_cache_warcprox_routing():
+    url = "http://example.com/"
+    robots = {
+        "url": url + "robots.txt",
+        "status": 200,
+        "content": b"",
+        "expires": time.time() + 60,
+    }
+    cache = brozzler.robots.RobotsCache()
+    site1 = brozzler.Site(
+        None, {"seed": url, "warcprox_meta": {"warc-prefix": "a", "stats": {}}}
+    )
+    site2 = brozzler.Site(
+        None, {"seed": url + "b", "warcprox_meta": {"warc-prefix": "a", "stats": {}}}
+    )
+    site3 = brozzler.Site(
+        None,
+        {
+            "seed": url,
+            "warcprox_meta": {"warc-prefix": "a", "stats": {"buckets": ["c"]}},
+        },
+    )
+    with mock.patch.object(cache, "_fetch", return_value=robots) as fetch:
+        # through warcprox, sites archiving robots.txt to different warcs or
+        # counting it in different stats buckets fetch it themselves
+        for site in (site1, site2, site3):
+            cache.rules(site, url, "localhost:8000")
+        assert fetch.call_count == 2
+        assert fetch.call_args_list[1] == mock.call(site3, url, "localhost:8000")
+        # not through warcprox, it doesn't matter
+        for site in (site1, site3):
+            cache.rules(site, url)
+        assert fetch.call_count == 3
+
+
+def test_robots_prefetch(httpd):
+    url = "http://localhost:%s/prefetch" % httpd.server_port
+    site = brozzler.Site(None, {"seed": url, "user_agent": "a badbot of sorts"})
+    assert brozzler.robots.is_permitted_by_cached_robots(site, url) is None
+    start = time.time()
+    while (
+        brozzler.robots.is_permitted_by_cached_robots(site, url) is None
+        and time.time() - start < 10
+    ):
+        time.sleep(0.1)
+    assert brozzler.robots.is_permitted_by_cached_robots(site, url) is False
+
+    site = brozzler.Site(None, {"seed": url, "ignore_robots": True})
+    assert brozzler.robots.is_permitted_by_cached_robots(site, url) is True
+
+
+def test_filter_permitted_by_robots(httpd):
+    url = "http://localhost:%s/" % httpd.server_port
+    urls = [url, url + "a", "http://localhost:4/", url + "b#c"]
+    site = brozzler.Site(None, {"seed": url, "user_agent": "im/a/GoOdbot/yep"})
+    assert brozzler.robots.filter_permitted_by_robots(site, urls) == urls
+    site = brozzler.Site(None, {"seed": url, "user_agent": "im/a bAdBOt/uh huh"})
+    # robots.txt of localhost:4 can't be fetched, so anything goes
+    assert brozzler.robots.filter_permitted_by_robots(site, urls) == [
+        "http://localhost:4/"
+    ]
+
+
+def test_outlink_robots_proxy():
+    seed = "http://example.com/"
+    site = brozzler.Site(None, {"seed": seed})
+    parent_page = brozzler.Page(
+        None, {"url": seed, "site_id": site.id, "hops_from_seed": 0, "hops_off": 0}
+    )
+    frontier = brozzler.RethinkDbFrontier(mock.MagicMock(dbname="brozzler"))
+    cache = brozzler.robots.RobotsCache()
+    robots = {
+        "url": seed + "robots.txt",
+        "status": 200,
+        "content": b"User-agent: *\nDisallow: /private\n",
+        "expires": time.time() + 60,
+    }
+    with mock.patch.object(brozzler.robots, "_robots_cache", cache), mock.patch.object(
+        cache, "_fetch", return_value=robots
+    ) as fetch:
+        assert brozzler.is_permitted_by_robots(site, seed, "localhost:8000")
+        pages, blocked, out_of_scope = frontier._scope_and_enforce_robots(
+            site, parent_page, [seed + "a", seed + "private"], "localhost:8000"
+        )
+    # outlink scoping reuses the robots.txt fetched through the site's proxy
+    fetch.assert_called_once_with(site, seed, "localhost:8000")
+    assert [page.url for page in pages.values()] == [seed + "a"]
+    assert blocked == {seed + "private"}
+
+
+def test_outlink_robots_prefetched_through_proxy():
+    seed = "http://example.com/"
+    site = brozzler.Site(None, {"seed": seed})
+    parent_page = brozzler.Page(
+        None, {"url": seed, "site_id": site.id, "hops_from_seed": 0, "hops_off": 0}
+    )
+    frontier = brozzler.RethinkDbFrontier(
+        mock.MagicMock(dbname="brozzler"), prefetch_robots=True
+    )
+    cache = brozzler.robots.RobotsCache()
+    robots = {
+        "url": seed + "robots.txt",
+        "status": 200,
+        "content": b"User-agent: *\nDisallow: /private\n",
+        "expires": time.time() + 60,
+    }
+    with mock.patch.object(brozzler.robots, "_robots_cache", cache), mock.patch.object(
+        cache, "_fetch", return_value=robots
+    ) as fetch:
+        # as the worker does when it starts brozzling the site
+        brozzler.robots.prefetch_robots(site, seed, "localhost:8000")
+        start = time.time()
+        while (
+            cache.cached_rules(site, seed, "localhost:8000") is None
+            and time.time() - start < 10
+        ):
+            time.sleep(0.1)
+        pages, blocked, out_of_scope = frontier._scope_and_enforce_robots(
+            site, parent_page, [seed + "a", seed + "private"], "localhost:8000"
+        )
+    fetch.assert_called_once_with(site, seed, "localhost:8000")
+    assert [page.url for page in pages.values()] == [seed + "a"]
+    # robots.txt was prefetched, no need to check before brozzling
+    assert not list(pages.values())[0].needs_robots_check
+    assert blocked == {seed + "private"}
+
+
+def test_robots_agent_matcher():
+    robots_txt = b"""
+User-agent: *
+Disallow: /a
+Allow: /a/b
+Disallow: /*.pdf$
+Disallow: /x%2fy
+Allow: /c
+Disallow: /c
+
+User-agent: badbot
+Disallow: /
+"""
+    rules = reppy.parser.Rules(
+        "http://example.com/robots.txt", 200, robots_txt, time.time() + 60
+    )
+    for path in (
+        "",
+        "/",
+        "/a",
+        "/ab",
+        "/a/b",
+        "/a/b/c.pdf",
+        "/a/b/c.pdfx",
+        "/c",
+        "/x%2fy",
+        "/x/y",
+        "/robots.txt",
+        "/?q",
+    ):
+        for user_agent in ("brozzler", "a BadBot/1.0"):
+            url = "http://example.com" + path
+            matcher = brozzler.robots._agent_matcher(rules, user_agent)
+            if path == "/c" and user_agent == "brozzler":
+                # reppy can't break the tie, allow wins
+                assert matcher.allowed(url)
+            else:
+                assert matcher.allowed(url) == rules.allowed(url, user_agent)
+
+
 def test_scoping():
     test_scope = yaml.safe_load(
         """
@@ -566,6 +784,7 @@ def test_limit_failures():
 
     rr = mock.Mock()
     rr.servers = [mock.Mock()]
+    rr.dbname = "brozzler"
     rethink_query = mock.Mock(run=mock.Mock(return_value=[]))
     rr.db_list = mock.Mock(return_value=rethink_query)
     rr.table_list = mock.Mock(return_value=rethink_query)
@@ -573,14 +792,15 @@ def test_limit_failures():
         return_value=mock.Mock(
             between=mock.Mock(
                 return_value=mock.Mock(limit=mock.Mock(return_value=rethink_query))
-            )
+            ),
+            index_list=mock.Mock(return_value=rethink_query),
         )
     )
     assert rr.table().between().limit().run() == []
     frontier = brozzler.RethinkDbFrontier(rr)
     frontier.enforce_time_limit = mock.Mock()
     frontier.honor_stop_request = mock.Mock()
-    frontier.claim_page = mock.Mock(return_value=page)
+    frontier.claim_pages = mock.Mock(return_value=[page])
     frontier._maybe_finish_job = mock.Mock()
 
     browser = mock.Mock()
@@ -606,3 +826,792 @@ def test_limit_failures():
     assert page.failed_attempts == 3
     assert page.brozzle_count == 1
     assert site.status == "FINISHED"
+
+
+def test_disclaim_site_despite_page_release_failure():
+    frontier = mock.Mock()
+    frontier.honor_stop_request.side_effect = brozzler.CrawlStopped
+    frontier.disclaim_pages.side_effect = Exception("rethinkdb is down")
+    site = mock.Mock(active_brozzling_time=0)
+    worker = brozzler.BrozzlerWorker(frontier)
+    worker.brozzle_site(mock.Mock(), site)
+    frontier.disclaim_site.assert_called_once_with(site, None)
+
+
+def test_warm_browser_pool():
+    pool = brozzler.BrowserPool(2, warm=True, chrome_exe="chromium-browser")
+    browser = pool.acquire()
+    assert browser.warm
+    with mock.patch.object(browser, "reset") as reset, mock.patch.object(
+        browser.chrome, "is_running", return_value=True
+    ):
+        pool.release(browser)
+        reset.assert_called_once_with()
+    assert pool.num_in_use() == 0
+
+    # released warm browser is handed out again
+    assert pool.acquire_multi(2)[0] is browser
+    assert pool.num_available() == 0
+
+    # cold pool stops released browsers and starts fresh ones
+    cold_pool = brozzler.BrowserPool(1, chrome_exe="chromium-browser")
+    browser = cold_pool.acquire()
+    assert not browser.warm
+    with mock.patch.object(browser, "stop") as stop:
+        cold_pool.release(browser)
+        stop.assert_called_once_with()
+    assert cold_pool.acquire() is not browser
+
+
+def test_claimed_page_queue():
+    pages = [mock.Mock(id=str(i)) for i in range(3)]
+    frontier = mock.Mock()
+    frontier.claim_pages = mock.Mock(side_effect=[pages[:2], [pages[2]]])
+    site = mock.Mock()
+
+    queue = brozzler.frontier.ClaimedPageQueue(frontier, site, "test:1", 2)
+    assert queue.claim() is pages[0]
+    frontier.claim_pages.assert_called_once_with(site, "test:1", 2)
+    assert queue.pages == {"1": pages[1]}
+    assert queue.claim() is pages[1]
+    assert queue.claim() is pages[2]
+    assert frontier.claim_pages.call_count == 2
+
+    queue.release()
+    frontier.disclaim_pages.assert_called_once_with([])
+
+
+def test_write_behind():
+    rr = mock.Mock()
+    write_behind = brozzler.frontier.WriteBehind(rr, max_delay=3600)
+
+    page = brozzler.Page(rr, {"site_id": "site1", "url": "http://example.com/"})
+    write_behind.save(page)
+    page.brozzle_count = 1
+    write_behind.save(page)
+    # coalesced, and a snapshot of the document at the time of save()
+    assert write_behind.pending_ids("pages") == [page.id]
+    assert write_behind.pending_ids("sites") == []
+    assert write_behind.get("pages", page.id)["brozzle_count"] == 1
+    page.claimed = True
+    assert write_behind.get("pages", page.id)["claimed"] == False
+
+    # failed write is put back in the buffer
+    rr.table().insert().run.side_effect = Exception("rethinkdb down")
+    with pytest.raises(Exception):
+        write_behind.flush()
+    assert write_behind.pending_ids("pages") == [page.id]
+
+    rr.table().insert().run.side_effect = None
+    rr.reset_mock()
+    write_behind.flush()
+    rr.table.assert_called_once_with("pages")
+    (docs,), kwargs = rr.table().insert.call_args
+    assert [doc["id"] for doc in docs] == [page.id]
+    assert kwargs == {"conflict": "replace"}
+    assert write_behind.pending_ids("pages") == []
+    assert write_behind.get("pages", page.id) is None
+
+
+def test_seen_pages():
+    bloom = brozzler.seen.ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    ids = [
+        brozzler.Page.compute_id("site1", "http://example.com/%s" % i)
+        for i in range(1000)
+    ]
+    for page_id in ids:
+        bloom.add(page_id)
+    assert len(bloom._filters) > 1
+    assert all(page_id in bloom for page_id in ids)
+    others = [
+        brozzler.Page.compute_id("site2", "http://example.com/%s" % i)
+        for i in range(1000)
+    ]
+    assert sum(page_id in bloom for page_id in others) < 30
+
+    seen = brozzler.seen.SeenPages(lru_size=10)
+    for page_id in ids[:20]:
+        seen.add(page_id)
+    assert seen.classify(ids[19]) is True
+    # evicted from lru, maybe in bloom filter
+    assert seen.classify(ids[0]) is None
+    # not certainly new until the cache has every page id of the site
+    assert seen.classify(ids[999]) is None
+    seen.complete = True
+    assert seen.classify(ids[999]) is False
+    assert seen.classify(ids[0]) is None
+
+    seen = brozzler.seen.SeenPages(lru_size=10, bloom=False)
+    seen.add(ids[0])
+    seen.complete = True
+    assert seen.classify(ids[0]) is True
+    assert seen.classify(ids[1]) is None
+
+
+def test_outlink_pool_shutdown():
+    frontier = brozzler.RethinkDbFrontier(
+        mock.MagicMock(dbname="brozzler"),
+        outlink_processes=2,
+        outlink_pool_threshold=2,
+    )
+    outlinks = ["http://example.com/a", "http://example.com/b"]
+    assert len(frontier._canonicalize_outlinks(outlinks)) == 2
+    pool = frontier._outlink_pool
+    assert pool
+    frontier.close()
+    assert frontier._outlink_pool is None
+    with pytest.raises(RuntimeError):
+        pool.submit(len, [])
+
+
+def test_upsert_pages_failure():
+    rr = mock.MagicMock(dbname="brozzler")
+    frontier = brozzler.RethinkDbFrontier(rr)
+    pages = [
+        brozzler.Page(None, {"url": "http://example.com/%s" % i}) for i in range(120)
+    ]
+    rr.table("pages").insert().run.side_effect = [
+        {"inserted": 50, "replaced": 0, "unchanged": 0},
+        Exception("query failed"),
+        {"inserted": 10, "replaced": 5, "unchanged": 5},
+    ]
+    # a failed batch is logged and the others still go through
+    assert frontier._upsert_pages(pages) == (60, 10)
+
+
+def test_compiled_scope():
+    site = brozzler.Site(
+        None,
+        {
+            "seed": "http://example.com/",
+            "scope": {
+                "accepts": [
+                    {"ssurt": "org,example,//http:/a/"},
+                    {"regex": "^https?://example\\.net/[a-z]+$"},
+                    {
+                        "domain": "example.info",
+                        "parent_url_regex": "^http://example\\.com/.*$",
+                    },
+                ],
+                "blocks": [{"ssurt": "com,example,//http:/private/"}],
+            },
+        },
+    )
+    parent = brozzler.Page(None, {"url": "http://example.com/", "site_id": 1})
+    assert site.accept_reject_or_neither("http://example.com/foo", parent) is True
+    assert (
+        site.accept_reject_or_neither("http://example.com/private/x", parent) is False
+    )
+    assert site.accept_reject_or_neither("http://example.org/a/b", parent) is True
+    assert site.accept_reject_or_neither("http://example.org/b", parent) is None
+    assert site.accept_reject_or_neither("http://example.net/abc", parent) is True
+    assert site.accept_reject_or_neither("http://example.net/123", parent) is None
+    assert site.accept_reject_or_neither("http://www.example.info/", parent) is True
+    assert site.accept_reject_or_neither("http://www.example.info/") is None
+
+    compiled_scope = site.compiled_scope()
+    assert site.compiled_scope() is compiled_scope
+    assert len(compiled_scope.accepts.match_rules) == 2
+
+    # adding an accept rule invalidates the compiled scope
+    site.note_seed_redirect("https://example.biz/")
+    assert site.compiled_scope() is not compiled_scope
+    assert site.accept_reject_or_neither("https://example.biz/x", parent) is True
+
+    # replacing scope with an equal one reuses the compiled scope
+    compiled_scope = site.compiled_scope()
+    site.scope = copy.deepcopy(site.scope)
+    assert site.compiled_scope() is compiled_scope
+
+
+def test_canonicalize_outlinks():
+    rr = mock.Mock(servers=[mock.Mock()])
+    with mock.patch.object(brozzler.RethinkDbFrontier, "_ensure_db"):
+        frontier = brozzler.RethinkDbFrontier(
+            rr, outlink_processes=2, outlink_pool_threshold=5
+        )
+    outlinks = [
+        "http://example.com/a#foo",
+        "HTTP://EXAMPLE.COM/a",
+        "http://example.com/a#foo",
+        "http://example.com/b/../c?x=1",
+    ]
+
+    # below the threshold, canonicalized in process, each distinct url once
+    canonicalized = frontier._canonicalize_outlinks(outlinks)
+    assert frontier._outlink_pool is None
+    assert list(canonicalized) == outlinks[:2] + outlinks[3:]
+    url_for_scoping, url_for_crawling, hashtag = canonicalized[outlinks[0]]
+    assert url_for_scoping.ssurt() == b"com,example,//http:/a"
+    assert url_for_crawling == "http://example.com/a"
+    assert hashtag == "#foo"
+    assert canonicalized[outlinks[3]][1] == "http://example.com/c?x=1"
+
+    # above the threshold, canonicalized in the process pool
+    outlinks += ["http://example.com/%s" % i for i in range(10)]
+    try:
+        pooled = frontier._canonicalize_outlinks(outlinks)
+        assert frontier._outlink_pool is not None
+    finally:
+        if frontier._outlink_pool:
+            frontier._outlink_pool.shutdown()
+    assert len(pooled) == 13
+    for url in canonicalized:
+        assert pooled[url][0].ssurt() == canonicalized[url][0].ssurt()
+        assert pooled[url][1:] == canonicalized[url][1:]
+
+
+def test_wait_for_wakes_on_message():
+    browser = brozzler.Browser(chrome_exe="chromium-browser")
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(mock.Mock())
+    # with a long wait interval, returning promptly means we were notified
+    browser._wait_interval = 10
+    browser.websock_thread.expect_result(1)
+
+    def receive():
+        time.sleep(0.1)
+        browser.websock_thread._handle_message(
+            None, json.dumps({"id": 1, "result": {}})
+        )
+
+    start = time.time()
+    threading.Thread(target=receive).start()
+    browser._wait_for(lambda: browser.websock_thread.received_result(1), timeout=5)
+    assert time.time() - start < 5
+    assert browser.websock_thread.pop_result(1) == {"id": 1, "result": {}}
+
+    message = json.dumps({"method": "Page.loadEventFired"})
+    threading.Timer(
+        0.1, browser.websock_thread._handle_message, (None, message)
+    ).start()
+    browser._wait_for(lambda: browser.websock_thread.got_page_load_event, timeout=5)
+    assert time.time() - start < 5
+
+    browser._wait_interval = 0.1
+    with pytest.raises(brozzler.browser.BrowsingTimeout):
+        browser._wait_for(lambda: False, timeout=0.3)
+
+
+def test_wait_for_network_idle():
+    browser = brozzler.Browser(chrome_exe="chromium-browser")
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(mock.Mock())
+
+    def network_event(method, request_id):
+        message = {"method": method, "params": {"requestId": request_id}}
+        browser.websock_thread._handle_message(None, json.dumps(message))
+
+    network_event("Network.requestWillBeSent", "1")
+    network_event("Network.requestWillBeSent", "2")
+    assert not browser.wait_for_network_idle(idle_ms=50, timeout=0.3)
+    assert browser.wait_for_network_idle(idle_ms=50, timeout=0.3, max_inflight=2)
+
+    network_event("Network.loadingFinished", "1")
+    threading.Timer(0.2, network_event, ("Network.loadingFailed", "2")).start()
+    start = time.time()
+    assert browser.wait_for_network_idle(idle_ms=100, timeout=5)
+    assert 0.3 <= time.time() - start < 5
+
+    # behaviors.yaml fallback behavior waits for 10s of quiet
+    behavior = brozzler.matching_behavior("http://example.com/")
+    assert behavior["url_regex"] == "^.*$"
+    assert behavior["request_idle_timeout_sec"] == 10
+
+
+def test_cdp_connection_routing():
+    connection = brozzler.browser.CdpConnection("ws://localhost:9/devtools/browser/x")
+
+    def respond(msg):
+        msg = json.loads(msg)
+        result = {"id": msg["id"], "result": {"sessionId": msg["params"]["targetId"]}}
+        connection._on_message(None, json.dumps(result))
+
+    connection.websock.send = respond
+    tab1 = connection.attach("tab1")
+    tab2 = connection.attach("tab2")
+    assert tab1.session_id == "tab1"
+
+    sent = []
+    connection.websock.send = lambda msg: sent.append(json.loads(msg))
+
+    def receive(**message):
+        connection._on_message(None, json.dumps(message))
+
+    receive(sessionId="tab1", method="Page.loadEventFired", params={})
+    assert tab1.got_page_load_event
+    assert not tab2.got_page_load_event
+
+    tab2.expect_result(5)
+    receive(sessionId="tab2", id=5, result={"result": {"value": 1}})
+    assert tab2.received_result(5)
+    tab2.send({"id": 6, "method": "Page.reload"})
+    assert sent == [{"id": 6, "method": "Page.reload", "sessionId": "tab2"}]
+
+    # network events of out-of-process iframes count towards their tab's
+    receive(
+        sessionId="tab1",
+        method="Target.attachedToTarget",
+        params={"sessionId": "frame1", "targetInfo": {"type": "iframe"}},
+    )
+    assert sent[-1] == {"id": 0, "method": "Network.enable", "sessionId": "frame1"}
+    receive(
+        sessionId="frame1",
+        method="Network.requestWillBeSent",
+        params={"requestId": "r1"},
+    )
+    assert not tab1.network_idle_for(0)
+    receive(sessionId="frame1", id=0, result={})
+    receive(
+        sessionId="tab1",
+        method="Target.detachedFromTarget",
+        params={"sessionId": "frame1"},
+    )
+    receive(
+        sessionId="frame1",
+        method="Network.loadingFinished",
+        params={"requestId": "r1"},
+    )
+    assert not tab1.network_idle_for(0)
+    assert tab2.network_idle_for(0)
+
+
+def test_async_cdp_session():
+    class Websock:
+        def __init__(self):
+            self.sent = []
+            self.incoming = asyncio.Queue()
+
+        async def send(self, message):
+            message = json.loads(message)
+            self.sent.append(message)
+            if message["method"] == "Runtime.evaluate":
+                self.receive(id=message["id"], result={"result": {"value": 2}})
+
+        def receive(self, **message):
+            self.incoming.put_nowait(json.dumps(message))
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            message = await self.incoming.get()
+            if message is None:
+                raise StopAsyncIteration
+            return message
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        websock = Websock()
+        session = brozzler.aiobrowser.AsyncCdpSession(websock)
+        receiver = asyncio.ensure_future(session.receive())
+
+        result = await session.command("Runtime.evaluate", expression="1+1")
+        assert result == {"result": {"value": 2}}
+        with pytest.raises(brozzler.browser.BrowsingTimeout):
+            await session.command("Page.navigate", timeout=0.1, url="about:blank")
+
+        # reaching a warcprox limit cancels browsing in progress
+        warcprox_meta = {"reached-limit": {"test_limit": 1}}
+        response = {
+            "status": 420,
+            "headers": {"Warcprox-Meta": json.dumps(warcprox_meta)},
+        }
+        loop.call_later(
+            0.1,
+            lambda: websock.receive(
+                method="Network.responseReceived", params={"response": response}
+            ),
+        )
+        browsing = asyncio.ensure_future(asyncio.sleep(10))
+        with pytest.raises(brozzler.ReachedLimit) as excinfo:
+            await session.guard(browsing)
+        assert excinfo.value.warcprox_meta == warcprox_meta
+        assert browsing.cancelled()
+
+        session.reset_abort()
+        websock.receive(method="Network.requestWillBeSent", params={"requestId": "1"})
+        await asyncio.sleep(0.01)
+        assert not await session.wait_for_network_idle(idle_ms=50, timeout=0.2)
+        loop.call_later(
+            0.1,
+            lambda: websock.receive(
+                method="Network.loadingFinished", params={"requestId": "1"}
+            ),
+        )
+        assert await session.wait_for_network_idle(idle_ms=50, timeout=2)
+
+        # losing the connection aborts browsing too
+        websock.incoming.put_nowait(None)
+        await receiver
+        assert not session.is_open
+        session.reset_abort()
+        with pytest.raises(brozzler.browser.BrowsingException):
+            await session.guard(asyncio.sleep(10))
+
+    asyncio.run(scenario())
+
+
+def test_content_type_prober():
+    prober = brozzler.prober.ContentTypeProber()
+    site = brozzler.Site(None, {"id": "site1", "seed": "http://example.com/"})
+    response = mock.MagicMock(
+        status_code=200,
+        headers=CaseInsensitiveDict({"content-type": "application/pdf"}),
+    )
+    response.__enter__.return_value = response
+    with mock.patch.object(prober._session, "head", return_value=response) as head:
+        for i in range(3):
+            headers = prober.probe(site, "http://example.com/%s.PDF" % i)
+            assert headers["Content-Type"] == "application/pdf"
+        # the third pdf wasn't probed
+        assert head.call_count == 2
+
+        # extensions seen with different content-types are always probed
+        response.headers = CaseInsensitiveDict({"content-type": "text/html"})
+        prober.probe(site, "http://example.com/a.php")
+        response.headers = CaseInsensitiveDict({"content-type": "image/png"})
+        prober.probe(site, "http://example.com/b.php")
+        prober.probe(site, "http://example.com/c.php")
+        assert head.call_count == 5
+
+        prober.forget_site(site)
+        prober.probe(site, "http://example.com/3.pdf")
+        assert head.call_count == 6
+
+
+def test_warcprox_client():
+    records = []
+    client_ports = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_WARCPROX_WRITE_RECORD(self):
+            payload = self.rfile.read(int(self.headers["Content-Length"]))
+            records.append((self.path, self.headers["WARC-Type"], payload))
+            client_ports.add(self.client_address[1])
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    address = "127.0.0.1:%s" % httpd.server_port
+    client = brozzler.warcprox_client.WarcproxClient()
+    try:
+        request, response = client.write_record(
+            address, "screenshot:http://example.com/", "resource", "image/jpeg", b"a"
+        )
+        assert response.code == 204
+        for i in range(3):
+            request, response = client.write_record(
+                address, "thumbnail:http://example.com/", "resource", "image/jpeg", b"b"
+            )
+            assert response.status == 204
+    finally:
+        client.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert records[0] == ("screenshot:http://example.com/", "resource", b"a")
+    assert len(records) == 4
+    # one keep-alive connection for all four records
+    assert len(client_ports) == 1
+
+
+def test_screenshot_records():
+    out = io.BytesIO()
+    PIL.Image.new("RGB", (2400, 6000), "red").save(out, "jpeg")
+    screenshot_jpeg = out.getvalue()
+
+    thumbnail = PIL.Image.open(io.BytesIO(brozzler.worker.thumb_jpeg(screenshot_jpeg)))
+    assert thumbnail.size == (300, 750)
+
+    worker = brozzler.BrozzlerWorker(frontier=None, thumbnail_processes=1)
+    with mock.patch.object(worker, "_warcprox_write_record") as write_record:
+        future = worker._screenshot_executor.submit(
+            worker._write_screenshot_records,
+            "localhost:8000",
+            "http://example.com/",
+            memoryview(bytearray(screenshot_jpeg)),
+            {"Warcprox-Meta": "{}"},
+        )
+        future.result()
+    worker._thumbnail_executor.shutdown()
+
+    assert write_record.call_count == 2
+    screenshot_call, thumbnail_call = write_record.call_args_list
+    assert screenshot_call.kwargs["url"] == "screenshot:http://example.com/"
+    assert screenshot_call.kwargs["payload"] == screenshot_jpeg
+    assert thumbnail_call.kwargs["url"] == "thumbnail:http://example.com/"
+    assert thumbnail_call.kwargs["extra_headers"] == {"Warcprox-Meta": "{}"}
+    thumbnail = PIL.Image.open(io.BytesIO(thumbnail_call.kwargs["payload"]))
+    assert thumbnail.size == (300, 750)
+
+
+def test_b64decode_to_buffer():
+    for data in (b"", b"a", b"ab", b"abc", os.urandom(1000)):
+        encoded = base64.b64encode(data).decode("ascii")
+        decoded = brozzler.browser.b64decode_to_buffer(encoded, chunk_size=8)
+        assert isinstance(decoded, memoryview)
+        assert decoded.nbytes == len(decoded.obj)
+        assert decoded == data
+
+
+def test_brozzle_site_in_tabs():
+    pages = [
+        brozzler.Page(None, {"id": str(i), "url": "http://example.com/%s" % i})
+        for i in range(6)
+    ]
+    unclaimed = list(pages)
+
+    def claim_pages(site, worker_id, n=1):
+        if not unclaimed:
+            raise brozzler.NothingToClaim
+        return [unclaimed.pop(0)]
+
+    frontier = mock.Mock()
+    frontier.claim_pages = mock.Mock(side_effect=claim_pages)
+    site = mock.Mock(id="site1", active_brozzling_time=0)
+
+    browser = mock.Mock(warm=False)
+    browser.chrome.port = 9222
+    tabs = [mock.Mock(warm=False), mock.Mock(warm=False)]
+    browser.open_tab = mock.Mock(side_effect=tabs)
+
+    brozzled_by = {}
+
+    def brozzle_page(browser, site, page, enable_youtube_dl=True):
+        time.sleep(0.05)
+        brozzled_by[page.id] = browser
+        return []
+
+    worker = brozzler.BrozzlerWorker(frontier, tabs_per_site=3)
+    worker.brozzle_page = mock.Mock(side_effect=brozzle_page)
+    worker.brozzle_site(browser, site)
+
+    assert sorted(brozzled_by) == [page.id for page in pages]
+    assert len(set(brozzled_by.values())) == 3
+    assert frontier.completed_page.call_count == 6
+    for tab in tabs:
+        tab.start.assert_called_once_with()
+        tab.stop.assert_called_once_with()
+    # every page was done, none left to disclaim
+    frontier.disclaim_pages.assert_called_with([])
+    frontier.disclaim_site.assert_called_once_with(site, None)
+
+
+def test_brozzle_site_in_tabs_from_seed():
+    # only the seed is claimable at first, the other pages are its outlinks
+    seed = brozzler.Page(None, {"id": "seed", "url": "http://example.com/"})
+    outlinks = ["http://example.com/%s" % i for i in range(6)]
+    unclaimed = [seed]
+
+    def claim_pages(site, worker_id, n=1):
+        if not unclaimed:
+            raise brozzler.NothingToClaim
+        return [unclaimed.pop(0)]
+
+    def scope_and_schedule_outlinks(site, page, outlinks, **kwargs):
+        unclaimed.extend(
+            brozzler.Page(None, {"id": url, "url": url}) for url in outlinks
+        )
+
+    frontier = mock.Mock()
+    frontier.claim_pages = mock.Mock(side_effect=claim_pages)
+    frontier.scope_and_schedule_outlinks = mock.Mock(
+        side_effect=scope_and_schedule_outlinks
+    )
+    site = mock.Mock(id="site1", active_brozzling_time=0)
+
+    browser = mock.Mock(warm=False)
+    browser.chrome.port = 9222
+    tabs = [mock.Mock(warm=False), mock.Mock(warm=False)]
+    browser.open_tab = mock.Mock(side_effect=tabs)
+
+    brozzled_by = {}
+
+    def brozzle_page(browser, site, page, enable_youtube_dl=True):
+        time.sleep(0.1)
+        brozzled_by[page.id] = browser
+        return outlinks if page is seed else []
+
+    worker = brozzler.BrozzlerWorker(frontier, tabs_per_site=3)
+    worker.brozzle_page = mock.Mock(side_effect=brozzle_page)
+    worker.brozzle_site(browser, site)
+
+    assert sorted(brozzled_by) == sorted(["seed"] + outlinks)
+    # the extra tabs waited for the seed's outlinks instead of giving up
+    for tab in tabs:
+        assert tab in brozzled_by.values()
+    frontier.disclaim_pages.assert_called_with([])
+    frontier.disclaim_site.assert_called_once_with(site, None)
+
+
+def test_browse_page_failure_logs_pending_records():
+    worker = brozzler.BrozzlerWorker(mock.Mock())
+    site = brozzler.Site(None, {"seed": "http://example.com/"})
+    page = brozzler.Page(None, {"url": "http://example.com/"})
+
+    def browse_page(url, on_screenshot, **kwargs):
+        on_screenshot(b"jpeg")
+        raise brozzler.browser.BrowsingTimeout
+
+    browser = mock.Mock(browse_page=browse_page)
+    with mock.patch.object(
+        worker, "_using_warcprox", return_value=True
+    ), mock.patch.object(
+        worker, "_proxy_for", return_value="localhost:8000"
+    ), mock.patch.object(
+        worker, "_write_screenshot_records", side_effect=brozzler.ProxyError
+    ), mock.patch.object(
+        worker.logger, "error"
+    ) as error:
+        with pytest.raises(brozzler.browser.BrowsingTimeout):
+            worker._browse_page(browser, site, page)
+        # waits for the screenshot record to be done with
+        worker._shutdown_executors()
+    error.assert_called_once()
+    assert isinstance(error.call_args.kwargs["exc_info"], brozzler.ProxyError)
+
+
+def test_claim_backoff():
+    backoff = brozzler.worker._ClaimBackoff(initial=1.0, maximum=8.0, jitter=0.5)
+    assert backoff.wait_time() == 0
+
+    # waits grow exponentially, randomized within their upper half
+    for expected in (1, 2, 4, 8, 8):
+        backoff.nothing_to_claim()
+        assert expected / 2 - 0.1 <= backoff.wait_time() <= expected
+
+    # a site becoming claimable brings the next attempt forward
+    backoff.work_available(time.time())
+    assert backoff.wait_time() <= 0.5
+    # but not before the site is actually claimable
+    backoff.nothing_to_claim()
+    backoff.work_available(time.time() + 100)
+    assert 0.4 <= backoff.wait_time() <= 1
+
+    backoff.nothing_to_claim()
+    backoff.succeeded()
+    assert backoff.wait_time() == 0
+
+
+def test_host_politeness():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = (
+                b"User-agent: slowbot\nCrawl-delay: 100\n\n"
+                b"User-agent: *\nCrawl-delay: 5\n"
+            )
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = http.server.HTTPServer(("localhost", 0), Handler)
+    httpd_thread = threading.Thread(name="httpd", target=httpd.serve_forever)
+    httpd_thread.start()
+
+    try:
+        url = "http://localhost:%s/page" % httpd.server_port
+        frontier = mock.Mock()
+        politeness = brozzler.politeness.HostPoliteness(frontier, min_delay=1)
+
+        site = brozzler.Site(None, {"seed": url})
+        assert politeness.delay(site, url) == 5
+        site = brozzler.Site(None, {"seed": url, "user_agent": "SlowBot/1.0"})
+        assert politeness.delay(site, url) == 30  # capped
+        site = brozzler.Site(None, {"seed": url, "ignore_robots": True})
+        assert politeness.delay(site, url) == 1
+
+        page = brozzler.Page(None, {"url": url})
+        turn = doublethink.utcnow() + datetime.timedelta(seconds=2)
+        frontier.reserve_host_turn.return_value = (True, turn)
+        assert 1 < politeness.reserve_turn(site, page) <= 2
+        frontier.reserve_host_turn.assert_called_with(
+            "localhost:%s" % httpd.server_port, 1, 60
+        )
+        frontier.defer_page.assert_not_called()
+
+        frontier.reserve_host_turn.return_value = (False, turn)
+        assert politeness.reserve_turn(site, page) is None
+        frontier.defer_page.assert_called_with(page, turn)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+
+def test_hop_path():
+    hop_path = None
+    for i in range(40):
+        hop_path = brozzler.model.append_hop(hop_path, "L")
+    assert hop_path == "L40"
+    assert brozzler.model.append_hop("LLRL", "L") == "L2RL2"
+    assert brozzler.model.expand_hop_path("L2RL2") == "LLRLL"
+    # hop paths stored before they were run-length encoded
+    assert brozzler.model.expand_hop_path("LLRL") == "LLRL"
+    assert brozzler.model.expand_hop_path("") == ""
+    assert brozzler.model.expand_hop_path(None) is None
+
+    warcprox_meta = {"metadata": {"seed": "http://example.com/"}, "blocks": []}
+    site = brozzler.Site(
+        None, {"seed": "http://example.com/", "warcprox_meta": warcprox_meta}
+    )
+    page = brozzler.Page(
+        None, {"url": "http://example.com/a", "hop_path": "L3", "via_page_url": "x"}
+    )
+    headers = site.extra_headers(page)
+    metadata = json.loads(headers["Warcprox-Meta"])["metadata"]
+    assert metadata["hop_path"] == "LLL"
+    assert metadata["brozzled_url"] == "http://example.com/a"
+    # site's warcprox_meta is left alone
+    assert warcprox_meta == {"metadata": {"seed": "http://example.com/"}, "blocks": []}
+
+
+def test_warcprox_meta_header_cached():
+    warcprox_meta = {
+        "warc-prefix": "test",
+        "metadata": {"seed": "http://example.com/"},
+        "blocks": [{"domain": "example.org"}],
+    }
+    site = brozzler.Site(
+        None, {"seed": "http://example.com/", "warcprox_meta": warcprox_meta}
+    )
+    page = brozzler.Page(None, {"url": "http://example.com/a", "hop_path": "L"})
+    compressed_blocks = base64.b64encode(
+        zlib.compress(b'[{"domain":"example.org"}]')
+    ).decode()
+    with mock.patch("brozzler.model.zlib.compress", wraps=zlib.compress) as compress:
+        headers = site.extra_headers()
+        assert json.loads(headers["Warcprox-Meta"]) == {
+            "warc-prefix": "test",
+            "metadata": {"seed": "http://example.com/"},
+            "compressed_blocks": compressed_blocks,
+        }
+        page_warcprox_meta = json.loads(site.extra_headers(page)["Warcprox-Meta"])
+        assert page_warcprox_meta["warc-prefix"] == "test"
+        assert page_warcprox_meta["metadata"] == {
+            "seed": "http://example.com/",
+            "hop_path": "L",
+            "brozzled_url": "http://example.com/a",
+            "hop_via_url": None,
+        }
+        # reloading the same warcprox_meta, as refresh() does, doesn't
+        # recompress the blocks
+        site.warcprox_meta = copy.deepcopy(warcprox_meta)
+        assert site.extra_headers() == headers
+        assert compress.call_count == 1
+
+    site.warcprox_meta = {"blocks": []}
+    assert json.loads(site.extra_headers(page)["Warcprox-Meta"]) == {
+        "compressed_blocks": base64.b64encode(zlib.compress(b"[]")).decode(),
+        "metadata": {
+            "hop_path": "L",
+            "brozzled_url": "http://example.com/a",
+            "hop_via_url": None,
+        },
+    }